@@ -1,6 +1,19 @@
-from flask import Flask, request, jsonify
-from oi_cache import get_oi, get_oi_age
-from dhan_ws import start_ws
+from flask import Flask, Response, g, request, jsonify
+import metrics
+from metrics import log_every
+import oi_cache
+from oi_views import build_get_oi, build_health, build_status, get_oi_tag
+from response_cache import cached_json_response
+from oi_stream import parse_symbols, parse_window, stream_events, stream_slots, MAX_STREAMS
+from snapshot_scheduler import scheduler as snapshot_scheduler
+from oi_bars import build_oi_bars
+from symbol_search import build_search
+from option_chain import build_chain_oi, engine as option_chain_engine
+from oi_export import build_export
+from dhan_ws import start_ws, get_feed_stats
+from instrument_registry import get_registry
+import scrip_master
+from lifecycle import lifecycle, build_ready
 import os
 import time
 from tv_endpoint import tv_bp
@@ -17,6 +30,21 @@ app.register_blueprint(tv_bp)
 # Отключаем проверку имени хоста для решения проблемы с IDNA
 app.config['SERVER_NAME'] = None
 
+@app.before_request
+def start_timer():
+    # Запуск при первом запросе, если сервер не вызвал lifecycle.start() сам
+    lifecycle.start()
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    # Долгие потоки /stream не учитываются в задержке запросов
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unknown"
+    if endpoint != "/stream" and "started" in g:
+        metrics.REQUEST_LATENCY.observe(time.perf_counter() - g.started, endpoint)
+    metrics.REQUESTS.inc(endpoint, str(response.status_code))
+    return response
+
 # Глобальный флаг, показывающий состояние WebSocket
 websocket_status = {"connected": False, "last_attempt": 0, "error": None}
 
@@ -33,11 +61,29 @@ def init_websocket():
         websocket_status["error"] = str(e)
         logging.error(f"Ошибка при запуске WebSocket: {e}")
 
-# Запускаем WebSocket при старте
-try:
-    init_websocket()
-except Exception as e:
-    logging.critical(f"Критическая ошибка при инициализации WebSocket: {e}")
+def start_feed():
+    """
+    Запускает фид в этом процессе. В режиме "reader" данные пишет отдельный
+    процесс фида (feed_process.py), а воркер только читает разделяемую память.
+    """
+    if oi_cache.STORE_MODE == "reader":
+        websocket_status["mode"] = "shared"
+        return
+    try:
+        init_websocket()
+    except Exception as e:
+        logging.critical(f"Критическая ошибка при инициализации WebSocket: {e}")
+    # Опционные цепочки из OI_CHAIN_SYMBOLS подписываются через тот же фид
+    option_chain_engine.start()
+
+# Ничего не запускается при импорте: шаги выполняет lifecycle.start() после
+# fork воркера (gunicorn.conf.py), при первом запросе или в __main__
+lifecycle.on_start("registry", get_registry)
+# Индекс справочника строится здесь (под flock), а не на пути запроса
+lifecycle.on_start("scrip_master", scrip_master.start)
+lifecycle.on_start("feed", start_feed)
+# Снимки изменений OI по всем символам на границах интервалов
+lifecycle.on_start("snapshots", snapshot_scheduler.start)
 
 @app.route("/get_oi")
 def get_oi_endpoint():
@@ -46,24 +92,8 @@ def get_oi_endpoint():
         if not ticker:
             return jsonify({"error": "Ticker parameter is required"}), 400
         
-        oi = get_oi(ticker)
-        if oi is None:
-            # Проверяем возраст данных
-            age = get_oi_age(ticker)
-            if age is not None:
-                return jsonify({
-                    "error": f"OI data is stale (last update {int(age)} seconds ago)", 
-                    "symbol": ticker,
-                    "status": "error"
-                }), 503
-            else:
-                return jsonify({
-                    "error": f"OI data not available for {ticker}",
-                    "symbol": ticker,
-                    "status": "error"
-                }), 404
-                
-        return jsonify({"symbol": ticker, "open_interest": oi, "status": "success"})
+        return cached_json_response(("get_oi", ticker), get_oi_tag(ticker),
+                                    lambda: build_get_oi(ticker))
     except Exception as e:
         logging.error(f"Ошибка в get_oi_endpoint: {e}")
         return jsonify({"error": str(e), "status": "error"}), 500
@@ -80,35 +110,124 @@ def index():
         logging.error(f"Ошибка в index: {e}")
         return jsonify({"error": str(e), "status": "error"}), 500
 
+@app.route("/health")
+def health():
+    """Проверка для балансировщика: O(1), без обхода тикеров"""
+    try:
+        payload, status = build_health(websocket_status)
+        return jsonify(payload), status
+    except Exception as e:
+        logging.error(f"Ошибка в health: {e}")
+        return jsonify({"error": str(e), "status": "error"}), 500
+
+@app.route("/ready")
+def ready():
+    """Готовность: подписка подтверждена и пришли первые тики (503 до этого)"""
+    try:
+        payload, status = build_ready(get_feed_stats())
+        return jsonify(payload), status
+    except Exception as e:
+        logging.error(f"Ошибка в ready: {e}")
+        return jsonify({"error": str(e), "status": "error"}), 500
+
 @app.route("/status")
 def status():
     try:
-        # Проверяем наличие данных для всех тикеров
-        from config import get_config
-        config = get_config()
-        
-        status_data = {
-            "server": "running",
-            "websocket": websocket_status,
-            "tickers": {}
-        }
-        
-        for ticker in config.get("tickers", []):
-            symbol = ticker.get("symbol")
-            oi = get_oi(symbol)
-            age = get_oi_age(symbol)
-            
-            status_data["tickers"][symbol] = {
-                "has_data": oi is not None,
-                "last_update_age": int(age) if age is not None else None,
-                "data_fresh": age is not None and age < 60 if age is not None else False
-            }
-        
-        return jsonify(status_data)
+        return jsonify(build_status(websocket_status, get_feed_stats()))
     except Exception as e:
         logging.error(f"Ошибка в status: {e}")
         return jsonify({"error": str(e), "status": "error"}), 500
 
+@app.route("/oi_bars")
+def oi_bars():
+    """Бары OI по таймфреймам, выровненные по сессии NSE"""
+    try:
+        symbol = request.args.get("symbol")
+        if not symbol:
+            return jsonify({"error": "Symbol parameter is required"}), 400
+        payload, status = build_oi_bars(symbol, request.args.get("timeframes"), request.args.get("since"))
+        return jsonify(payload), status
+    except Exception as e:
+        logging.error(f"Ошибка в oi_bars: {e}")
+        return jsonify({"error": str(e), "status": "error"}), 500
+
+@app.route("/search")
+def search():
+    """Поиск символов по префиксу и с опечатками"""
+    try:
+        payload, status = build_search(request.args.get("q"), request.args.get("limit"))
+        return jsonify(payload), status
+    except Exception as e:
+        logging.error(f"Ошибка в search: {e}")
+        return jsonify({"error": str(e), "status": "error"}), 500
+
+@app.route("/chain_oi")
+def chain_oi():
+    """OI опционной цепочки: PCR, max pain, концентрация и изменение OI по страйкам"""
+    try:
+        symbol = request.args.get("symbol")
+        if not symbol:
+            return jsonify({"error": "Symbol parameter is required"}), 400
+        payload, status = build_chain_oi(symbol, request.args.get("expiry"))
+        return jsonify(payload), status
+    except Exception as e:
+        logging.error(f"Ошибка в chain_oi: {e}")
+        return jsonify({"error": str(e), "status": "error"}), 500
+
+@app.route("/snapshot")
+def snapshot():
+    """Последний снимок изменений OI по всем символам"""
+    try:
+        latest = snapshot_scheduler.latest
+        if latest is None:
+            return jsonify({"error": "Snapshot is not ready yet", "status": "error"}), 503
+        return cached_json_response(("snapshot",), latest.timestamp, lambda: (latest.to_dict(), 200))
+    except Exception as e:
+        logging.error(f"Ошибка в snapshot: {e}")
+        return jsonify({"error": str(e), "status": "error"}), 500
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Метрики процесса в формате Prometheus"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route("/stream")
+def stream():
+    """Push-поток обновлений OI (Server-Sent Events)"""
+    symbols = parse_symbols(request.args.get("symbols"))
+    window = parse_window(request.args.get("window"))
+    # Поток SSE держит поток воркера, пока клиент подключён: сверх предела - 503,
+    # чтобы /get_oi, /tv_data и /ready не остались без потоков
+    if not stream_slots.acquire(blocking=False):
+        log_every("stream_limit", f"Отклонён /stream: открыто {MAX_STREAMS} потоков (OI_MAX_STREAMS)")
+        return jsonify({"error": "Too many open streams, retry later", "status": "error"}), 503, \
+            {"Retry-After": "5"}
+    try:
+        response = Response(stream_events(symbols, window), mimetype="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        # Слот освобождается при закрытии ответа - и когда генератор не успел начаться
+        response.call_on_close(stream_slots.release)
+    except Exception:
+        stream_slots.release()
+        raise
+    return response
+
+@app.route("/export")
+def export():
+    """Потоковая выгрузка истории OI в колоночном формате (npz или Arrow IPC)"""
+    try:
+        payload, status = build_export(parse_symbols(request.args.get("symbols")), request.args.get("start"),
+                                       request.args.get("end"), request.args.get("source"),
+                                       request.args.get("format"))
+        if status != 200:
+            return jsonify(payload), status
+        return Response(payload.stream(), mimetype=payload.content_type,
+                        headers={"Content-Disposition": f'attachment; filename="{payload.filename}"'})
+    except Exception as e:
+        logging.error(f"Ошибка в export: {e}")
+        return jsonify({"error": str(e), "status": "error"}), 500
+
 if __name__ == "__main__":
+    lifecycle.start()
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
+    app.run(host="0.0.0.0", port=port, threaded=True)
@@ -0,0 +1,355 @@
+"""
+ASGI-режим сервера: HTTP и фид Dhan в одном цикле событий asyncio.
+
+Отдаёт те же /get_oi, /status, /health, /ready, /tv_data, /tv_data_batch, /snapshot,
+/oi_bars, /search, /chain_oi, /export и /stream, что и Flask-приложение (app.py), но фид
+работает как задачи asyncio (async_feed.py), а не в потоках websocket-client. Один процесс обслуживает
+тысячи одновременных опросов.
+
+Запуск:
+    python asgi_app.py
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import json
+import os
+import time
+import logging
+from urllib.parse import parse_qs
+
+import dhan_ws
+import metrics
+import scrip_master
+from async_feed import AsyncFeed
+from feed_supervisor import supervisor, snapshot_source
+from instrument_registry import get_registry
+from lifecycle import lifecycle, build_ready
+from oi_stream import (parse_symbols, parse_window, publisher, format_event,
+                       snapshot_event, HEARTBEAT_EVENT)
+from oi_bars import build_oi_bars
+from symbol_search import build_search
+from option_chain import build_chain_oi, engine as option_chain_engine
+from oi_export import build_export
+from oi_views import build_get_oi, build_health, build_status, get_oi_tag
+from response_cache import get_or_build, serialize
+from snapshot_scheduler import scheduler as snapshot_scheduler
+from tv_endpoint import build_tv_data, build_tv_data_batch, discover_ticker, tv_data_tag
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s [%(levelname)s] %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+feed = None
+websocket_status = {"connected": False, "last_attempt": 0, "error": None, "mode": "asgi"}
+
+
+def feed_stats():
+    stats = feed.stats() if feed is not None else []
+    websocket_status["connected"] = any(shard["connected"] for shard in stats)
+    return stats
+
+
+metrics.register_feed_stats(feed_stats)
+lifecycle.on_start("registry", get_registry)
+# Индекс справочника строится здесь (под flock), а не на пути запроса
+lifecycle.on_start("scrip_master", scrip_master.start)
+
+
+async def start_feed():
+    global feed
+    websocket_status["last_attempt"] = time.time()
+    url = dhan_ws.feed_url(dhan_ws.load_config())
+    if url is None:
+        websocket_status["error"] = "Отсутствуют параметры аутентификации"
+        return
+    # Тёплый старт из журнала тиков - файловый ввод-вывод вне цикла событий
+    await asyncio.get_running_loop().run_in_executor(None, dhan_ws.replay_journal)
+    supervisor.source = snapshot_source(dhan_ws.load_config())
+    feed = AsyncFeed(url)
+    await feed.add_instruments(dhan_ws.feed_tickers())
+    feed.start()
+    logging.info("Асинхронный фид Dhan запущен")
+    # Новые цепочки подписываются (истёкшие - отписываются) по открытым соединениям асинхронного фида;
+    # старт (с возможной сборкой индекса справочника) - вне цикла событий
+    loop = asyncio.get_running_loop()
+    option_chain_engine.subscriber = lambda tickers: loop.call_soon_threadsafe(feed.subscribe, tickers)
+    option_chain_engine.unsubscriber = lambda tickers: asyncio.run_coroutine_threadsafe(feed.unsubscribe(tickers), loop)
+    await loop.run_in_executor(None, option_chain_engine.start)
+
+
+async def stop_feed():
+    snapshot_scheduler.stop()
+    if feed is not None:
+        await feed.stop()
+
+
+def _etag_matches(headers, etag):
+    header = headers.get(b'if-none-match')
+    if not header or not etag:
+        return False
+    for candidate in header.decode('latin-1').split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate.strip('"') == etag or candidate == '*':
+            return True
+    return False
+
+
+async def _respond(send, status, body, etag=None):
+    headers = [(b'content-type', b'application/json')]
+    if etag:
+        headers.append((b'etag', f'"{etag}"'.encode('latin-1')))
+        headers.append((b'cache-control', b'no-cache'))
+    headers.append((b'content-length', str(len(body)).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _respond_cached(send, headers, key, tag, build):
+    body, status, etag = get_or_build(key, tag, build)
+    if etag and _etag_matches(headers, etag):
+        await _respond(send, 304, b'', etag)
+    else:
+        await _respond(send, status, body, etag)
+
+
+async def handle_get_oi(params, headers, send):
+    ticker = params.get("ticker")
+    if not ticker:
+        await _respond(send, 400, serialize({"error": "Ticker parameter is required"}))
+        return
+    await _respond_cached(send, headers, ("get_oi", ticker), get_oi_tag(ticker),
+                          lambda: build_get_oi(ticker))
+
+
+async def handle_tv_data(params, headers, send):
+    symbol = params.get("symbol", "NIFTY")
+    if not get_registry().get(symbol):
+        new_ticker = await asyncio.get_running_loop().run_in_executor(None, discover_ticker, symbol)
+        if new_ticker and feed is not None and dhan_ws.is_subscribable(new_ticker):
+            feed.subscribe([new_ticker])
+    timeframes = params.get("timeframes")
+    await _respond_cached(send, headers, ("tv_data", symbol, timeframes), tv_data_tag(symbol),
+                          lambda: build_tv_data(symbol, timeframes))
+
+
+async def handle_tv_data_batch(params, headers, send):
+    payload, status = build_tv_data_batch(params.get("symbols", "all"), params.get("timeframes"))
+    await _respond(send, status, serialize(payload))
+
+
+async def handle_metrics(params, headers, send):
+    body = metrics.render().encode('utf-8')
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', metrics.CONTENT_TYPE.encode('latin-1')),
+        (b'content-length', str(len(body)).encode('latin-1')),
+    ]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def handle_oi_bars(params, headers, send):
+    symbol = params.get("symbol")
+    if not symbol:
+        await _respond(send, 400, serialize({"error": "Symbol parameter is required"}))
+        return
+    payload, status = build_oi_bars(symbol, params.get("timeframes"), params.get("since"))
+    await _respond(send, status, serialize(payload))
+
+
+async def handle_search(params, headers, send):
+    payload, status = build_search(params.get("q"), params.get("limit"))
+    await _respond(send, status, serialize(payload))
+
+
+async def handle_chain_oi(params, headers, send):
+    symbol = params.get("symbol")
+    if not symbol:
+        await _respond(send, 400, serialize({"error": "Symbol parameter is required"}))
+        return
+    # Первая подписка на цепочку может собирать индекс справочника из CSV
+    # (секунды) - вне цикла событий, как поиск тикера в handle_tv_data
+    payload, status = await asyncio.get_running_loop().run_in_executor(
+        None, build_chain_oi, symbol, params.get("expiry"))
+    await _respond(send, status, serialize(payload))
+
+
+async def handle_export(params, headers, send):
+    """Потоковая выгрузка: куски читаются с диска в пуле потоков, цикл событий не блокируется"""
+    payload, status = build_export(parse_symbols(params.get("symbols")), params.get("start"),
+                                   params.get("end"), params.get("source"), params.get("format"))
+    if status != 200:
+        await _respond(send, status, serialize(payload))
+        return
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', payload.content_type.encode('latin-1')),
+        (b'content-disposition', f'attachment; filename="{payload.filename}"'.encode('latin-1')),
+    ]})
+    loop = asyncio.get_running_loop()
+    chunks = payload.stream()
+    while True:
+        data = await loop.run_in_executor(None, next, chunks, None)
+        if data is None:
+            break
+        if data:
+            await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def handle_snapshot(params, headers, send):
+    latest = snapshot_scheduler.latest
+    if latest is None:
+        await _respond(send, 503, serialize({"error": "Snapshot is not ready yet", "status": "error"}))
+        return
+    await _respond_cached(send, headers, ("snapshot",), latest.timestamp, lambda: (latest.to_dict(), 200))
+
+
+async def handle_status(params, headers, send):
+    await _respond(send, 200, serialize(build_status(websocket_status, feed_stats())))
+
+
+async def handle_health(params, headers, send):
+    feed_stats()
+    payload, status = build_health(websocket_status)
+    await _respond(send, status, serialize(payload))
+
+
+async def handle_ready(params, headers, send):
+    payload, status = build_ready(feed_stats())
+    await _respond(send, status, serialize(payload))
+
+
+async def handle_index(params, headers, send):
+    feed_stats()
+    await _respond(send, 200, serialize({
+        "status": "ok",
+        "message": "Dhan OI Server работает",
+        "websocket": websocket_status
+    }))
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def handle_stream(params, receive, send):
+    """Push-поток обновлений OI (Server-Sent Events)"""
+    symbols = parse_symbols(params.get("symbols"))
+    subscription = publisher.subscribe(symbols, parse_window(params.get("window")))
+    disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        initial = snapshot_event(symbols)
+        if initial:
+            await send({'type': 'http.response.body', 'body': initial.encode(), 'more_body': True})
+        while True:
+            batch = asyncio.ensure_future(subscription.next_batch_async())
+            await asyncio.wait({batch, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                batch.cancel()
+                return
+            event = format_event(batch.result()) if batch.result() else HEARTBEAT_EVENT
+            await send({'type': 'http.response.body', 'body': event.encode(), 'more_body': True})
+    finally:
+        disconnected.cancel()
+        publisher.unsubscribe(subscription)
+
+
+ROUTES = {
+    "/": handle_index,
+    "/get_oi": handle_get_oi,
+    "/status": handle_status,
+    "/health": handle_health,
+    "/ready": handle_ready,
+    "/tv_data": handle_tv_data,
+    "/tv_data_batch": handle_tv_data_batch,
+    "/metrics": handle_metrics,
+    "/snapshot": handle_snapshot,
+    "/oi_bars": handle_oi_bars,
+    "/search": handle_search,
+    "/chain_oi": handle_chain_oi,
+    "/export": handle_export,
+}
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Синхронные шаги запуска (реестр инструментов) - вне цикла событий
+            await asyncio.get_running_loop().run_in_executor(None, lifecycle.start)
+            try:
+                await start_feed()
+            except Exception as e:
+                websocket_status["error"] = str(e)
+                logging.error(f"Ошибка при запуске асинхронного фида: {e}")
+            snapshot_scheduler.start_async()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await stop_feed()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    params = {key: values[0] for key, values in parse_qs(scope['query_string'].decode('latin-1')).items()}
+    if scope['method'] == 'POST':
+        # Параметры POST (/tv_data_batch) - из JSON-тела поверх строки запроса, как во Flask
+        body = await _read_body(receive)
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            data = {}
+        if isinstance(data, dict):
+            params.update(data)
+    if scope['path'] == "/stream":
+        await handle_stream(params, receive, send)
+        return
+    handler = ROUTES.get(scope['path'])
+    if handler is None:
+        metrics.REQUESTS.inc("unknown", "404")
+        await _respond(send, 404, serialize({"error": "Not found", "status": "error"}))
+        return
+    headers = dict(scope['headers'])
+    started = time.perf_counter()
+    status = {}
+
+    async def send_tracked(message):
+        if message['type'] == 'http.response.start':
+            status['code'] = message['status']
+        await send(message)
+
+    try:
+        await handler(params, headers, send_tracked)
+    except Exception as e:
+        logging.error(f"Ошибка при обработке {scope['path']}: {e}", exc_info=True)
+        status['code'] = 500
+        await _respond(send, 500, serialize({"error": str(e), "status": "error"}))
+    metrics.REQUEST_LATENCY.observe(time.perf_counter() - started, scope['path'])
+    metrics.REQUESTS.inc(scope['path'], str(status.get('code', 0)))
+
+
+if __name__ == "__main__":
+    import uvicorn
+    port = int(os.environ.get("PORT", 5000))
+    uvicorn.run(app, host="0.0.0.0", port=port, lifespan="on")
@@ -0,0 +1,246 @@
+"""
+Асинхронный фид Dhan для ASGI-режима (asgi_app.py).
+
+Соединения работают как задачи asyncio в том же цикле событий, что и
+HTTP-сервер: переподключение ждёт через asyncio.sleep и не блокирует
+потоков, а кэш OI пишется и читается из одного потока без блокировок.
+Разбор фреймов и формат подписки - те же, что у потокового фида.
+"""
+import asyncio
+import logging
+import time
+
+import websockets
+
+from dhan_ws import process_frame
+from metrics import RECONNECTS
+from feed_manager import (build_subscription_messages, instrument_key,
+                          MAX_INSTRUMENTS_PER_CONNECTION, MAX_CONNECTIONS,
+                          SUBSCRIBE_REQUEST_CODE, UNSUBSCRIBE_REQUEST_CODE,
+                          SUBSCRIBE_COALESCE_WINDOW)
+from feed_supervisor import Backoff, supervisor
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncFeedConnection:
+    """Одно соединение фида, работающее как задача asyncio"""
+
+    def __init__(self, shard_id, url, on_frame=process_frame):
+        self.shard_id = shard_id
+        self.url = url
+        self.on_frame = on_frame
+        self.instruments = {}
+        self.connected = False
+        self.acknowledged = False
+        self.frames = 0
+        self.ticks = 0
+        self.backoff = Backoff()
+        self.tick_rate = 0.0
+        self._rate_sample = (time.monotonic(), 0)
+        self._ws = None
+        self._task = None
+        self._backfill = None
+
+    def __len__(self):
+        return len(self.instruments)
+
+    @property
+    def reconnect_attempt(self):
+        return self.backoff.attempt
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.run(), name=f"dhan-feed-{self.shard_id}")
+        return self._task
+
+    async def stop(self):
+        if self._backfill is not None:
+            self._backfill.cancel()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _send(self, keys, request_code):
+        if not keys or self._ws is None or not self.connected:
+            return
+        for message in build_subscription_messages(keys, request_code):
+            await self._ws.send(message)
+
+    async def run(self):
+        while True:
+            try:
+                async with websockets.connect(self.url, max_size=None) as ws:
+                    self._ws = ws
+                    self.connected = True
+                    self.backoff.connected()
+                    # Желаемая подписка повторяется при каждом подключении
+                    keys = list(self.instruments)
+                    await self._send(keys, SUBSCRIBE_REQUEST_CODE)
+                    logger.info(f"Шард {self.shard_id}: отправлен запрос на подписку для {len(keys)} инструментов")
+                    restored = supervisor.connection_restored(self.shard_id)
+                    if restored is not None:
+                        self._backfill = asyncio.get_running_loop().create_task(
+                            self._run_backfill(list(self.instruments.values()), restored))
+                    async for message in ws:
+                        self.acknowledged = True
+                        self.frames += 1
+                        self.ticks += self.on_frame(message)
+                    logger.warning(f"Шард {self.shard_id}: WebSocket закрыт: "
+                                   f"{ws.close_code} - {ws.close_reason}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Шард {self.shard_id}: WebSocket ошибка: {e}")
+            finally:
+                self.connected = False
+                self.acknowledged = False
+                self._ws = None
+
+            supervisor.connection_lost(self.shard_id)
+            RECONNECTS.inc(str(self.shard_id))
+            delay = self.backoff.next_delay()
+            logger.info(f"Шард {self.shard_id}: попытка переподключения {self.backoff.attempt} через {delay:.1f} секунд...")
+            await asyncio.sleep(delay)
+
+    async def _run_backfill(self, instruments, since):
+        """Восполнение пропусков: запрос снимка - в пуле потоков, запись в кэш - в цикле событий"""
+        await asyncio.sleep(supervisor.delay)
+        values = await asyncio.get_running_loop().run_in_executor(
+            None, supervisor.fetch_backfill, self.shard_id, instruments, since)
+        supervisor.apply_backfill(self.shard_id, values, since)
+
+    async def add(self, instruments):
+        new_keys = []
+        for instrument in instruments:
+            key = instrument_key(instrument)
+            if key not in self.instruments:
+                self.instruments[key] = instrument
+                new_keys.append(key)
+        await self._send(new_keys, SUBSCRIBE_REQUEST_CODE)
+        return new_keys
+
+    async def remove(self, keys):
+        removed = [self.instruments.pop(key) for key in keys if key in self.instruments]
+        await self._send([instrument_key(i) for i in removed], UNSUBSCRIBE_REQUEST_CODE)
+        return removed
+
+    def stats(self):
+        now = time.monotonic()
+        started, ticks = self._rate_sample
+        elapsed = now - started
+        if elapsed >= 1.0:
+            self.tick_rate = (self.ticks - ticks) / elapsed
+            self._rate_sample = (now, self.ticks)
+        return {
+            "shard": self.shard_id,
+            "connected": self.connected,
+            "acknowledged": self.acknowledged or not self.instruments,
+            "instruments": len(self.instruments),
+            "frames": self.frames,
+            "ticks": self.ticks,
+            "tick_rate": round(self.tick_rate, 2),
+            "reconnect_attempt": self.reconnect_attempt
+        }
+
+
+class AsyncFeed:
+    """Набор асинхронных соединений с тем же распределением, что у FeedManager"""
+
+    def __init__(self, url, on_frame=process_frame,
+                 max_per_connection=MAX_INSTRUMENTS_PER_CONNECTION,
+                 max_connections=MAX_CONNECTIONS):
+        self.url = url
+        self.on_frame = on_frame
+        self.max_per_connection = max_per_connection
+        self.max_connections = max_connections
+        self.shards = []
+        self._started = False
+        self._pending = {}
+        self._flush_handle = None
+
+    def _new_shard(self):
+        shard = AsyncFeedConnection(len(self.shards), self.url, self.on_frame)
+        self.shards.append(shard)
+        if self._started:
+            shard.start()
+        return shard
+
+    async def add_instruments(self, instruments):
+        """
+        Распределяет инструменты по соединениям, как FeedManager.add_instruments:
+        сначала раскладка, затем одна подписка на соединение (пачками по
+        MAX_INSTRUMENTS_PER_MESSAGE).
+
+        Returns:
+            int: количество добавленных инструментов
+        """
+        placement = {}
+        placed = set()
+        for instrument in instruments:
+            key = instrument_key(instrument)
+            if key in placed or any(key in shard.instruments for shard in self.shards):
+                continue
+            candidates = [s for s in self.shards
+                          if len(s) + len(placement.get(s.shard_id, ())) < self.max_per_connection]
+            if candidates:
+                shard = min(candidates, key=lambda s: len(s) + len(placement.get(s.shard_id, ())))
+            elif len(self.shards) < self.max_connections:
+                shard = self._new_shard()
+            else:
+                logger.error(f"Достигнут лимит инструментов, {instrument.get('symbol')} не подписан")
+                continue
+            placement.setdefault(shard.shard_id, []).append(instrument)
+            placed.add(key)
+        added = 0
+        for shard_id, batch in placement.items():
+            added += len(await self.shards[shard_id].add(batch))
+        return added
+
+    def subscribe(self, instruments):
+        """Добавляет инструменты к подписке; запросы в пределах окна объединяются"""
+        for instrument in instruments:
+            self._pending[instrument_key(instrument)] = instrument
+        if self._flush_handle is None and self._pending:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(SUBSCRIBE_COALESCE_WINDOW,
+                                                 lambda: loop.create_task(self.flush_pending()))
+
+    async def flush_pending(self):
+        pending = list(self._pending.values())
+        self._pending.clear()
+        self._flush_handle = None
+        if pending:
+            added = await self.add_instruments(pending)
+            logger.info(f"Подписка расширена на {added} инструментов")
+
+    async def unsubscribe(self, instruments):
+        keys = {instrument_key(instrument) for instrument in instruments}
+        for key in keys:
+            self._pending.pop(key, None)
+        removed = 0
+        for shard in self.shards:
+            owned = [key for key in keys if key in shard.instruments]
+            if owned:
+                removed += len(await shard.remove(owned))
+        return removed
+
+    def start(self):
+        self._started = True
+        for shard in self.shards:
+            shard.start()
+        logger.info(f"Асинхронный фид запущен: {len(self.shards)} соединений")
+
+    async def stop(self):
+        self._started = False
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for shard in self.shards:
+            await shard.stop()
+
+    def stats(self):
+        return [shard.stats() for shard in self.shards]
@@ -0,0 +1,166 @@
+"""
+Локальный симулятор фида Dhan v2.
+
+WebSocket-сервер принимает JSON-запросы подписки в формате Dhan
+(RequestCode 15/17/21 - подписка, 16/18/22 - отписка, 12 - отключение) и
+шлёт бинарные OI-пакеты по подписанным инструментам с заданной частотой.
+Токен и остальные параметры URL не проверяются.
+
+Запуск:
+    python bench/dhan_simulator.py --port 8765 --rate 20000 --batch 100
+    DHAN_FEED_URL=ws://127.0.0.1:8765 python app.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import logging
+
+import numpy as np
+import websockets
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dhan_packets import EXCHANGE_SEGMENTS, encode_oi_packets, parse_security_id  # noqa: E402
+
+logger = logging.getLogger("dhan_simulator")
+
+SUBSCRIBE_CODES = {15, 17, 21}
+UNSUBSCRIBE_CODES = {16, 18, 22}
+DISCONNECT_CODE = 12
+
+
+class FeedSimulator:
+    """
+    Генератор тиков для подключённых клиентов.
+
+    Args:
+        rate: тиков в секунду на одно соединение
+        batch: пакетов в одном WebSocket-фрейме
+        values: "walk" - случайное блуждание OI, "seq" - сквозной номер тика
+            (по нему бенчмарк находит время отправки)
+        on_frame: функция (последнее значение во фрейме, время отправки
+            по perf_counter), вызываемая перед отправкой каждого фрейма
+    """
+
+    def __init__(self, rate=10000, batch=100, values="walk", on_frame=None, seed=0):
+        self.rate = rate
+        self.batch = batch
+        self.values = values
+        self.on_frame = on_frame
+        self.frames_sent = 0
+        self.ticks_sent = 0
+        self.connections = 0
+        self._sequence = 0
+        self._random = np.random.default_rng(seed)
+
+    def _next_values(self, state, positions):
+        if self.values == "seq":
+            start = self._sequence + 1
+            self._sequence += len(positions)
+            return np.arange(start, self._sequence + 1, dtype=np.int64)
+        steps = self._random.integers(-50, 51, size=len(positions))
+        state[positions] = np.maximum(state[positions] + steps, 0)
+        return state[positions]
+
+    async def _receive(self, ws, instruments):
+        async for message in ws:
+            try:
+                request = json.loads(message)
+            except (TypeError, ValueError):
+                continue
+            code = request.get("RequestCode")
+            if code == DISCONNECT_CODE:
+                await ws.close()
+                return
+            for item in request.get("InstrumentList", ()):
+                key = (EXCHANGE_SEGMENTS.get(item.get("ExchangeSegment")),
+                       parse_security_id(item.get("SecurityId")))
+                if None in key:
+                    continue
+                if code in SUBSCRIBE_CODES:
+                    instruments[key] = True
+                elif code in UNSUBSCRIBE_CODES:
+                    instruments.pop(key, None)
+
+    async def _stream(self, ws, instruments):
+        cursor = 0
+        state = None
+        keys = None
+        started = time.perf_counter()
+        sent = 0
+        while True:
+            if keys is None or len(keys) != len(instruments):
+                # Подписка изменилась - пересобираем массивы инструментов
+                keys = np.array(list(instruments) or [(0, 0)], dtype=np.int64)[:len(instruments)]
+                state = self._random.integers(100_000, 10_000_000, size=len(keys))
+                cursor = 0
+            if not len(keys):
+                await asyncio.sleep(0.01)
+                started, sent = time.perf_counter(), 0
+                continue
+            # Сколько тиков положено к текущему моменту - без накопления дрейфа
+            owed = int((time.perf_counter() - started) * self.rate) - sent
+            if owed < self.batch:
+                await asyncio.sleep(max((self.batch - owed) / self.rate, 0.0005))
+                continue
+            for _ in range(owed // self.batch):
+                positions = (cursor + np.arange(self.batch)) % len(keys)
+                cursor = (cursor + self.batch) % len(keys)
+                values = self._next_values(state, positions)
+                frame = encode_oi_packets(keys[positions, 0], keys[positions, 1], values)
+                if self.on_frame is not None:
+                    self.on_frame(int(values[-1]), time.perf_counter())
+                await ws.send(frame)
+                sent += self.batch
+                self.frames_sent += 1
+                self.ticks_sent += self.batch
+
+    async def handler(self, ws, path=None):
+        instruments = {}
+        self.connections += 1
+        receiver = asyncio.ensure_future(self._receive(ws, instruments))
+        streamer = asyncio.ensure_future(self._stream(ws, instruments))
+        try:
+            done, _ = await asyncio.wait({receiver, streamer}, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() and not isinstance(task.exception(), websockets.ConnectionClosed):
+                    logger.error(f"Ошибка соединения симулятора: {task.exception()}")
+        finally:
+            receiver.cancel()
+            streamer.cancel()
+            self.connections -= 1
+
+    async def serve(self, host="127.0.0.1", port=8765):
+        """Запускает сервер; возвращает объект сервера websockets"""
+        server = await websockets.serve(self.handler, host, port, max_size=None)
+        logger.info(f"Симулятор фида Dhan слушает ws://{host}:{port} "
+                    f"({self.rate} тиков/сек, {self.batch} пакетов во фрейме)")
+        return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Симулятор фида Dhan v2")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rate", type=int, default=10000, help="тиков в секунду на соединение")
+    parser.add_argument("--batch", type=int, default=100, help="пакетов во фрейме")
+    parser.add_argument("--values", choices=("walk", "seq"), default="walk")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s [%(levelname)s] %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    simulator = FeedSimulator(args.rate, args.batch, args.values)
+
+    async def run():
+        server = await simulator.serve(args.host, args.port)
+        await server.wait_closed()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
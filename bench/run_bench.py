@@ -0,0 +1,352 @@
+"""
+Сквозной бенчмарк сервера OI против локального симулятора фида.
+
+Этапы:
+    import - время импорта app и asgi_app в новом интерпретаторе; импорт не
+             должен запускать потоков (фид стартует в lifecycle.start())
+    decode - process_frame на заранее собранных фреймах (фреймы и тики в секунду)
+    feed   - настоящий FeedManager, подключённый к симулятору: задержка от
+             отправки фрейма до появления тика в кэше
+    http   - /get_oi, /tv_data и /status под параллельной нагрузкой
+
+Бенчмарк создаёт временную конфигурацию с синтетическими инструментами и не
+трогает config.json. Отчёт пишется в JSON; с --baseline сравнивается с
+прошлым отчётом и завершается с кодом 1 при регрессии.
+
+Запуск:
+    python bench/run_bench.py --instruments 500 --rate 20000 --output bench/report.json
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import logging
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SEGMENT = "NSE_FNO"
+FIRST_SECURITY_ID = 900000
+
+
+def percentiles(samples):
+    """p50/p95/p99/max в миллисекундах"""
+    if not len(samples):
+        return None
+    values = np.asarray(samples, dtype=np.float64) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50_ms": round(float(p50), 4), "p95_ms": round(float(p95), 4),
+            "p99_ms": round(float(p99), 4), "max_ms": round(float(values.max()), 4),
+            "samples": int(len(values))}
+
+
+def prepare_environment(workdir, instruments, port, journal):
+    """Временная конфигурация и окружение; вызывается до импорта модулей сервера"""
+    tickers = [{"symbol": f"SIM{i}", "exchange_segment": SEGMENT,
+                "security_id": str(FIRST_SECURITY_ID + i)} for i in range(instruments)]
+    config_path = os.path.join(workdir, "config.json")
+    with open(config_path, "w") as f:
+        json.dump({"token": "bench", "client_id": "bench", "auth_type": 2, "tickers": tickers}, f)
+    os.environ["DHAN_CONFIG_FILE"] = config_path
+    os.environ["DHAN_FEED_URL"] = f"ws://127.0.0.1:{port}"
+    os.environ["OI_STORE_MODE"] = "local"
+    os.environ["OI_JOURNAL"] = "1" if journal else "0"
+    os.environ["OI_JOURNAL_DIR"] = os.path.join(workdir, "journal")
+    return [ticker["symbol"] for ticker in tickers]
+
+
+def bench_import(modules=("app", "asgi_app"), repeats=5):
+    """Время импорта модулей сервера в новом интерпретаторе (минимум и медиана из repeats)"""
+    script = ("import threading, time; started = time.perf_counter(); import {module}; "
+              "print(time.perf_counter() - started, threading.active_count())")
+    report = {}
+    for module in modules:
+        samples = []
+        threads = 0
+        for _ in range(repeats):
+            output = subprocess.check_output([sys.executable, "-c", script.format(module=module)],
+                                             cwd=ROOT, stderr=subprocess.DEVNULL)
+            elapsed, threads = output.decode().split()[-2:]
+            samples.append(float(elapsed))
+        report[module] = {"min_ms": round(min(samples) * 1000, 1),
+                          "median_ms": round(float(np.median(samples)) * 1000, 1),
+                          "threads": int(threads)}
+    return report
+
+
+def bench_decode(instruments, batch, duration):
+    """Пропускная способность process_frame без сети"""
+    import dhan_ws
+    from dhan_packets import EXCHANGE_SEGMENTS, encode_oi_packets
+
+    rng = np.random.default_rng(1)
+    ids = FIRST_SECURITY_ID + np.arange(instruments)
+    frames = [encode_oi_packets(EXCHANGE_SEGMENTS[SEGMENT], rng.choice(ids, batch),
+                                rng.integers(1, 10_000_000, batch)) for _ in range(64)]
+    count = ticks = 0
+    started = time.perf_counter()
+    deadline = started + duration
+    while time.perf_counter() < deadline:
+        for frame in frames:
+            ticks += dhan_ws.process_frame(frame)
+        count += len(frames)
+    elapsed = time.perf_counter() - started
+    return {"frames": count, "ticks": ticks, "seconds": round(elapsed, 3),
+            "frames_per_sec": round(count / elapsed, 1), "ticks_per_sec": round(ticks / elapsed, 1),
+            "us_per_frame": round(elapsed / count * 1e6, 3)}
+
+
+def bench_feed(simulator, duration):
+    """Задержка от отправки фрейма симулятором до записи последнего тика в кэш"""
+    import dhan_ws
+    import metrics
+    import oi_cache
+
+    sent_at = {}
+    latencies = []
+    simulator.on_frame = lambda value, ts: sent_at.__setitem__(value, ts)
+
+    def on_update(symbol, value, updated_at):
+        started = sent_at.pop(value, None)
+        if started is not None:
+            latencies.append(time.perf_counter() - started)
+
+    oi_cache.add_listener(on_update)
+    ticks_before = metrics.TICKS.value()
+    sent_before = simulator.ticks_sent
+    manager = dhan_ws.start_ws()
+    try:
+        connect_deadline = time.monotonic() + 10
+        while not any(shard.connected for shard in manager.shards) and time.monotonic() < connect_deadline:
+            time.sleep(0.05)
+        time.sleep(0.5)  # подписка и первые фреймы
+        latencies.clear()
+        received_before = metrics.TICKS.value()
+        started_sent = simulator.ticks_sent
+        time.sleep(duration)
+        received = metrics.TICKS.value() - received_before
+        sent = simulator.ticks_sent - started_sent
+    finally:
+        manager.stop()
+        oi_cache.remove_listener(on_update)
+        simulator.on_frame = None
+    return {"ticks_sent": sent, "ticks_received": received,
+            "ticks_per_sec": round(received / duration, 1),
+            "delivered_ratio": round(received / sent, 4) if sent else None,
+            "latency": percentiles(latencies),
+            "total_ticks": metrics.TICKS.value() - ticks_before,
+            "total_sent": simulator.ticks_sent - sent_before}
+
+
+def _load_worker(host, port, paths, deadline, results, index):
+    conn = http.client.HTTPConnection(host, port, timeout=10)
+    latencies, errors, i = [], 0, index
+    while time.perf_counter() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        started = time.perf_counter()
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 500:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=10)
+            continue
+        latencies.append(time.perf_counter() - started)
+    conn.close()
+    results.append((latencies, errors))
+
+
+def bench_http(host, port, symbols, concurrency, duration):
+    """Пропускная способность и задержка эндпоинтов под параллельной нагрузкой"""
+    scenarios = {
+        "/get_oi": [f"/get_oi?ticker={symbol}" for symbol in symbols[:200]],
+        "/tv_data": [f"/tv_data?symbol={symbol}" for symbol in symbols[:200]],
+        "/status": ["/status"],
+    }
+    report = {}
+    for name, paths in scenarios.items():
+        results = []
+        deadline = time.perf_counter() + duration
+        threads = [threading.Thread(target=_load_worker, args=(host, port, paths, deadline, results, i))
+                   for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        latencies = [value for worker, _ in results for value in worker]
+        errors = sum(worker_errors for _, worker_errors in results)
+        report[name] = {"requests": len(latencies), "errors": errors,
+                        "requests_per_sec": round(len(latencies) / duration, 1),
+                        "latency": percentiles(latencies)}
+    return report
+
+
+def start_http_server(port):
+    """Flask-приложение на werkzeug в фоновом потоке; фид запускает lifecycle.start()"""
+    from werkzeug.serving import make_server
+    import app as flask_app
+    flask_app.lifecycle.start()
+    # Журнал запросов werkzeug искажает замер
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", port, flask_app.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, name="bench-http")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def start_simulator(simulator, port):
+    """Симулятор в отдельном потоке со своим циклом событий"""
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(simulator.serve("127.0.0.1", port))
+        ready.set()
+        loop.run_forever()
+
+    thread = threading.Thread(target=run, name="dhan-simulator")
+    thread.daemon = True
+    thread.start()
+    ready.wait(10)
+    return loop
+
+
+def compare(report, baseline, tolerance):
+    """Список регрессий относительно прошлого отчёта"""
+    checks = [
+        (("decode", "ticks_per_sec"), True),
+        (("feed", "latency", "p99_ms"), False),
+    ] + [(("import", module, "min_ms"), False) for module in report.get("import", {})] \
+      + [(("http", name, "requests_per_sec"), True) for name in report.get("http", {})]
+    regressions = []
+    for path, higher_is_better in checks:
+        current, previous = report, baseline
+        for key in path:
+            current = current.get(key) if isinstance(current, dict) else None
+            previous = previous.get(key) if isinstance(previous, dict) else None
+        if not current or not previous:
+            continue
+        change = (current - previous) / previous
+        if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+            regressions.append({"metric": ".".join(path), "baseline": previous,
+                                "current": current, "change_pct": round(change * 100, 1)})
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк сервера OI с симулятором фида Dhan")
+    parser.add_argument("--instruments", type=int, default=500)
+    parser.add_argument("--rate", type=int, default=20000, help="тиков в секунду от симулятора")
+    parser.add_argument("--batch", type=int, default=100, help="пакетов во фрейме")
+    parser.add_argument("--duration", type=float, default=5.0, help="длительность каждого этапа, сек")
+    parser.add_argument("--concurrency", type=int, default=16, help="параллельных HTTP-клиентов")
+    parser.add_argument("--sim-port", type=int, default=8765)
+    parser.add_argument("--http-port", type=int, default=5099)
+    parser.add_argument("--journal", action="store_true", help="включить журнал тиков")
+    parser.add_argument("--stages", default="import,decode,feed,http")
+    parser.add_argument("--output", default=os.path.join(ROOT, "bench", "report.json"))
+    parser.add_argument("--baseline", help="прошлый отчёт для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение (доля)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING,
+                        format='%(asctime)s [%(levelname)s] %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    stages = set(args.stages.split(","))
+    workdir = tempfile.mkdtemp(prefix="dhan-bench-")
+    symbols = prepare_environment(workdir, args.instruments, args.sim_port, args.journal)
+
+    from dhan_simulator import FeedSimulator
+    import metrics
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "params": {key: value for key, value in vars(args).items()
+                       if key not in ("output", "baseline")},
+        }
+    }
+
+    if "import" in stages:
+        report["import"] = bench_import()
+        for module, result in report["import"].items():
+            print(f"import {module}: {result['min_ms']} мс, потоков после импорта: {result['threads']}")
+
+    if "decode" in stages:
+        report["decode"] = bench_decode(args.instruments, args.batch, args.duration)
+        print(f"decode: {report['decode']['ticks_per_sec']:.0f} тиков/сек")
+
+    simulator = FeedSimulator(args.rate, args.batch, values="seq")
+    if "feed" in stages or "http" in stages:
+        start_simulator(simulator, args.sim_port)
+
+    if "feed" in stages:
+        report["feed"] = bench_feed(simulator, args.duration)
+        print(f"feed: {report['feed']['ticks_per_sec']:.0f} тиков/сек, задержка {report['feed']['latency']}")
+
+    if "http" in stages:
+        import dhan_ws
+        server = start_http_server(args.http_port)
+        # Данные обновляются во время нагрузки, как в бою
+        manager = dhan_ws.feed_manager or dhan_ws.start_ws()
+        time.sleep(1.0)
+        try:
+            report["http"] = bench_http("127.0.0.1", args.http_port, symbols,
+                                        args.concurrency, args.duration)
+        finally:
+            manager.stop()
+            server.shutdown()
+        for name, result in report["http"].items():
+            print(f"http {name}: {result['requests_per_sec']:.0f} запросов/сек, {result['latency']}")
+
+    report["metrics"] = {}
+    for name, histogram in (("decode", metrics.FRAME_DECODE), ("tick_to_cache", metrics.TICK_TO_CACHE)):
+        _, total, count = histogram.values().get((), (None, 0.0, 0))
+        report["metrics"][name] = {"count": count,
+                                   "mean_us": round(total / count * 1e6, 3) if count else None}
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        report["regressions"] = regressions
+        for regression in regressions:
+            print(f"РЕГРЕССИЯ {regression['metric']}: {regression['baseline']} -> "
+                  f"{regression['current']} ({regression['change_pct']}%)")
+        exit_code = 1 if regressions else 0
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Отчёт сохранён: {args.output}")
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 import os
 import json
-import csv
+import tempfile
+import threading
+import fcntl
+from types import MappingProxyType
 from datetime import datetime
 import logging
 
@@ -9,36 +12,136 @@ logging.basicConfig(level=logging.INFO,
                    format='%(asctime)s [%(levelname)s] %(message)s',
                    datefmt='%Y-%m-%d %H:%M:%S')
 
-CSV_FILE_PATH = "api-scrip-master.csv"
+# Полный справочник инструментов Dhan (см. scrip_master.py)
+CSV_FILE_PATH = os.environ.get("DHAN_SCRIP_MASTER",
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api-scrip-master.csv'))
 
-# Путь к конфигурационному файлу
-CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+# Путь к конфигурационному файлу (DHAN_CONFIG_FILE - например, для бенчмарка)
+CONFIG_FILE = os.environ.get("DHAN_CONFIG_FILE",
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json'))
 
 # Путь к файлу со списком тикеров и их Security ID
 TICKER_SECURITY_ID_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Cleaned_Ticker_Security_ID_List.csv')
+if not os.path.exists(TICKER_SECURITY_ID_FILE):
+    # В репозитории поставляется список в формате "Ticker,Security ID"
+    TICKER_SECURITY_ID_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Tickers_with_Security_IDs.csv')
 
 def find_security_id_from_csv(base_symbol: str, exchange_segment: str = "NSE_FNO") -> int | None:
-    """Эта функция отключена, теперь ID должны быть указаны в config.json"""
-    print(f"[i] Поиск в CSV отключен. Используйте security_id из config.json для {base_symbol}")
-    return None
+    """
+    Ищет Security ID в полном справочнике инструментов Dhan (индекс
+    scrip_master поверх CSV_FILE_PATH). Для F&O базовый символ разрешается
+    в ближайший фьючерс.
+    """
+    from scrip_master import get_scrip_master
+    master = get_scrip_master()
+    if master is None:
+        return None
+    return master.find_security_id(base_symbol, exchange_segment)
+
+# Кэш разобранной конфигурации: (ключ файла, неизменяемый снимок)
+_config_cache = (None, None)
+_config_lock = threading.Lock()
+
+def _freeze(value):
+    """Превращает dict/list в неизменяемые MappingProxyType/tuple"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+def thaw(value):
+    """Возвращает изменяемую копию снимка конфигурации (dict/list)"""
+    if isinstance(value, MappingProxyType) or isinstance(value, dict):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, (tuple, list)):
+        return [thaw(v) for v in value]
+    return value
+
+def _file_key(path):
+    """Ключ для дешёвой проверки изменения файла: inode, mtime и размер"""
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
 
 def get_config():
     """
-    Загружает конфигурацию из файла config.json и возвращает словарь.
+    Загружает конфигурацию из файла config.json и возвращает неизменяемый снимок.
+    
+    Файл разбирается заново только если изменились его inode, mtime или размер.
+    Для изменения конфигурации используйте update_config_file().
     """
+    global _config_cache
     try:
-        with open(CONFIG_FILE, 'r') as f:
-            config = json.load(f)
-        return config
+        key = _file_key(CONFIG_FILE)
+        cached_key, snapshot = _config_cache
+        if key == cached_key:
+            return snapshot
+        
+        with _config_lock:
+            cached_key, snapshot = _config_cache
+            if key == cached_key:
+                return snapshot
+            with open(CONFIG_FILE, 'r') as f:
+                snapshot = _freeze(json.load(f))
+            _config_cache = (key, snapshot)
+            return snapshot
     except FileNotFoundError:
         logging.error(f"Конфигурационный файл не найден: {CONFIG_FILE}")
-        return {}
+        return MappingProxyType({})
     except json.JSONDecodeError as e:
         logging.error(f"Ошибка декодирования JSON: {e}")
-        return {}
+        # Отдаём последний корректный снимок, если он есть
+        return _config_cache[1] if _config_cache[1] is not None else MappingProxyType({})
     except Exception as e:
         logging.error(f"Неизвестная ошибка при загрузке конфигурации: {e}")
-        return {}
+        return _config_cache[1] if _config_cache[1] is not None else MappingProxyType({})
+
+def save_config(config):
+    """
+    Атомарно записывает конфигурацию: во временный файл рядом с config.json,
+    затем os.replace. Читатели видят либо старый, либо новый файл целиком.
+    """
+    global _config_cache
+    directory = os.path.dirname(CONFIG_FILE)
+    fd, tmp_path = tempfile.mkstemp(prefix='.config.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(thaw(config), f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, CONFIG_FILE)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    
+    with _config_lock:
+        _config_cache = (_file_key(CONFIG_FILE), _freeze(thaw(config)))
+
+def update_config_file(mutator):
+    """
+    Читает конфигурацию, применяет к изменяемой копии mutator(config) и
+    атомарно сохраняет результат. Изменения сериализуются межпроцессной
+    блокировкой, чтобы воркеры gunicorn не затирали правки друг друга.
+    
+    Если mutator возвращает False, файл не перезаписывается.
+    
+    Returns:
+        bool: True, если конфигурация была сохранена
+    """
+    lock_path = CONFIG_FILE + '.lock'
+    with open(lock_path, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            config = thaw(get_config())
+            if mutator(config) is False:
+                return False
+            save_config(config)
+            return True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 def find_security_id(symbol):
     """
@@ -51,22 +154,17 @@ def find_security_id(symbol):
         str: Security ID или None, если не найден
     """
     try:
-        # Проверяем существование файла
-        if not os.path.exists(TICKER_SECURITY_ID_FILE):
-            logging.error(f"Файл со списком тикеров не найден: {TICKER_SECURITY_ID_FILE}")
-            return None
+        from instrument_registry import get_registry
+        security_id = get_registry().find_security_id(symbol)
+        if security_id:
+            logging.info(f"Найден Security ID для {symbol}: {security_id}")
+            return security_id
         
-        # Поиск символа в файле
-        with open(TICKER_SECURITY_ID_FILE, 'r') as f:
-            reader = csv.reader(f)
-            next(reader)  # Пропускаем заголовок
-            
-            # Ищем точное соответствие символу
-            for row in reader:
-                if len(row) >= 3 and row[1].strip() == symbol:
-                    security_id = row[2].strip()
-                    logging.info(f"Найден Security ID для {symbol}: {security_id}")
-                    return security_id
+        # Нет в списке тикеров - ищем в полном справочнике (фьючерсы, опционы)
+        security_id = find_security_id_from_csv(symbol)
+        if security_id:
+            logging.info(f"Найден Security ID для {symbol} в справочнике инструментов: {security_id}")
+            return str(security_id)
         
         logging.warning(f"Security ID для символа {symbol} не найден")
         return None
@@ -79,31 +177,37 @@ def update_security_ids():
     Обновляет Security ID для всех тикеров в конфигурационном файле.
     """
     try:
-        # Загружаем текущую конфигурацию
-        config = get_config()
-        if not config or 'tickers' not in config:
-            logging.error("Конфигурация не содержит список тикеров")
-            return False
+        # Индекс символ -> Security ID строится один раз на весь проход
+        from instrument_registry import get_registry
+        security_ids = get_registry().security_ids
         
-        # Обновляем Security ID для каждого тикера
-        updated_count = 0
-        for ticker in config['tickers']:
-            symbol = ticker.get('symbol')
-            if not symbol:
-                continue
-                
-            security_id = find_security_id(symbol)
-            if security_id:
-                old_id = ticker.get('security_id', 'None')
-                ticker['security_id'] = security_id
-                logging.info(f"Обновлен Security ID для {symbol}: {old_id} -> {security_id}")
-                updated_count += 1
+        result = {"updated": 0, "valid": True}
+        
+        def apply(config):
+            if not config or 'tickers' not in config:
+                result["valid"] = False
+                return False
+            
+            # Обновляем Security ID для каждого тикера
+            for ticker in config['tickers']:
+                symbol = ticker.get('symbol')
+                if not symbol:
+                    continue
+                    
+                security_id = security_ids.get(symbol)
+                if security_id:
+                    old_id = ticker.get('security_id', 'None')
+                    ticker['security_id'] = security_id
+                    logging.info(f"Обновлен Security ID для {symbol}: {old_id} -> {security_id}")
+                    result["updated"] += 1
         
         # Сохраняем обновленную конфигурацию
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(config, f, indent=2)
+        update_config_file(apply)
+        if not result["valid"]:
+            logging.error("Конфигурация не содержит список тикеров")
+            return False
         
-        logging.info(f"Обновлено {updated_count} Security ID в файле конфигурации")
+        logging.info(f"Обновлено {result['updated']} Security ID в файле конфигурации")
         return True
     except Exception as e:
         logging.error(f"Ошибка при обновлении Security ID: {e}")
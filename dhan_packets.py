@@ -0,0 +1,141 @@
+"""
+Разбор бинарных пакетов Dhan Market Feed v2.
+
+Каждый пакет начинается с 8-байтового заголовка:
+    байт 0     - код ответа (uint8)
+    байты 1-2  - длина сообщения (int16)
+    байт 3     - сегмент биржи (uint8)
+    байты 4-7  - security_id (int32)
+Все числа передаются в little-endian. Один WebSocket-фрейм может содержать
+несколько пакетов подряд, поэтому разбор идёт по длине из заголовка.
+"""
+import struct
+
+import numpy as np
+
+# Коды ответов фида
+TICKER_PACKET = 2
+QUOTE_PACKET = 4
+OI_PACKET = 5
+PREV_CLOSE_PACKET = 6
+MARKET_STATUS_PACKET = 7
+FULL_PACKET = 8
+DISCONNECT_PACKET = 50
+
+# Коды сегментов биржи в бинарном заголовке
+EXCHANGE_SEGMENTS = {
+    "IDX_I": 0,
+    "NSE_EQ": 1,
+    "NSE_FNO": 2,
+    "NSE_CURRENCY": 3,
+    "BSE_EQ": 4,
+    "MCX_COMM": 5,
+    "BSE_CURRENCY": 7,
+    "BSE_FNO": 8,
+}
+SEGMENT_NAMES = {code: name for name, code in EXCHANGE_SEGMENTS.items()}
+
+# Длины пакетов по коду ответа - на случай, если поле длины в заголовке пустое
+PACKET_SIZES = {
+    TICKER_PACKET: 16,
+    QUOTE_PACKET: 50,
+    OI_PACKET: 12,
+    PREV_CLOSE_PACKET: 16,
+    MARKET_STATUS_PACKET: 8,
+    FULL_PACKET: 162,
+    DISCONNECT_PACKET: 10,
+}
+
+HEADER = struct.Struct('<BhBi')
+# OI-пакет: int32 сразу после заголовка
+OI_VALUE = struct.Struct('<i')
+OI_OFFSET = HEADER.size
+# Full-пакет: OI находится в байтах 35-38 (нумерация с 1 в документации Dhan)
+FULL_OI_OFFSET = 34
+# Prev close: float32 цена закрытия + int32 OI предыдущего дня
+PREV_CLOSE = struct.Struct('<fi')
+
+# OI-пакет целиком - для сборки фреймов (симулятор фида, воспроизведение)
+OI_PACKET_DTYPE = np.dtype([
+    ('code', 'u1'),
+    ('length', '<i2'),
+    ('segment', 'u1'),
+    ('security_id', '<i4'),
+    ('oi', '<i4'),
+])
+
+
+def segment_code(segment):
+    """Возвращает числовой код сегмента по его имени (или None)"""
+    if isinstance(segment, int):
+        return segment
+    return EXCHANGE_SEGMENTS.get(segment)
+
+
+def parse_security_id(security_id):
+    """Приводит security_id из конфигурации к int (или None для нечисловых ID)"""
+    try:
+        return int(security_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def iter_packets(message):
+    """
+    Итерирует по пакетам во фрейме без копирования данных.
+
+    Yields:
+        tuple: (код ответа, код сегмента, security_id, memoryview пакета)
+    """
+    view = memoryview(message)
+    total = len(view)
+    offset = 0
+    unpack_header = HEADER.unpack_from
+    header_size = HEADER.size
+
+    while offset + header_size <= total:
+        code, length, segment, security_id = unpack_header(view, offset)
+        if length < header_size:
+            length = PACKET_SIZES.get(code, 0)
+        if length < header_size or offset + length > total:
+            # Неизвестный или обрезанный пакет - дальше разбирать нельзя
+            return
+        yield code, segment, security_id, view[offset:offset + length]
+        offset += length
+
+
+def encode_oi_packets(segments, security_ids, values):
+    """
+    Собирает фрейм из OI-пакетов в формате фида Dhan v2.
+
+    Args:
+        segments: коды сегментов (число или массив)
+        security_ids: security_id инструментов
+        values: значения OI
+
+    Returns:
+        bytes: фрейм из len(security_ids) пакетов подряд
+    """
+    security_ids = np.asarray(security_ids)
+    packets = np.empty(len(security_ids), dtype=OI_PACKET_DTYPE)
+    packets['code'] = OI_PACKET
+    packets['length'] = OI_PACKET_DTYPE.itemsize
+    packets['segment'] = segments
+    packets['security_id'] = security_ids
+    packets['oi'] = values
+    return packets.tobytes()
+
+
+def iter_oi(message):
+    """
+    Извлекает значения OI из фрейма.
+
+    Yields:
+        tuple: (код сегмента, security_id, oi)
+    """
+    unpack_oi = OI_VALUE.unpack_from
+    for code, segment, security_id, packet in iter_packets(message):
+        if code == OI_PACKET:
+            yield segment, security_id, unpack_oi(packet, OI_OFFSET)[0]
+        elif code == FULL_PACKET:
+            yield segment, security_id, unpack_oi(packet, FULL_OI_OFFSET)[0]
@@ -1,121 +1,219 @@
-import websocket
-import threading
-import json
-import struct
+import os
 import time
 import logging
-from oi_cache import set_oi
+import tick_journal
+from oi_cache import set_oi, restore
 from config import get_config
+from instrument_registry import get_registry
+from feed_manager import FeedManager
+from feed_supervisor import supervisor, snapshot_source
+from metrics import (FRAMES, TICKS, UNKNOWN_INSTRUMENTS, DECODE_ERRORS, FRAME_DECODE,
+                     TICK_TO_CACHE, log_every, register_feed_stats)
+from dhan_packets import (iter_packets, parse_security_id, OI_VALUE, OI_OFFSET, FULL_OI_OFFSET,
+                          OI_PACKET, FULL_PACKET, DISCONNECT_PACKET)
 
 # Настраиваем логирование
 logging.basicConfig(level=logging.INFO, 
                    format='%(asctime)s [%(levelname)s] %(message)s',
                    datefmt='%Y-%m-%d %H:%M:%S')
 
-# Загружаем конфигурацию
-try:
-    config = get_config()
-except Exception as e:
-    logging.critical(f"Не удалось загрузить конфигурацию: {e}")
-    config = {"tickers": []}
+# Конфигурация читается при первом обращении (load_config), а не при импорте
+config = None
 
-# Глобальная переменная для хранения экземпляра WebSocket
-ws_instance = None
-reconnect_attempt = 0
-MAX_RECONNECT_ATTEMPTS = 10
-reconnect_delay = 5  # начальная задержка в секундах
+# Адрес фида Dhan v2 (DHAN_FEED_URL позволяет подключиться к локальному симулятору)
+FEED_URL = "wss://api-feed.dhan.co"
 
-def on_message(ws, message):
-    global reconnect_attempt
-    reconnect_attempt = 0  # Сбрасываем счетчик при успешном получении сообщения
-    
-    if len(config["tickers"]) == 0:
-        logging.warning("Список тикеров пуст, нет данных для обработки")
-        return
-    
-    for ticker in config["tickers"]:
-        symbol = ticker["symbol"]
-        try:
-            # Проверка длины сообщения
-            if len(message) < 39:
-                logging.warning(f"Полученное сообщение слишком короткое: {len(message)} байт")
-                continue
-                
-            oi_bytes = message[35:39]
-            oi = struct.unpack('>I', oi_bytes)[0]
-            set_oi(symbol, oi)
-            logging.info(f"Обновлен OI для {symbol}: {oi}")
-        except Exception as e:
-            logging.error(f"Ошибка при парсинге OI для {symbol}: {e}")
+# Менеджер соединений фида (один или несколько шардов)
+feed_manager = None
+# Журнал тиков воспроизводится один раз за жизнь процесса
+journal_replayed = False
+# Потребители тиков по инструментам вне реестра (например, опционные цепочки
+# из option_chain.py): объекты с методами lookup((сегмент, security_id)) ->
+# ключ или None, on_ticks([(ключ, OI), ...]) и tickers() - их подписки
+taps = []
 
-def on_error(ws, error):
-    logging.error(f"WebSocket ошибка: {error}")
+def add_tap(tap):
+    """Регистрирует потребителя тиков по инструментам вне реестра"""
+    taps.append(tap)
 
-def on_close(ws, close_status_code, close_msg):
-    global reconnect_attempt, reconnect_delay
-    
-    logging.warning(f"WebSocket закрыт: {close_status_code} - {close_msg}")
-    
-    # Увеличиваем счетчик попыток и задержку между попытками (экспоненциальный backoff)
-    reconnect_attempt += 1
-    current_delay = min(reconnect_delay * (2 ** (reconnect_attempt - 1)), 300)  # максимум 5 минут
+def process_frame(message):
+    """
+    Разбирает бинарный фрейм и записывает OI в кэш.
     
-    if reconnect_attempt <= MAX_RECONNECT_ATTEMPTS:
-        logging.info(f"Попытка переподключения {reconnect_attempt}/{MAX_RECONNECT_ATTEMPTS} через {current_delay} секунд...")
-        time.sleep(current_delay)
-        start_ws()
-    else:
-        logging.critical(f"Достигнуто максимальное количество попыток подключения ({MAX_RECONNECT_ATTEMPTS}). Прекращаем попытки.")
-
-def on_open(ws):
-    global reconnect_attempt, config
-    reconnect_attempt = 0  # Сбрасываем счетчик при успешном подключении
+    Returns:
+        int: количество обработанных значений OI
+    """
+    if isinstance(message, str):
+        logging.debug(f"Получено текстовое сообщение: {message}")
+        return 0
     
-    # Перезагружаем конфигурацию для получения актуальных данных
+    received = time.perf_counter()
+    registry = get_registry()
+    registry.maybe_reload()
+    lookup = registry.by_instrument.get
+    unpack_oi = OI_VALUE.unpack_from
+    FRAMES.inc()
+    # Сначала разбираем весь фрейм, затем пишем тики в кэш - так время
+    # разбора и задержка до кэша измеряются раздельно
+    updates = []
+    tapped = []
     try:
-        config = get_config()
+        for code, segment, security_id, packet in iter_packets(message):
+            if code == OI_PACKET:
+                oi = unpack_oi(packet, OI_OFFSET)[0]
+            elif code == FULL_PACKET:
+                oi = unpack_oi(packet, FULL_OI_OFFSET)[0]
+            elif code == DISCONNECT_PACKET:
+                logging.warning(f"Сервер Dhan сообщил об отключении: {bytes(packet[8:10]).hex()}")
+                continue
+            else:
+                continue
+            
+            symbol = lookup((segment, security_id))
+            if symbol is None:
+                for tap in taps:
+                    key = tap.lookup((segment, security_id))
+                    if key is not None:
+                        tapped.append((tap, key, oi))
+                        break
+                else:
+                    UNKNOWN_INSTRUMENTS.inc()
+                continue
+            updates.append((symbol, segment, security_id, oi))
     except Exception as e:
-        logging.error(f"Ошибка при перезагрузке конфигурации: {e}")
+        DECODE_ERRORS.inc()
+        log_every("decode_error", f"Ошибка при разборе сообщения WebSocket: {e}", level=logging.ERROR)
+    decoded = time.perf_counter()
+    
+    journal = tick_journal.get_journal()
+    received_ns = time.time_ns()
+    for symbol, segment, security_id, oi in updates:
+        set_oi(symbol, oi)
+        if journal is not None:
+            journal.append(received_ns, segment, security_id, oi)
     
-    logging.info("WebSocket соединение установлено, подписываемся на данные...")
+    if tapped:
+        for tap in taps:
+            ticks = [(key, oi) for owner, key, oi in tapped if owner is tap]
+            if ticks:
+                try:
+                    tap.on_ticks(ticks)
+                except Exception as e:
+                    log_every(("tap_error", id(tap)), f"Ошибка в обработчике тиков {tap}: {e}",
+                              level=logging.ERROR)
     
-    if len(config["tickers"]) == 0:
+    FRAME_DECODE.observe(decoded - received)
+    if updates:
+        TICKS.inc(amount=len(updates))
+        TICK_TO_CACHE.observe(time.perf_counter() - received)
+    return len(updates)
+
+def on_message(ws, message):
+    process_frame(message)
+
+def is_subscribable(ticker):
+    """Можно ли подписаться на тикер: нужен сегмент и числовой security_id"""
+    return bool(ticker.get("exchange_segment")) and parse_security_id(ticker.get("security_id")) is not None
+
+def get_valid_tickers():
+    """Возвращает тикеры из конфигурации, на которые можно подписаться"""
+    tickers = load_config().get("tickers", ())
+    if len(tickers) == 0:
         logging.warning("Список тикеров пуст, невозможно подписаться на данные")
-        return
+        return []
         
     # Проверяем наличие security_id для всех тикеров
     valid_tickers = []
-    for ticker in config["tickers"]:
-        if ticker.get("security_id") is not None:
+    skipped = []
+    for ticker in tickers:
+        if is_subscribable(ticker):
             valid_tickers.append(ticker)
         else:
-            logging.warning(f"Тикер {ticker.get('symbol')} не имеет security_id, пропускаем")
+            skipped.append(ticker.get("symbol"))
     
+    if skipped:
+        logging.warning(f"Тикеры без числового security_id пропущены ({len(skipped)}): "
+                        f"{', '.join(map(str, skipped[:10]))}{' ...' if len(skipped) > 10 else ''}")
     if len(valid_tickers) == 0:
         logging.warning("Нет валидных тикеров с security_id, невозможно подписаться на данные")
-        return
-        
+    return valid_tickers
+
+def feed_tickers():
+    """Все подписки фида: тикеры из конфигурации и инструменты потребителей"""
+    tickers = get_valid_tickers()
+    for tap in taps:
+        tickers.extend(ticker for ticker in tap.tickers() if is_subscribable(ticker))
+    return tickers
+
+def load_config():
+    """Возвращает конфигурацию фида, загружая её при первом обращении"""
+    global config
+    if config is None:
+        try:
+            config = get_config()
+        except Exception as e:
+            logging.critical(f"Не удалось загрузить конфигурацию: {e}")
+            config = {"tickers": []}
+    return config
+
+def feed_url(config):
+    """URL фида Dhan v2 или None, если не хватает параметров аутентификации"""
+    if not config.get("token") or not config.get("client_id") or not config.get("auth_type"):
+        logging.critical("Отсутствуют обязательные параметры аутентификации (token, client_id, auth_type)")
+        return None
+    base = os.environ.get("DHAN_FEED_URL", FEED_URL)
+    return f"{base}?version=2&token={config['token']}&clientId={config['client_id']}&authType={config['auth_type']}"
+
+def get_feed_stats():
+    """Возвращает статистику по шардам фида"""
+    if feed_manager is None:
+        return []
+    return feed_manager.stats()
+
+register_feed_stats(get_feed_stats)
+
+def subscribe(tickers):
+    """
+    Подписывается на тикеры по открытым соединениям без перезапуска фида.
+    Подписка запоминается и повторяется при переподключении.
+    
+    Returns:
+        bool: True, если запрос на подписку принят
+    """
+    tickers = [ticker for ticker in tickers if is_subscribable(ticker)]
+    if not tickers:
+        return False
+    if feed_manager is None:
+        logging.warning("Фид не запущен, подписка будет выполнена при старте WebSocket")
+        return False
+    feed_manager.subscribe(tickers)
+    return True
+
+def unsubscribe(tickers):
+    """Отписывается от тикеров без перезапуска фида"""
+    if feed_manager is None:
+        return 0
+    return feed_manager.unsubscribe(tickers)
+
+def replay_journal():
+    """Восстанавливает кэш OI и историю из журнала тиков за текущий день"""
+    global journal_replayed
+    if journal_replayed or not tick_journal.JOURNAL_ENABLED:
+        return 0
+    journal_replayed = True
     try:
-        sub_msg = {
-            "RequestCode": 15,
-            "InstrumentCount": len(valid_tickers),
-            "InstrumentList": [
-                {
-                    "ExchangeSegment": ticker["exchange_segment"],
-                    "SecurityId": ticker["security_id"]
-                } for ticker in valid_tickers
-            ]
-        }
-        ws.send(json.dumps(sub_msg))
-        logging.info(f"Отправлен запрос на подписку для {len(valid_tickers)} тикеров")
+        registry = get_registry()
+        return tick_journal.replay(registry.by_instrument.get,
+                                   lambda symbol, ts, oi: restore(symbol, ts / 1e9, oi))
     except Exception as e:
-        logging.error(f"Ошибка при отправке запроса на подписку: {e}")
+        logging.error(f"Ошибка при воспроизведении журнала тиков: {e}")
+        return 0
 
 def restart_ws():
     """
-    Перезапускает WebSocket соединение для применения изменений в конфигурации
+    Перезапускает WebSocket соединения для применения изменений в конфигурации
     """
-    global ws_instance, config
+    global config
     
     logging.info("Перезапуск WebSocket соединения...")
     
@@ -125,48 +223,37 @@ def restart_ws():
     except Exception as e:
         logging.error(f"Ошибка при перезагрузке конфигурации: {e}")
     
-    # Закрываем текущее соединение, если оно есть
-    if ws_instance:
-        try:
-            ws_instance.close()
-            logging.info("Закрыто предыдущее WebSocket соединение")
-        except Exception as e:
-            logging.warning(f"Ошибка при закрытии предыдущего соединения: {e}")
-    
-    # Запускаем новое соединение
+    # Запускаем новое соединение (start_ws закрывает текущее)
     return start_ws()
 
 def start_ws():
-    global ws_instance
+    global feed_manager
     
     try:
-        if not config.get("token") or not config.get("client_id") or not config.get("auth_type"):
-            logging.critical("Отсутствуют обязательные параметры аутентификации (token, client_id, auth_type)")
+        url = feed_url(load_config())
+        if url is None:
             return None
-            
-        url = f"wss://api-feed.dhan.co?version=2&token={config['token']}&clientId={config['client_id']}&authType={config['auth_type']}"
         
-        # Закрываем предыдущее соединение, если оно существует
-        if ws_instance:
+        # Закрываем предыдущие соединения, если они существуют
+        if feed_manager:
             try:
-                ws_instance.close()
+                feed_manager.stop()
                 logging.info("Закрыто предыдущее WebSocket соединение")
-            except:
-                pass
+            except Exception as e:
+                logging.warning(f"Ошибка при закрытии предыдущего соединения: {e}")
         
-        ws = websocket.WebSocketApp(url, 
-                                   on_open=on_open, 
-                                   on_message=on_message,
-                                   on_error=on_error,
-                                   on_close=on_close)
+        # Тёплый старт: история за день доступна до первых тиков
+        replay_journal()
         
-        wst = threading.Thread(target=ws.run_forever)
-        wst.daemon = True
-        wst.start()
+        # Источник снимков OI для восполнения пропусков после переподключения
+        supervisor.source = snapshot_source(config)
+        manager = FeedManager(url, process_frame)
+        manager.add_instruments(feed_tickers())
+        manager.start()
         
-        ws_instance = ws
-        logging.info("WebSocket соединение запущено в отдельном потоке")
-        return ws
+        feed_manager = manager
+        logging.info(f"WebSocket соединения запущены: {len(manager.shards)} шардов")
+        return manager
     except Exception as e:
         logging.critical(f"Критическая ошибка при запуске WebSocket: {e}")
         return None
@@ -0,0 +1,377 @@
+"""
+Менеджер фида Dhan: распределяет инструменты по нескольким
+WebSocket-соединениям (шардам).
+
+Dhan ограничивает число инструментов в одном сообщении подписки и на одно
+соединение, поэтому большой список инструментов делится между шардами,
+а подписка отправляется пачками. Все шарды передают фреймы в один
+обработчик, который пишет в общий oi_cache.
+"""
+import json
+import threading
+import time
+import logging
+
+import websocket
+
+from metrics import RECONNECTS
+from feed_supervisor import Backoff, supervisor
+
+logger = logging.getLogger(__name__)
+
+# Ограничения Dhan Market Feed v2
+MAX_INSTRUMENTS_PER_MESSAGE = 100
+MAX_INSTRUMENTS_PER_CONNECTION = 5000
+MAX_CONNECTIONS = 5
+
+# RequestCode 17 (Quote): для F&O фид присылает отдельные OI-пакеты.
+# На подписку Ticker (15) данные об OI не приходят вовсе.
+SUBSCRIBE_REQUEST_CODE = 17
+UNSUBSCRIBE_REQUEST_CODE = 18
+
+# Окно, в течение которого запросы на подписку объединяются в одно сообщение
+SUBSCRIBE_COALESCE_WINDOW = 0.05
+
+
+def instrument_key(instrument):
+    """Ключ инструмента: (сегмент биржи, security_id в виде строки)"""
+    return (instrument["exchange_segment"], str(instrument["security_id"]))
+
+
+def build_subscription_messages(keys, request_code=SUBSCRIBE_REQUEST_CODE):
+    """
+    Формирует JSON-сообщения подписки, не более
+    MAX_INSTRUMENTS_PER_MESSAGE инструментов в каждом.
+    """
+    keys = list(keys)
+    messages = []
+    for start in range(0, len(keys), MAX_INSTRUMENTS_PER_MESSAGE):
+        batch = keys[start:start + MAX_INSTRUMENTS_PER_MESSAGE]
+        messages.append(json.dumps({
+            "RequestCode": request_code,
+            "InstrumentCount": len(batch),
+            "InstrumentList": [
+                {"ExchangeSegment": segment, "SecurityId": security_id}
+                for segment, security_id in batch
+            ]
+        }))
+    return messages
+
+
+class FeedShard:
+    """Одно WebSocket-соединение со своим потоком и набором инструментов"""
+
+    def __init__(self, shard_id, url, on_frame):
+        self.shard_id = shard_id
+        self.url = url
+        self.on_frame = on_frame
+        self.instruments = {}  # ключ инструмента -> описание тикера
+        self.connected = False
+        # Подписка подтверждена: после её отправки пришёл хотя бы один фрейм
+        self.acknowledged = False
+        self.frames = 0
+        self.ticks = 0
+        self.backoff = Backoff()
+        self._ws = None
+        self._thread = None
+        self._running = False
+        self._lock = threading.Lock()
+        self._rate_sample = (time.monotonic(), 0)
+        self.tick_rate = 0.0
+
+    def __len__(self):
+        return len(self.instruments)
+
+    @property
+    def reconnect_attempt(self):
+        return self.backoff.attempt
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=f"dhan-feed-{self.shard_id}")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        ws = self._ws
+        if ws:
+            try:
+                ws.close()
+            except Exception as e:
+                logger.warning(f"Шард {self.shard_id}: ошибка при закрытии соединения: {e}")
+
+    def _run(self):
+        while self._running:
+            self._ws = websocket.WebSocketApp(self.url,
+                                              on_open=self._on_open,
+                                              on_message=self._on_message,
+                                              on_error=self._on_error,
+                                              on_close=self._on_close,
+                                              on_ping=self._on_ping)
+            try:
+                self._ws.run_forever()
+            except Exception as e:
+                logger.error(f"Шард {self.shard_id}: WebSocket ошибка: {e}")
+            self.connected = False
+            self.acknowledged = False
+            if not self._running:
+                break
+
+            # Переподключение с разбросом задержки и без предела попыток
+            supervisor.connection_lost(self.shard_id)
+            RECONNECTS.inc(str(self.shard_id))
+            delay = self.backoff.next_delay()
+            logger.info(f"Шард {self.shard_id}: попытка переподключения "
+                        f"{self.backoff.attempt} через {delay:.1f} секунд...")
+            time.sleep(delay)
+
+    def _send(self, keys, request_code):
+        ws = self._ws
+        if not keys or not self.connected or ws is None:
+            return
+        for message in build_subscription_messages(keys, request_code):
+            ws.send(message)
+
+    def _on_open(self, ws):
+        # Повторяем всю желаемую подписку шарда - после переподключения тоже
+        self.connected = True
+        self.backoff.connected()
+        with self._lock:
+            keys = list(self.instruments)
+            instruments = list(self.instruments.values())
+        try:
+            self._send(keys, SUBSCRIBE_REQUEST_CODE)
+            logger.info(f"Шард {self.shard_id}: отправлен запрос на подписку для {len(keys)} инструментов")
+        except Exception as e:
+            logger.error(f"Шард {self.shard_id}: ошибка при отправке запроса на подписку: {e}")
+        # После обрыва - восполнение инструментов, по которым так и не придут тики
+        restored = supervisor.connection_restored(self.shard_id)
+        if restored is not None:
+            supervisor.schedule_backfill(self.shard_id, instruments, restored)
+
+    def _on_message(self, ws, message):
+        self.acknowledged = True
+        self.frames += 1
+        # Снимок старше тиков фрейма - применяется до них
+        supervisor.drain_backfill(self.shard_id)
+        self.ticks += self.on_frame(message)
+
+    def _on_ping(self, ws, data):
+        # Сервер пингует соединение и без тиков - снимок не залёживается
+        supervisor.drain_backfill(self.shard_id)
+
+    def _on_error(self, ws, error):
+        logger.error(f"Шард {self.shard_id}: WebSocket ошибка: {error}")
+
+    def _on_close(self, ws, close_status_code, close_msg):
+        self.connected = False
+        logger.warning(f"Шард {self.shard_id}: WebSocket закрыт: {close_status_code} - {close_msg}")
+
+    def add(self, instruments):
+        """Добавляет инструменты и подписывается на них, если соединение открыто"""
+        with self._lock:
+            new_keys = []
+            for instrument in instruments:
+                key = instrument_key(instrument)
+                if key not in self.instruments:
+                    self.instruments[key] = instrument
+                    new_keys.append(key)
+        try:
+            self._send(new_keys, SUBSCRIBE_REQUEST_CODE)
+        except Exception as e:
+            logger.error(f"Шард {self.shard_id}: ошибка при подписке на новые инструменты: {e}")
+        return new_keys
+
+    def remove(self, keys):
+        """Убирает инструменты из шарда и отписывается от них"""
+        removed = []
+        with self._lock:
+            for key in keys:
+                instrument = self.instruments.pop(key, None)
+                if instrument is not None:
+                    removed.append(instrument)
+        try:
+            self._send([instrument_key(i) for i in removed], UNSUBSCRIBE_REQUEST_CODE)
+        except Exception as e:
+            logger.error(f"Шард {self.shard_id}: ошибка при отписке от инструментов: {e}")
+        return removed
+
+    def stats(self):
+        now = time.monotonic()
+        started, ticks = self._rate_sample
+        elapsed = now - started
+        if elapsed >= 1.0:
+            self.tick_rate = (self.ticks - ticks) / elapsed
+            self._rate_sample = (now, self.ticks)
+        return {
+            "shard": self.shard_id,
+            "connected": self.connected,
+            # Соединению без инструментов подтверждать нечего
+            "acknowledged": self.acknowledged or not self.instruments,
+            "instruments": len(self.instruments),
+            "frames": self.frames,
+            "ticks": self.ticks,
+            "tick_rate": round(self.tick_rate, 2),
+            "reconnect_attempt": self.reconnect_attempt
+        }
+
+
+class FeedManager:
+    """Распределяет инструменты между шардами и управляет их жизненным циклом"""
+
+    def __init__(self, url, on_frame,
+                 max_per_connection=MAX_INSTRUMENTS_PER_CONNECTION,
+                 max_connections=MAX_CONNECTIONS):
+        self.url = url
+        self.on_frame = on_frame
+        self.max_per_connection = max_per_connection
+        self.max_connections = max_connections
+        self.shards = []
+        self._started = False
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._flush_timer = None
+
+    def _new_shard(self):
+        shard = FeedShard(len(self.shards), self.url, self.on_frame)
+        self.shards.append(shard)
+        if self._started:
+            shard.start()
+        return shard
+
+    def _shard_for(self, key):
+        for shard in self.shards:
+            if key in shard.instruments:
+                return shard
+        return None
+
+    def add_instruments(self, instruments):
+        """
+        Добавляет инструменты в наименее загруженные шарды, открывая новые
+        соединения по мере необходимости. До старта фида нагрузка затем
+        выравнивается; после старта инструменты не переносятся: перенос
+        отписал бы их на старом соединении раньше, чем новое подпишется.
+
+        Returns:
+            int: количество добавленных инструментов
+        """
+        with self._lock:
+            placement = {}
+            placed = set()
+            for instrument in instruments:
+                key = instrument_key(instrument)
+                if key in placed or self._shard_for(key) is not None:
+                    continue
+                candidates = [s for s in self.shards
+                              if len(s) + len(placement.get(s.shard_id, ())) < self.max_per_connection]
+                if candidates:
+                    shard = min(candidates, key=lambda s: len(s) + len(placement.get(s.shard_id, ())))
+                elif len(self.shards) < self.max_connections:
+                    shard = self._new_shard()
+                else:
+                    logger.error(f"Достигнут лимит инструментов ({self.max_connections} соединений по "
+                                 f"{self.max_per_connection}), {instrument.get('symbol')} не подписан")
+                    continue
+                placement.setdefault(shard.shard_id, []).append(instrument)
+                placed.add(key)
+
+            added = 0
+            for shard_id, batch in placement.items():
+                added += len(self.shards[shard_id].add(batch))
+            if not self._started:
+                self._rebalance()
+            return added
+
+    def subscribe(self, instruments):
+        """
+        Добавляет инструменты к подписке без переподключения.
+
+        Запросы, пришедшие в течение SUBSCRIBE_COALESCE_WINDOW, объединяются
+        и отправляются одной пачкой по уже открытым соединениям.
+        """
+        with self._pending_lock:
+            for instrument in instruments:
+                self._pending[instrument_key(instrument)] = instrument
+            if self._flush_timer is None and self._pending:
+                self._flush_timer = threading.Timer(SUBSCRIBE_COALESCE_WINDOW, self.flush_pending)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush_pending(self):
+        """Отправляет накопленные запросы на подписку"""
+        with self._pending_lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        if pending:
+            added = self.add_instruments(pending)
+            logger.info(f"Подписка расширена на {added} инструментов")
+        return pending
+
+    def unsubscribe(self, instruments):
+        """
+        Отписывается от инструментов по открытым соединениям и убирает их
+        из желаемой подписки, чтобы они не вернулись при переподключении.
+
+        Returns:
+            int: количество инструментов, от которых удалось отписаться
+        """
+        keys = {instrument_key(instrument) for instrument in instruments}
+        with self._pending_lock:
+            for key in keys:
+                self._pending.pop(key, None)
+        removed = 0
+        with self._lock:
+            for shard in self.shards:
+                owned = [key for key in keys if key in shard.instruments]
+                if owned:
+                    removed += len(shard.remove(owned))
+        return removed
+
+    def _rebalance(self):
+        """
+        Переносит инструменты из перегруженных шардов в недогруженные, если
+        разница превышает размер одной пачки подписки. Только до старта
+        фида: соединения ещё не открыты, и переносимые инструменты не
+        теряют тиков.
+        """
+        if len(self.shards) < 2:
+            return
+        while True:
+            heavy = max(self.shards, key=len)
+            light = min(self.shards, key=len)
+            excess = (len(heavy) - len(light)) // 2
+            if excess <= MAX_INSTRUMENTS_PER_MESSAGE:
+                return
+            keys = list(heavy.instruments)[-excess:]
+            moved = heavy.remove(keys)
+            light.add(moved)
+            logger.info(f"Перебалансировка: {len(moved)} инструментов перенесено "
+                        f"из шарда {heavy.shard_id} в шард {light.shard_id}")
+
+    def instrument_count(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def start(self):
+        with self._lock:
+            self._started = True
+            for shard in self.shards:
+                shard.start()
+        logger.info(f"Фид запущен: {len(self.shards)} соединений, {self.instrument_count()} инструментов")
+
+    def stop(self):
+        with self._pending_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        with self._lock:
+            self._started = False
+            for shard in self.shards:
+                shard.stop()
+
+    def stats(self):
+        return [shard.stats() for shard in self.shards]
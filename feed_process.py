@@ -0,0 +1,105 @@
+"""
+Отдельный процесс фида Dhan.
+
+Держит единственное подключение к Dhan и пишет OI в хранилище в разделяемой
+памяти (oi_shm). Воркеры gunicorn запускаются в режиме "reader" и читают
+данные через обычные get_oi / get_oi_age, не открывая своих соединений.
+Опционные цепочки из OI_CHAIN_SYMBOLS тоже ведёт этот процесс: их массивы
+лежат в файлах рядом с хранилищем (option_chain.chain_dir()).
+
+Запуск: python feed_process.py (или автоматически из gunicorn.conf.py)
+"""
+import os
+import threading
+import time
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+import oi_cache
+from oi_shm import HEARTBEAT_INTERVAL
+
+# Как часто сверять подписку с config.json (новые тикеры добавляют воркеры)
+SYNC_INTERVAL = 5
+# Порт /metrics процесса фида (метрики разбора фреймов есть только здесь)
+METRICS_PORT = int(os.environ.get("OI_FEED_METRICS_PORT", 0))
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s [%(levelname)s] %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+
+def sync_subscriptions(dhan_ws, registry):
+    """Подписывается на тикеры, появившиеся в конфигурации после старта"""
+    manager = dhan_ws.feed_manager
+    if manager is None:
+        return 0
+    subscribed = set()
+    for shard in manager.shards:
+        subscribed.update(shard.instruments)
+    new_tickers = [ticker for ticker in registry.instruments()
+                   if dhan_ws.is_subscribable(ticker)
+                   and (ticker["exchange_segment"], str(ticker["security_id"])) not in subscribed]
+    if new_tickers:
+        dhan_ws.subscribe(new_tickers)
+        logging.info(f"Добавлена подписка на {len(new_tickers)} новых тикеров из конфигурации")
+    return len(new_tickers)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", metrics.CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port):
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="feed-metrics")
+    thread.daemon = True
+    thread.start()
+    logging.info(f"Метрики процесса фида доступны на порту {port}")
+    return server
+
+
+def run():
+    oi_cache.configure("writer")
+
+    import dhan_ws
+    import option_chain
+    import scrip_master
+    from instrument_registry import get_registry
+
+    if METRICS_PORT:
+        serve_metrics(METRICS_PORT)
+    oi_cache.heartbeat()
+    dhan_ws.start_ws()
+    if option_chain.CHAIN_SYMBOLS:
+        scrip_master.start()
+        option_chain.engine.start()
+    registry = get_registry()
+    synced_at = time.monotonic()
+    while True:
+        # Воркеры считают процесс фида потерянным, если отметки прекратились
+        time.sleep(HEARTBEAT_INTERVAL)
+        oi_cache.heartbeat()
+        if time.monotonic() - synced_at < SYNC_INTERVAL:
+            continue
+        synced_at = time.monotonic()
+        try:
+            sync_subscriptions(dhan_ws, registry)
+        except Exception as e:
+            logging.error(f"Ошибка при синхронизации подписки: {e}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,264 @@
+"""
+Надзор за соединениями фида Dhan: переподключение и восполнение пропусков.
+
+Каждое соединение (шард потокового FeedManager или задача AsyncFeed) само
+держит свой цикл подключения, а этот модуль решает, сколько ждать перед
+следующей попыткой и что делать после восстановления связи:
+
+    - Backoff: экспоненциальная задержка со случайным разбросом (шарды не
+      переподключаются синхронно), без предельного числа попыток. Счётчик
+      сбрасывается, только если соединение продержалось STABLE_CONNECTION
+      секунд, поэтому "подключился и сразу отвалился" не долбит сервер.
+    - FeedSupervisor: запоминает момент обрыва каждого шарда и после
+      переподключения ищет пропуски - инструменты, по которым с момента
+      восстановления так и не пришло тиков (время последнего тика по символу
+      ведёт oi_cache). Их OI запрашивается у источника снимков и пишется в
+      кэш, если живой тик не успел прийти раньше.
+
+Писатель записи OI по символу один - поток его шарда (seqlock в oi_cache и
+oi_shm рассчитан на это). Поэтому снимок, полученный в отдельном потоке,
+не пишется в кэш сразу: он откладывается до шарда (drain_backfill), и
+проверка "живой тик уже пришёл" выполняется тем же потоком, что пишет тики.
+
+Источник снимков подключаемый: объект с методом fetch(инструменты) ->
+{символ: OI}. По умолчанию это REST marketfeed/quote Dhan (DhanQuoteSource,
+адрес переопределяется DHAN_QUOTE_URL), для проверок и симулятора -
+StaticSnapshotSource.
+"""
+import json
+import os
+import random
+import threading
+import time
+import logging
+import urllib.request
+
+import oi_cache
+from instrument_registry import get_registry
+from metrics import Counter, Histogram, log_every
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_DELAY = float(os.environ.get("OI_RECONNECT_DELAY", 1.0))  # начальная задержка, секунды
+MAX_RECONNECT_DELAY = float(os.environ.get("OI_MAX_RECONNECT_DELAY", 30.0))
+# Сколько секунд соединение должно прожить, чтобы backoff начался заново
+STABLE_CONNECTION = 10.0
+# Пауза после переподключения перед поиском пропусков: первые тики
+# приходят сразу после подписки, восполнять нужно только оставшиеся
+BACKFILL_DELAY = float(os.environ.get("OI_BACKFILL_DELAY", 2.0))
+# "dhan" - REST marketfeed/quote, "off" - без восполнения
+BACKFILL_SOURCE = os.environ.get("OI_BACKFILL", "dhan")
+
+QUOTE_URL = os.environ.get("DHAN_QUOTE_URL", "https://api.dhan.co/v2/marketfeed/quote")
+# Ограничения REST marketfeed: инструментов в запросе и запросов в секунду
+QUOTE_BATCH = 1000
+QUOTE_INTERVAL = 1.0
+QUOTE_TIMEOUT = 5.0
+
+OUTAGES = Histogram("dhan_feed_outage_seconds", "Time from a feed disconnect until the connection is restored",
+                    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0))
+GAPS = Counter("dhan_feed_gap_instruments_total", "Instruments without ticks after a reconnect")
+BACKFILLED = Counter("dhan_feed_backfilled_total", "OI values restored from the snapshot source after a reconnect")
+
+
+class Backoff:
+    """Экспоненциальная задержка переподключения с разбросом, без лимита попыток"""
+
+    def __init__(self, base=RECONNECT_DELAY, cap=MAX_RECONNECT_DELAY, stable=STABLE_CONNECTION,
+                 rng=random.random):
+        self.base = base
+        self.cap = cap
+        self.stable = stable
+        self.rng = rng
+        self.attempt = 0
+        self.connected_at = None
+
+    def connected(self):
+        self.connected_at = time.monotonic()
+
+    def next_delay(self):
+        """Задержка перед следующей попыткой; увеличивает счётчик попыток"""
+        if self.connected_at is not None and time.monotonic() - self.connected_at >= self.stable:
+            self.attempt = 0
+        self.connected_at = None
+        self.attempt += 1
+        ceiling = min(self.cap, self.base * 2 ** min(self.attempt - 1, 32))
+        # Половина задержки гарантирована, вторая половина - случайная
+        return ceiling / 2 + self.rng() * ceiling / 2
+
+
+class StaticSnapshotSource:
+    """Источник снимков из словаря или функции символ -> OI (заглушка для проверок)"""
+
+    def __init__(self, values):
+        self.values = values
+
+    def fetch(self, instruments):
+        get = self.values if callable(self.values) else self.values.get
+        result = {}
+        for instrument in instruments:
+            value = get(instrument["symbol"])
+            if value is not None:
+                result[instrument["symbol"]] = value
+        return result
+
+
+class DhanQuoteSource:
+    """Снимок OI через REST marketfeed/quote Dhan"""
+
+    def __init__(self, token, client_id, url=QUOTE_URL, timeout=QUOTE_TIMEOUT):
+        self.token = token
+        self.client_id = client_id
+        self.url = url
+        self.timeout = timeout
+
+    def _request(self, body):
+        request = urllib.request.Request(self.url, data=json.dumps(body).encode("utf-8"), method="POST", headers={
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "access-token": self.token,
+            "client-id": str(self.client_id),
+        })
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def fetch(self, instruments):
+        instruments = list(instruments)
+        result = {}
+        for start in range(0, len(instruments), QUOTE_BATCH):
+            if start:
+                time.sleep(QUOTE_INTERVAL)
+            batch = instruments[start:start + QUOTE_BATCH]
+            body = {}
+            symbols = {}
+            for instrument in batch:
+                segment, security_id = instrument["exchange_segment"], str(instrument["security_id"])
+                body.setdefault(segment, []).append(int(security_id))
+                symbols[(segment, security_id)] = instrument["symbol"]
+            data = self._request(body).get("data", {})
+            for segment, quotes in data.items():
+                for security_id, quote in quotes.items():
+                    symbol = symbols.get((segment, str(security_id)))
+                    if symbol is not None and quote.get("oi") is not None:
+                        result[symbol] = int(quote["oi"])
+        return result
+
+
+def snapshot_source(config):
+    """Источник снимков по настройкам (None - восполнение отключено)"""
+    if BACKFILL_SOURCE == "off" or not config.get("token") or not config.get("client_id"):
+        return None
+    return DhanQuoteSource(config["token"], config["client_id"])
+
+
+class FeedSupervisor:
+    """Обрывы соединений фида, поиск пропусков и восполнение из снимков"""
+
+    def __init__(self, source=None, delay=BACKFILL_DELAY):
+        self.source = source
+        self.delay = delay
+        self.disconnected_at = {}  # шард -> монотонное время обрыва
+        self.pending = {}  # шард -> (символ -> OI, время восстановления) для потока шарда
+        self._lock = threading.Lock()
+
+    def connection_lost(self, shard_id):
+        with self._lock:
+            self.disconnected_at.setdefault(shard_id, oi_cache.monotonic_time())
+
+    def connection_restored(self, shard_id):
+        """
+        Отмечает восстановление связи.
+
+        Returns:
+            float: монотонное время восстановления, если перед ним был обрыв, иначе None
+        """
+        now = oi_cache.monotonic_time()
+        with self._lock:
+            lost = self.disconnected_at.pop(shard_id, None)
+        if lost is None:
+            return None
+        OUTAGES.observe(now - lost)
+        logger.info(f"Шард {shard_id}: соединение восстановлено после {now - lost:.1f} с без данных")
+        return now
+
+    def find_gaps(self, instruments, since):
+        """Инструменты реестра, по которым с момента since не было тиков"""
+        known = get_registry().by_symbol
+        now = oi_cache.monotonic_time()
+        gaps = []
+        for instrument in instruments:
+            symbol = instrument.get("symbol")
+            if symbol not in known:
+                continue
+            state = oi_cache.get_state(symbol, count=False)
+            if state is None or now - state[2] < since:
+                gaps.append(instrument)
+        return gaps
+
+    def fetch_backfill(self, shard_id, instruments, since):
+        """Ищет пропуски и запрашивает их у источника снимков (блокирующий вызов)"""
+        gaps = self.find_gaps(instruments, since)
+        if not gaps:
+            return {}
+        GAPS.inc(amount=len(gaps))
+        listed = ", ".join(instrument["symbol"] for instrument in gaps[:10])
+        logger.warning(f"Шард {shard_id}: нет тиков после переподключения ({len(gaps)}): "
+                       f"{listed}{' ...' if len(gaps) > 10 else ''}")
+        if self.source is None:
+            return {}
+        try:
+            return self.source.fetch(gaps)
+        except Exception as e:
+            log_every(("backfill_error",), f"Не удалось получить снимок OI для восполнения: {e}",
+                      level=logging.ERROR, logger=logger)
+            return {}
+
+    def apply_backfill(self, shard_id, values, since):
+        """
+        Пишет значения снимка в кэш, если живой тик не пришёл раньше.
+        Вызывается только потоком (или циклом событий), пишущим тики шарда.
+        """
+        now = oi_cache.monotonic_time()
+        filled = 0
+        for symbol, value in values.items():
+            state = oi_cache.get_state(symbol, count=False)
+            if state is not None and now - state[2] >= since:
+                continue
+            oi_cache.set_oi(symbol, value)
+            filled += 1
+        if filled:
+            BACKFILLED.inc(amount=filled)
+            logger.info(f"Шард {shard_id}: OI восполнен из снимка для {filled} инструментов")
+        return filled
+
+    def backfill(self, shard_id, instruments, since):
+        return self.apply_backfill(shard_id, self.fetch_backfill(shard_id, instruments, since), since)
+
+    def schedule_backfill(self, shard_id, instruments, since):
+        """
+        Запрос снимка в отдельном потоке через self.delay секунд (потоковый
+        фид); значения применяет поток шарда в drain_backfill.
+        """
+        timer = threading.Timer(self.delay, self._fetch_pending, (shard_id, list(instruments), since))
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def _fetch_pending(self, shard_id, instruments, since):
+        values = self.fetch_backfill(shard_id, instruments, since)
+        if not values:
+            return
+        with self._lock:
+            previous, _ = self.pending.get(shard_id, ({}, since))
+            self.pending[shard_id] = ({**previous, **values}, since)
+
+    def drain_backfill(self, shard_id):
+        """Поток шарда: применяет отложенный для него снимок"""
+        if shard_id not in self.pending:
+            return 0
+        with self._lock:
+            values, since = self.pending.pop(shard_id, ({}, None))
+        return self.apply_backfill(shard_id, values, since) if values else 0
+
+
+supervisor = FeedSupervisor()
@@ -0,0 +1,106 @@
+"""
+Конфигурация gunicorn.
+
+Импорт приложения не открывает соединений и не запускает потоков, поэтому
+его можно загружать в мастере (GUNICORN_PRELOAD=1 или --preload): воркеры
+запускают фид, реестр и кэш сами после fork (post_worker_init).
+
+При OI_SHARED_FEED=1 (по умолчанию) мастер-процесс запускает один процесс
+фида (feed_process.py), а воркеры читают OI из разделяемой памяти. Так число
+воркеров можно увеличивать, не умножая подключения к Dhan. Мастер следит за
+процессом фида: если он завершился, об этом пишется ошибка в лог и процесс
+запускается заново (с нарастающей паузой, если он падает сразу после старта).
+Пока процесса фида нет, воркеры отвечают 503 на /ready и /health.
+"""
+import os
+import sys
+import subprocess
+import threading
+import time
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+# Потоки в воркере: долгие соединения /stream не должны занимать весь воркер
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+preload_app = os.environ.get("GUNICORN_PRELOAD", "0") == "1"
+
+SHARED_FEED = os.environ.get("OI_SHARED_FEED", "1") == "1"
+
+# Как часто мастер проверяет процесс фида и пределы паузы перед его перезапуском
+FEED_CHECK_INTERVAL = 1.0
+FEED_RESTART_DELAY = 1.0
+FEED_MAX_RESTART_DELAY = 60.0
+# Сколько секунд процесс фида должен проработать, чтобы пауза сбросилась
+FEED_STABLE_SECONDS = 60.0
+
+_feed_process = None
+_feed_stopping = threading.Event()
+
+
+def _spawn_feed(server):
+    global _feed_process
+    # Отдельный интерпретатор, а не fork мастера: воркеры не должны
+    # наследовать процесс фида как своего потомка
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "feed_process.py")
+    env = dict(os.environ, OI_STORE_MODE="writer")
+    _feed_process = subprocess.Popen([sys.executable, script], env=env)
+    server.log.info(f"Запущен процесс фида Dhan (pid {_feed_process.pid})")
+    return time.monotonic()
+
+
+def _supervise_feed(server):
+    """Поток мастера: перезапускает процесс фида, если он завершился"""
+    started_at = time.monotonic()
+    delay = FEED_RESTART_DELAY
+    while not _feed_stopping.wait(FEED_CHECK_INTERVAL):
+        # Мастер gunicorn сам собирает завершившихся потомков (waitpid(-1)),
+        # поэтому код выхода процесса фида может оказаться неизвестным (0)
+        code = _feed_process.poll()
+        if code is None:
+            continue
+        if time.monotonic() - started_at >= FEED_STABLE_SECONDS:
+            delay = FEED_RESTART_DELAY
+        server.log.error(f"Процесс фида Dhan (pid {_feed_process.pid}) завершился с кодом {code}, "
+                         f"перезапуск через {delay:.0f} сек")
+        if _feed_stopping.wait(delay):
+            return
+        delay = min(delay * 2, FEED_MAX_RESTART_DELAY)
+        try:
+            started_at = _spawn_feed(server)
+        except OSError as e:
+            server.log.error(f"Не удалось запустить процесс фида Dhan: {e}")
+            started_at = time.monotonic()
+
+
+def on_starting(server):
+    if not SHARED_FEED:
+        return
+    # Воркеры наследуют окружение мастера и подключаются к хранилищу как читатели
+    os.environ["OI_STORE_MODE"] = "reader"
+    _spawn_feed(server)
+    thread = threading.Thread(target=_supervise_feed, args=(server,), name="feed-supervisor")
+    thread.daemon = True
+    thread.start()
+
+
+def post_fork(server, worker):
+    if SHARED_FEED:
+        import oi_cache
+        oi_cache.configure("reader")
+
+
+def post_worker_init(worker):
+    # Приложение загружено (в воркере или заранее в мастере) - запускаем процесс
+    from lifecycle import lifecycle
+    lifecycle.start()
+
+
+def on_exit(server):
+    _feed_stopping.set()
+    if _feed_process is not None and _feed_process.poll() is None:
+        _feed_process.terminate()
+        try:
+            _feed_process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            _feed_process.kill()
@@ -0,0 +1,192 @@
+"""
+Реестр инструментов: единый индекс тикеров из config.json и
+списка Security ID (Tickers_with_Security_IDs.csv).
+
+Индексы строятся один раз и перестраиваются только при изменении
+mtime одного из файлов. Все поиски выполняются через словари за O(1).
+"""
+import csv
+import os
+import threading
+import time
+import logging
+
+from config import get_config, CONFIG_FILE, TICKER_SECURITY_ID_FILE
+from dhan_packets import segment_code, parse_security_id
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT = "NSE_FNO"
+# Как часто (в секундах) проверять mtime файлов
+CHECK_INTERVAL = 1.0
+
+
+def _file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def load_security_id_file(path):
+    """
+    Читает CSV со списком тикеров и возвращает словарь символ -> security_id.
+
+    Поддерживаются оба формата файла: "Ticker,Security ID" и
+    формат с тремя и более колонками (символ во второй, ID в третьей).
+    """
+    security_ids = {}
+    if not os.path.exists(path):
+        logger.error(f"Файл со списком тикеров не найден: {path}")
+        return security_ids
+
+    with open(path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)  # Пропускаем заголовок
+        for row in reader:
+            if len(row) >= 3:
+                symbol, security_id = row[1].strip(), row[2].strip()
+            elif len(row) == 2:
+                symbol, security_id = row[0].strip(), row[1].strip()
+            else:
+                continue
+            if symbol and security_id:
+                # Первое вхождение выигрывает, как и при прежнем построчном поиске
+                security_ids.setdefault(symbol, security_id)
+    return security_ids
+
+
+class InstrumentRegistry:
+    """
+    Индексы инструментов:
+        by_symbol     - символ -> настроенный тикер из config.json
+        by_instrument - (код сегмента, security_id) -> символ
+        security_ids  - символ -> security_id из CSV со списком тикеров
+    """
+
+    def __init__(self, config_file=CONFIG_FILE, security_id_file=TICKER_SECURITY_ID_FILE):
+        self.config_file = config_file
+        self.security_id_file = security_id_file
+        self.by_symbol = {}
+        self.by_instrument = {}
+        self.security_ids = {}
+        self.version = 0
+        self._config_mtime = None
+        self._csv_mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _rebuild_config_index(self, tickers):
+        by_symbol = {}
+        by_instrument = {}
+        for ticker in tickers:
+            symbol = ticker.get("symbol")
+            if not symbol:
+                continue
+            by_symbol[symbol] = ticker
+            segment = segment_code(ticker.get("exchange_segment", DEFAULT_SEGMENT))
+            security_id = parse_security_id(ticker.get("security_id"))
+            if segment is not None and security_id is not None:
+                by_instrument[(segment, security_id)] = symbol
+        # Подменяем словари целиком, чтобы читатели без блокировки видели
+        # либо старый, либо новый индекс
+        self.by_symbol = by_symbol
+        self.by_instrument = by_instrument
+
+    def reload(self, force=False):
+        """Перестраивает индексы, если файлы изменились с прошлой загрузки"""
+        with self._lock:
+            self._checked_at = time.monotonic()
+            changed = False
+
+            config_mtime = _file_mtime(self.config_file)
+            if force or config_mtime != self._config_mtime:
+                config = get_config()
+                self._rebuild_config_index(config.get("tickers", []))
+                self._config_mtime = config_mtime
+                changed = True
+
+            csv_mtime = _file_mtime(self.security_id_file)
+            if force or csv_mtime != self._csv_mtime:
+                self.security_ids = load_security_id_file(self.security_id_file)
+                self._csv_mtime = csv_mtime
+                changed = True
+
+            if changed:
+                self.version += 1
+                logger.info(f"Реестр инструментов загружен: {len(self.by_symbol)} тикеров в конфигурации, "
+                            f"{len(self.security_ids)} в списке Security ID")
+            return changed
+
+    def maybe_reload(self):
+        """Проверяет mtime файлов не чаще, чем раз в CHECK_INTERVAL секунд"""
+        if time.monotonic() - self._checked_at >= CHECK_INTERVAL:
+            return self.reload()
+        return False
+
+    def get(self, symbol):
+        """Возвращает настроенный тикер по символу или None"""
+        self.maybe_reload()
+        return self.by_symbol.get(symbol)
+
+    def symbol_for(self, segment, security_id):
+        """Возвращает символ по коду сегмента и числовому security_id"""
+        return self.by_instrument.get((segment, security_id))
+
+    def find_security_id(self, symbol):
+        """Ищет Security ID символа в списке тикеров"""
+        self.maybe_reload()
+        return self.security_ids.get(symbol)
+
+    def instruments(self):
+        """Возвращает список всех настроенных тикеров"""
+        self.maybe_reload()
+        return list(self.by_symbol.values())
+
+    def add(self, ticker):
+        """Регистрирует тикер, не дожидаясь перечитывания config.json"""
+        self.add_many([ticker])
+
+    def add_many(self, tickers):
+        """
+        Регистрирует тикеры одним обновлением индексов: словари копируются
+        один раз на вызов, а не перестраиваются из всех тикеров.
+        """
+        with self._lock:
+            by_symbol = dict(self.by_symbol)
+            by_instrument = dict(self.by_instrument)
+            for ticker in tickers:
+                symbol = ticker.get("symbol")
+                if not symbol:
+                    continue
+                previous = by_symbol.get(symbol)
+                if previous is not None:
+                    # Тикер мог смениться инструментом - старый ключ больше не его
+                    old_key = (segment_code(previous.get("exchange_segment", DEFAULT_SEGMENT)),
+                               parse_security_id(previous.get("security_id")))
+                    if by_instrument.get(old_key) == symbol:
+                        del by_instrument[old_key]
+                by_symbol[symbol] = ticker
+                segment = segment_code(ticker.get("exchange_segment", DEFAULT_SEGMENT))
+                security_id = parse_security_id(ticker.get("security_id"))
+                if segment is not None and security_id is not None:
+                    by_instrument[(segment, security_id)] = symbol
+            self.by_symbol = by_symbol
+            self.by_instrument = by_instrument
+            self.version += 1
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Возвращает общий экземпляр реестра, загружая его при первом обращении"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                registry = InstrumentRegistry()
+                registry.reload(force=True)
+                _registry = registry
+    return _registry
@@ -0,0 +1,145 @@
+"""
+Жизненный цикл процесса сервера: ленивый запуск и готовность (/ready).
+
+Импорт app.py и модулей сервера не открывает соединений, не запускает
+потоков и не читает конфигурацию - поэтому приложение можно загружать в
+мастере gunicorn (--preload) и воркеры стартуют быстрее. Всё, что требует
+ресурсов процесса (реестр инструментов, фид Dhan, планировщик снимков),
+регистрируется как шаг запуска (on_start) и выполняется в start():
+
+    - в воркере gunicorn - из post_worker_init (gunicorn.conf.py), то есть
+      после fork;
+    - при первом запросе, если сервер не вызвал start() сам;
+    - при запуске python app.py.
+
+start() выполняется один раз на процесс: запоминается pid, поэтому потомок
+после fork запускается заново, а не наследует состояние родителя.
+
+Готовность (/ready) наступает, когда подписка подтверждена (по каждому
+соединению фида после отправки подписки пришёл хотя бы один фрейм) и по
+доле OI_READY_FRACTION инструментов из конфигурации уже есть свежие тики.
+До этого балансировщик не направляет запросы в процесс с пустым кэшем.
+Воркер-читатель (OI_SHARED_FEED=1) готов, только пока жив процесс фида:
+его отметки в разделяемой памяти не старше OI_FEED_HEARTBEAT_TIMEOUT.
+"""
+import math
+import os
+import threading
+import time
+import logging
+
+import oi_cache
+from instrument_registry import get_registry
+from oi_freshness import index as freshness
+
+logger = logging.getLogger(__name__)
+
+# Доля инструментов из конфигурации, по которым нужны свежие тики для готовности
+READY_FRACTION = float(os.environ.get("OI_READY_FRACTION", 0.5))
+
+
+class Lifecycle:
+    """Шаги запуска процесса и состояние готовности"""
+
+    def __init__(self):
+        self.steps = []  # (имя, функция) в порядке регистрации
+        self.pid = None
+        self.started_at = None
+        self.startup_seconds = None
+        self.ready_at = None
+        self.acknowledged = False
+        self._lock = threading.Lock()
+
+    def on_start(self, name, step):
+        """Регистрирует шаг запуска; шаги выполняются в порядке регистрации"""
+        self.steps.append((name, step))
+        return step
+
+    @property
+    def started(self):
+        return self.pid == os.getpid()
+
+    def start(self):
+        """
+        Выполняет шаги запуска, если в этом процессе они ещё не выполнялись.
+
+        Returns:
+            bool: True, если запуск выполнен этим вызовом
+        """
+        if self.started:
+            return False
+        with self._lock:
+            if self.started:
+                return False
+            started = time.perf_counter()
+            for name, step in self.steps:
+                try:
+                    step()
+                except Exception as e:
+                    logger.error(f"Ошибка на шаге запуска {name}: {e}")
+            self.startup_seconds = time.perf_counter() - started
+            self.started_at = time.time()
+            self.ready_at = None
+            self.acknowledged = False
+            self.pid = os.getpid()
+        logger.info(f"Процесс {self.pid} запущен за {self.startup_seconds:.3f} сек")
+        return True
+
+    def readiness(self, feed_stats):
+        """
+        Проверяет готовность процесса.
+
+        Args:
+            feed_stats: статистика соединений фида (пустая, если фид
+                работает в другом процессе)
+
+        Returns:
+            tuple: (готов ли, список причин неготовности, подробности)
+        """
+        waiting = []
+        if not self.started:
+            return False, ["process is not started"], {}
+        # Фид в этом процессе: подписка подтверждается первым фреймом после неё
+        if oi_cache.STORE_MODE != "reader" and not self.acknowledged:
+            if not feed_stats:
+                waiting.append("feed is not running")
+            elif not all(shard.get("acknowledged") for shard in feed_stats):
+                pending = sum(1 for shard in feed_stats if not shard.get("acknowledged"))
+                waiting.append(f"subscriptions are not acknowledged on {pending} connections")
+            else:
+                self.acknowledged = True
+        feed_process = oi_cache.feed_process_state()
+        if feed_process is not None and not feed_process["alive"]:
+            if feed_process["pid"] is None:
+                waiting.append("feed process has not created the shared OI store")
+            else:
+                waiting.append(f"feed process {feed_process['pid']} is not responding "
+                               f"(last heartbeat {feed_process['heartbeat_age']:.0f} seconds ago)")
+        expected = len(get_registry().by_instrument)
+        needed = math.ceil(READY_FRACTION * expected)
+        summary = freshness.summary()
+        if summary["fresh"] < needed:
+            waiting.append(f"waiting for first ticks ({summary['fresh']} of {needed} instruments)")
+        ready = not waiting
+        if ready and self.ready_at is None:
+            self.ready_at = time.time()
+            logger.info(f"Процесс {self.pid} готов через {self.ready_at - self.started_at:.1f} сек после запуска")
+        details = {"fresh": summary["fresh"], "needed": needed}
+        if feed_process is not None:
+            details["feed_process"] = feed_process
+        return ready, waiting, details
+
+
+lifecycle = Lifecycle()
+
+
+def build_ready(feed_stats):
+    """Формирует ответ /ready: (payload, status); 503, пока процесс не готов"""
+    ready, waiting, details = lifecycle.readiness(feed_stats)
+    payload = {"status": "ready" if ready else "starting", "pid": os.getpid(), **details}
+    if waiting:
+        payload["waiting"] = waiting
+    if lifecycle.started_at is not None:
+        payload["uptime"] = round(time.time() - lifecycle.started_at, 1)
+        payload["startup_seconds"] = round(lifecycle.startup_seconds, 3)
+    return payload, 200 if ready else 503
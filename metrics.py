@@ -0,0 +1,261 @@
+"""
+Метрики сервера в текстовом формате Prometheus (/metrics).
+
+Счётчики и гистограммы пишутся без общих блокировок: у каждого потока свои
+ячейки, а при выдаче /metrics ячейки всех потоков суммируются. Горячий путь
+(разбор фреймов, чтение кэша) платит одно обращение к словарю. Ячейки
+завершившихся потоков (например, при python app.py каждый запрос - новый
+поток) сливаются в общий итог, поэтому их число не растёт с числом запросов.
+
+Вместо логирования каждого события используется log_every: сообщение с
+одним ключом пишется не чаще раза в интервал, с числом пропущенных повторов.
+"""
+import bisect
+import threading
+import time
+import weakref
+import logging
+
+# Границы корзин гистограмм по умолчанию, в секундах
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+_registry = []
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._cells = []  # (слабая ссылка на поток, ячейка потока)
+        self._retired = {}  # итог ячеек завершившихся потоков
+        self._cells_lock = threading.Lock()
+        _registry.append(self)
+
+    def _cell(self):
+        cell = getattr(self._local, "cell", None)
+        if cell is None:
+            cell = self._local.cell = {}
+            # Блокировка берётся один раз на поток - при регистрации ячейки
+            with self._cells_lock:
+                self._retire_dead()
+                self._cells.append((weakref.ref(threading.current_thread()), cell))
+        return cell
+
+    def _retire_dead(self):
+        """Сливает ячейки завершившихся потоков в self._retired (под self._cells_lock)"""
+        live = []
+        for ref, cell in self._cells:
+            thread = ref()
+            if thread is None or not thread.is_alive():
+                # Поток завершён - в его ячейку больше никто не пишет
+                self._merge(self._retired, cell)
+            else:
+                live.append((ref, cell))
+        self._cells = live
+
+    def _merge(self, totals, cell):
+        raise NotImplementedError
+
+    def values(self):
+        with self._cells_lock:
+            self._retire_dead()
+            totals = self._merge({}, self._retired)
+            cells = [cell for _, cell in self._cells]
+        for cell in cells:
+            self._merge(totals, cell)
+        return totals
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Монотонный счётчик с метками"""
+
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        cell = self._cell()
+        cell[labels] = cell.get(labels, 0) + amount
+
+    def _merge(self, totals, cell):
+        for labels, value in list(cell.items()):
+            totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def value(self, *labels):
+        return self.values().get(labels, 0)
+
+    def render(self):
+        lines = self._header()
+        for labels, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Гистограмма с фиксированными корзинами (как histogram в Prometheus)"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        cell = self._cell()
+        state = cell.get(labels)
+        if state is None:
+            # Счётчики по корзинам (+Inf последней), сумма, количество
+            state = cell[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def _merge(self, totals, cell):
+        for labels, (counts, total, count) in list(cell.items()):
+            merged = totals.get(labels)
+            if merged is None:
+                merged = totals[labels] = [[0] * len(counts), 0.0, 0]
+            merged[0] = [a + b for a, b in zip(merged[0], counts)]
+            merged[1] += total
+            merged[2] += count
+        return totals
+
+    def render(self):
+        lines = self._header()
+        for labels, (counts, total, count) in sorted(self.values().items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, ('le', le))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {count}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Значение, вычисляемое функцией при выдаче метрик"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def render(self):
+        lines = self._header()
+        try:
+            values = self.collect() if self.collect is not None else {}
+        except Exception as e:
+            logging.warning(f"Не удалось собрать метрику {self.name}: {e}")
+            values = {}
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}")
+        return lines
+
+
+def render():
+    """Все метрики процесса в текстовом формате Prometheus"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Фид Dhan
+FRAMES = Counter("dhan_feed_frames_total", "Binary frames received from the Dhan feed")
+TICKS = Counter("dhan_feed_ticks_total", "OI values written to the cache")
+UNKNOWN_INSTRUMENTS = Counter("dhan_feed_unknown_instrument_total", "Packets for instruments missing from the registry")
+DECODE_ERRORS = Counter("dhan_feed_decode_errors_total", "Frames that failed to decode")
+RECONNECTS = Counter("dhan_feed_reconnects_total", "Feed reconnect attempts", ("shard",))
+FRAME_DECODE = Histogram("dhan_feed_decode_seconds", "Time to decode one frame")
+TICK_TO_CACHE = Histogram("dhan_feed_tick_to_cache_seconds",
+                          "Time from frame arrival until its last tick is in the cache")
+
+FEED_CONNECTED = Gauge("dhan_feed_connected", "Whether the feed connection is open", ("shard",))
+FEED_INSTRUMENTS = Gauge("dhan_feed_instruments", "Instruments subscribed on the connection", ("shard",))
+FEED_TICK_RATE = Gauge("dhan_feed_tick_rate", "Ticks per second on the connection", ("shard",))
+
+
+def register_feed_stats(source):
+    """Подключает метрики соединений к функции статистики фида (список словарей по шардам)"""
+    def collector(field):
+        return lambda: {(str(shard["shard"]),): float(shard[field]) for shard in source()}
+    FEED_CONNECTED.collect = collector("connected")
+    FEED_INSTRUMENTS.collect = collector("instruments")
+    FEED_TICK_RATE.collect = collector("tick_rate")
+
+
+# Кэш OI и кэш ответов
+CACHE_READS = Counter("oi_cache_reads_total", "OI cache reads by result", ("result",))
+RESPONSE_CACHE = Counter("response_cache_total", "Serialized response cache lookups", ("result",))
+
+# HTTP
+REQUESTS = Counter("http_requests_total", "HTTP requests by endpoint and status", ("endpoint", "status"))
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency", ("endpoint",))
+
+
+# Ключ -> [время последнего вывода, подавленные повторы, интервал]
+_log_state = {}
+_log_state_lock = threading.Lock()
+# Предел числа ключей: сверх него забываются ключи с истёкшим интервалом
+MAX_LOG_KEYS = 1024
+
+
+def _prune_log_state(now):
+    global _log_state
+    with _log_state_lock:
+        if len(_log_state) < MAX_LOG_KEYS:
+            return
+        state = {key: value for key, value in _log_state.items() if now - value[0] < value[2]}
+        if len(state) >= MAX_LOG_KEYS:
+            # Все интервалы ещё идут - остаются самые свежие ключи
+            state = dict(sorted(state.items(), key=lambda item: item[1][0])[-MAX_LOG_KEYS // 2:])
+        _log_state = state
+
+
+def log_every(key, message, interval=60.0, level=logging.WARNING, logger=None):
+    """
+    Пишет сообщение не чаще раза в interval секунд для одного ключа.
+
+    Повторы в пределах интервала только подсчитываются, и их число
+    добавляется к следующему выведенному сообщению. Ключей не больше
+    MAX_LOG_KEYS, поэтому ключ может содержать и данные запроса.
+    """
+    now = time.monotonic()
+    state = _log_state.get(key)
+    if state is not None and now - state[0] < interval:
+        state[1] += 1
+        return False
+    suppressed = state[1] if state is not None else 0
+    if state is None:
+        _prune_log_state(now)
+    _log_state[key] = [now, 0, interval]
+    if suppressed:
+        message = f"{message} (+{suppressed} повторов за {int(interval)} сек)"
+    (logger or logging.getLogger()).log(level, message)
+    return True
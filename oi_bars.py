@@ -0,0 +1,216 @@
+"""
+Бары OI (open/high/low/close) по таймфреймам, выровненные по сессии NSE.
+
+Границы баров отсчитываются от начала сессии 09:15 IST каждого дня, поэтому
+бар 75min всегда 09:15-10:30, 10:30-11:45 и т.д., независимо от того, когда
+приходят запросы. Бары обновляются на каждом тике за O(1) на таймфрейм
+(слушатель oi_cache), закрытые бары хранятся в ограниченной очереди.
+
+Клиент забирает бары инкрементально: /oi_bars?since=<время начала бара>
+возвращает только бары, начавшиеся позже, плюс текущий незакрытый бар.
+
+Воркер-читатель разделяемой памяти (OI_SHARED_FEED=1) своих баров по тикам
+не ведёт: он видит тики только через опрос памяти, и бары разных воркеров
+расходились бы, а после перезапуска воркера пропадали. Вместо этого бары
+символа строятся по общей истории OI в разделяемой памяти (oi_cache) и
+кэшируются до следующего тика по символу - все воркеры отдают одинаковые
+бары, но с точностью OI_HISTORY_RESOLUTION секунд и на глубину истории
+(OI_HISTORY_CAPACITY отсчётов).
+"""
+import bisect
+import os
+import threading
+from collections import deque
+
+import numpy as np
+
+import oi_cache
+
+# Начало сессии NSE 09:15 IST = 03:45 UTC, в секундах от начала суток UTC
+SESSION_OFFSET = 3 * 3600 + 45 * 60
+DAY = 24 * 3600
+
+BAR_TIMEFRAMES = tuple(int(tf) for tf in os.environ.get("OI_BAR_TIMEFRAMES", "15,45,75,120,240").split(","))
+# Сколько закрытых баров хранить на таймфрейм
+BAR_HISTORY = int(os.environ.get("OI_BAR_HISTORY", 500))
+
+
+def bar_start(timestamp, seconds):
+    """Начало бара длиной seconds, содержащего timestamp (UNIX-время)"""
+    session = (timestamp - SESSION_OFFSET) // DAY * DAY + SESSION_OFFSET
+    return session + (timestamp - session) // seconds * seconds
+
+
+def bar_starts(timestamps, seconds):
+    """Векторный вариант bar_start"""
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    session = np.floor((timestamps - SESSION_OFFSET) / DAY) * DAY + SESSION_OFFSET
+    return session + np.floor((timestamps - session) / seconds) * seconds
+
+
+class BarSeries:
+    """Бары одного символа на одном таймфрейме"""
+
+    __slots__ = ("seconds", "closed", "current")
+
+    def __init__(self, seconds, history=BAR_HISTORY):
+        self.seconds = seconds
+        self.closed = deque(maxlen=history)
+        # (начало, open, high, low, close); кортеж подменяется целиком,
+        # так что читатель без блокировки видит согласованный бар
+        self.current = None
+
+    def update(self, timestamp, value):
+        current = self.current
+        if current is not None and timestamp < current[0] + self.seconds:
+            if timestamp >= current[0]:
+                self.current = (current[0], current[1], max(current[2], value),
+                                min(current[3], value), value)
+            return
+        start = bar_start(timestamp, self.seconds)
+        if current is not None:
+            if start < current[0]:
+                return  # тик старше текущего бара
+            self.closed.append(current)
+        self.current = (start, value, value, value, value)
+
+    def load(self, timestamps, values):
+        """Строит бары по готовой истории (массивы в хронологическом порядке)"""
+        if not len(values):
+            return
+        values = np.asarray(values, dtype=np.int64)
+        starts = bar_starts(timestamps, self.seconds)
+        first = np.flatnonzero(np.concatenate(([True], starts[1:] != starts[:-1])))
+        last = np.concatenate((first[1:] - 1, [len(values) - 1]))
+        bars = list(zip(starts[first].tolist(), values[first].tolist(),
+                        np.maximum.reduceat(values, first).tolist(),
+                        np.minimum.reduceat(values, first).tolist(),
+                        values[last].tolist()))
+        self.closed.clear()
+        self.closed.extend(bars[:-1])
+        self.current = bars[-1]
+
+    def since(self, cursor=None):
+        """Закрытые бары, начавшиеся после cursor, и текущий бар"""
+        current = self.current
+        # Копия очереди: поток фида может дописывать её во время чтения
+        closed = list(self.closed)
+        if cursor is not None:
+            starts = [bar[0] for bar in closed]
+            closed = closed[bisect.bisect_right(starts, cursor):]
+        return closed, current
+
+
+class OIBars:
+    """Бары по всем символам и таймфреймам"""
+
+    def __init__(self, timeframes=BAR_TIMEFRAMES, history=BAR_HISTORY):
+        self.timeframes = tuple(timeframes)
+        self.history = history
+        self.series = {}
+        # Режим "reader": символ -> (число обновлений, бары по общей истории)
+        self.shared = {}
+        self._lock = threading.Lock()
+
+    def _symbol_series(self, symbol):
+        series = self.series.get(symbol)
+        if series is None:
+            with self._lock:
+                series = self.series.get(symbol)
+                if series is None:
+                    series = tuple(BarSeries(tf * 60, self.history) for tf in self.timeframes)
+                    self.series = {**self.series, symbol: series}
+        return series
+
+    def on_update(self, symbol, value, updated_at):
+        """Слушатель oi_cache: O(1) на каждый таймфрейм"""
+        if oi_cache.STORE_MODE == "reader":
+            return
+        for series in self._symbol_series(symbol):
+            series.update(updated_at, value)
+
+    def on_restore(self, symbol, timestamps, values):
+        if oi_cache.STORE_MODE == "reader":
+            return
+        for series in self._symbol_series(symbol):
+            series.load(timestamps, values)
+
+    def _shared_series(self, symbol):
+        """Бары символа по истории в разделяемой памяти; пересчёт - после новых тиков"""
+        state = oi_cache.get_state(symbol, count=False)
+        if state is None:
+            return None
+        cached = self.shared.get(symbol)
+        if cached is not None and cached[0] == state[3]:
+            return cached[1]
+        history = oi_cache.get_history_series(symbol)
+        if history is None:
+            return None
+        series = tuple(BarSeries(tf * 60, self.history) for tf in self.timeframes)
+        for item in series:
+            item.load(*history)
+        self.shared[symbol] = (state[3], series)
+        return series
+
+    def get(self, symbol, timeframe):
+        """Серия баров символа на таймфрейме (в минутах) или None"""
+        if timeframe not in self.timeframes:
+            return None
+        if oi_cache.STORE_MODE == "reader":
+            series = self._shared_series(symbol)
+        else:
+            series = self.series.get(symbol)
+        if series is None:
+            return None
+        return series[self.timeframes.index(timeframe)]
+
+
+def format_bar(bar, closed):
+    start, open_, high, low, close = bar
+    return {"t": int(start), "o": open_, "h": high, "l": low, "c": close, "closed": closed}
+
+
+def build_oi_bars(symbol, timeframes=None, since=None):
+    """
+    Формирует ответ /oi_bars: (payload, status).
+
+    Args:
+        timeframes: минуты через запятую (по умолчанию все поддерживаемые)
+        since: время начала бара (UNIX); отдаются бары, начавшиеся позже
+    """
+    if timeframes:
+        try:
+            requested = [int(tf) for tf in timeframes.split(",") if tf.strip()]
+        except ValueError:
+            requested = None
+        if not requested or any(tf not in bars.timeframes for tf in requested):
+            return {"error": f"Supported timeframes: {','.join(map(str, bars.timeframes))}",
+                    "status": "error"}, 400
+    else:
+        requested = list(bars.timeframes)
+    if since is not None:
+        try:
+            since = float(since)
+        except ValueError:
+            return {"error": "since must be a UNIX timestamp", "status": "error"}, 400
+
+    result = {}
+    for tf in requested:
+        series = bars.get(symbol, tf)
+        if series is None:
+            continue
+        closed, current = series.since(since)
+        items = [format_bar(bar, True) for bar in closed]
+        if current is not None:
+            # Незакрытый бар отдаётся всегда: он меняется до закрытия
+            items.append(format_bar(current, False))
+        last_closed = closed[-1][0] if closed else since
+        result[f"{tf}min"] = {"bars": items, "cursor": int(last_closed) if last_closed is not None else None}
+    if not result:
+        return {"error": f"No OI bars for {symbol}", "symbol": symbol, "status": "error"}, 404
+    return {"symbol": symbol, "timeframes": result, "status": "success"}, 200
+
+
+bars = OIBars()
+oi_cache.add_listener(bars.on_update)
+oi_cache.add_restore_listener(bars.on_restore)
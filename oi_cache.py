@@ -1,30 +1,452 @@
+import os
+import threading
 import time
+import logging
+
+from metrics import CACHE_READS, log_every
+from oi_history import OIRing, oi_change, change_matrix
 
-oi_data = {}
-last_update = {}
 MAX_AGE_SECONDS = 60  # Максимальное время актуальности данных (1 минута)
 
+# Режим хранилища: "local" - записи в памяти процесса, "writer" - процесс фида пишет
+# в разделяемую память, "reader" - воркер читает из разделяемой памяти
+STORE_MODE = os.environ.get("OI_STORE_MODE", "local")
+# Как часто читатель пытается подключиться к ещё не созданному хранилищу и
+# проверяет, не пересоздал ли его перезапущенный процесс фида
+SHARED_ATTACH_RETRY = 1.0
+# Через сколько секунд без отметки процесса фида он считается потерянным
+FEED_HEARTBEAT_TIMEOUT = float(os.environ.get("OI_FEED_HEARTBEAT_TIMEOUT", 10))
+# Сколько раз читатель записи повторяет чтение, пока писатель посреди записи
+READ_RETRIES = 1000
+
+_shared = None
+# Поколение данных процесса в режиме "local" (в разделяемой памяти - поколение файла)
+_generation = int.from_bytes(os.urandom(8), 'little')
+_shared_attach_at = 0.0
+_shared_checked_at = 0.0
+
+# Часы кэша: время обновлений (UNIX) и монотонное время истории.
+# Воспроизведение тиков (replay.py) подменяет их виртуальными часами.
+wall_time = time.time
+monotonic_time = time.monotonic
+
+def use_clock(wall=None, monotonic=None):
+    """Подменяет часы кэша; без аргументов возвращает системные"""
+    global wall_time, monotonic_time
+    wall_time = wall or time.time
+    monotonic_time = monotonic or time.monotonic
+
+class OIRecord:
+    """
+    Запись символа в режиме "local": значение, время обновления по UNIX-часам
+    и по монотонным часам, число обновлений (версия данных) и история.
+
+    Поток фида обновляет поля по месту, а потоки запросов читают их без
+    блокировки: на время записи seq нечётный (seqlock), и читатель повторяет
+    чтение, пока не увидит одно и то же чётное seq до и после. Так значение
+    никогда не читается в паре с временем от другого тика.
+    """
+
+    __slots__ = ("seq", "value", "updated_at", "updated_mono", "updates", "ring")
+
+    def __init__(self):
+        self.seq = 0
+        self.value = 0
+        self.updated_at = 0.0
+        self.updated_mono = 0.0
+        self.updates = 0
+        self.ring = OIRing()
+
+    def write(self, value, updated_at, updated_mono):
+        # Писатель по символу один - поток шарда фида, к которому он относится
+        self.seq += 1
+        self.value = value
+        self.updated_at = updated_at
+        self.updated_mono = updated_mono
+        self.updates += 1
+        self.seq += 1
+
+    def read(self):
+        """Returns: (значение, время обновления, монотонное время, число обновлений)"""
+        for _ in range(READ_RETRIES):
+            seq = self.seq
+            if seq & 1:
+                # Писатель прерван посреди записи - отдаём ему GIL
+                time.sleep(0)
+                continue
+            result = (self.value, self.updated_at, self.updated_mono, self.updates)
+            if self.seq == seq:
+                return result
+        # seq так и остался нечётным - запись нарушена; не зависаем, а отдаём поля как есть
+        log_every(("seqlock", id(self)), f"Запись OI не стабилизировалась за {READ_RETRIES} попыток чтения",
+                  level=logging.ERROR)
+        return self.value, self.updated_at, self.updated_mono, self.updates
+
+# Записи по символам (режим "local")
+_records = {}
+_records_lock = threading.Lock()
+
+def _record_for(symbol):
+    record = _records.get(symbol)
+    if record is None:
+        with _records_lock:
+            record = _records.get(symbol)
+            if record is None:
+                record = _records[symbol] = OIRecord()
+    return record
+
+# Слушатели обновлений (символ, OI, время обновления) - например, push-поток
+_listeners = []
+_restore_listeners = []
+# Как часто воркер-читатель проверяет разделяемую память на новые тики
+WATCH_INTERVAL = 0.1
+_watcher = None
+
+def add_listener(callback):
+    """
+    Регистрирует функцию, вызываемую на каждом обновлении OI.
+    
+    В режимах "local" и "writer" она вызывается из потока фида, в режиме
+    "reader" - из фонового потока, следящего за разделяемой памятью.
+    """
+    _listeners.append(callback)
+    if STORE_MODE == "reader":
+        _start_watcher()
+
+def add_restore_listener(callback):
+    """
+    Регистрирует функцию (символ, время в секундах, OI), вызываемую при
+    восстановлении истории символа целиком (например, из журнала тиков).
+    """
+    _restore_listeners.append(callback)
+
+def remove_listener(callback):
+    if callback in _listeners:
+        _listeners.remove(callback)
+
+def _notify(symbol, value, updated_at):
+    for callback in _listeners:
+        try:
+            callback(symbol, value, updated_at)
+        except Exception as e:
+            logging.error(f"Ошибка в слушателе обновлений OI: {e}")
+
+def _start_watcher():
+    global _watcher
+    if _watcher is not None and _watcher.is_alive():
+        return
+    _watcher = threading.Thread(target=_watch_shared, name="oi-shm-watcher")
+    _watcher.daemon = True
+    _watcher.start()
+
+def _watch_shared():
+    """Сравнивает счётчики обновлений в разделяемой памяти и оповещает слушателей"""
+    counts = None
+    watched = None
+    while _listeners and STORE_MODE == "reader":
+        time.sleep(WATCH_INTERVAL)
+        store = _shared_store()
+        if store is None:
+            continue
+        if store is not watched:
+            # Новое хранилище (переподключение): стартовый снимок без оповещений
+            watched = store
+            counts, _ = store.changes()
+            continue
+        counts, changed = store.changes(counts)
+        for symbol in changed:
+            record = store.read(symbol)
+            if record is not None:
+                _notify(symbol, record[0], record[1])
+
+def configure(mode, path=None):
+    """Переключает режим хранилища (local / writer / reader)"""
+    global STORE_MODE, _shared, _shared_attach_at, _shared_checked_at
+    if path:
+        os.environ["OI_SHM_PATH"] = path
+    STORE_MODE = mode
+    _shared = None
+    _shared_attach_at = 0.0
+    _shared_checked_at = 0.0
+    # Слушатели могли появиться ещё до fork (gunicorn --preload), а потоки
+    # через fork не переходят - наблюдатель запускается в этом процессе
+    if mode == "reader" and _listeners:
+        _start_watcher()
+    return _shared_store()
+
+def _shared_store():
+    """
+    Возвращает хранилище в разделяемой памяти (подключается лениво).
+
+    Читатель раз в SHARED_ATTACH_RETRY секунд сверяет файл хранилища: после
+    перезапуска процесса фида на том же пути лежит новый файл, а старое
+    отображение больше никто не обновляет.
+    """
+    global _shared, _shared_attach_at, _shared_checked_at
+    if STORE_MODE == "local":
+        return None
+    if _shared is not None:
+        if STORE_MODE != "reader":
+            return _shared
+        now = time.monotonic()
+        if now - _shared_checked_at < SHARED_ATTACH_RETRY:
+            return _shared
+        _shared_checked_at = now
+        if _shared.is_current():
+            return _shared
+        from oi_shm import SharedOIStore
+        try:
+            store = SharedOIStore.attach(_shared.path)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Не удалось переподключиться к новому хранилищу OI: {e}")
+            return _shared
+        logging.warning(f"Процесс фида пересоздал хранилище OI - воркер переподключился к {store.path}")
+        # Старое отображение не закрывается: его могут дочитывать другие потоки
+        _shared = store
+        return _shared
+
+    now = time.monotonic()
+    if _shared_attach_at and now - _shared_attach_at < SHARED_ATTACH_RETRY:
+        return None
+    _shared_attach_at = now
+
+    from oi_shm import SharedOIStore, DEFAULT_PATH
+    path = os.environ.get("OI_SHM_PATH", DEFAULT_PATH)
+    try:
+        if STORE_MODE == "writer":
+            _shared = SharedOIStore.create(path)
+        else:
+            _shared = SharedOIStore.attach(path)
+            _shared_checked_at = now
+    except (OSError, ValueError) as e:
+        logging.warning(f"Хранилище OI в разделяемой памяти недоступно: {e}")
+    return _shared
+
+def heartbeat():
+    """Отметка процесса фида в хранилище (режим "writer")"""
+    store = _shared_store() if STORE_MODE == "writer" else None
+    if store is not None:
+        store.heartbeat()
+
+def feed_process_state():
+    """
+    Состояние процесса фида для воркера-читателя.
+
+    Returns:
+        dict: pid процесса фида, секунд с его последней отметки и жив ли он;
+            None вне режима "reader"
+    """
+    if STORE_MODE != "reader":
+        return None
+    store = _shared_store()
+    if store is None:
+        return {"pid": None, "heartbeat_age": None, "alive": False}
+    pid, age = store.writer_state()
+    return {"pid": pid, "heartbeat_age": round(age, 1), "alive": age <= FEED_HEARTBEAT_TIMEOUT}
+
+def _read(symbol):
+    """
+    Согласованно читает запись символа.
+
+    Returns:
+        tuple: (значение, время обновления, монотонное время обновления,
+            число обновлений) или None
+    """
+    if STORE_MODE != "local":
+        store = _shared_store()
+        return store.read(symbol) if store is not None else None
+    record = _records.get(symbol)
+    if record is None:
+        return None
+    return record.read()
+
 def set_oi(symbol, value):
-    oi_data[symbol] = value
-    last_update[symbol] = time.time()
+    now = wall_time()
+    mono = monotonic_time()
+    if STORE_MODE != "local":
+        store = _shared_store()
+        if store is not None:
+            store.write(symbol, value, now, mono)
+    else:
+        record = _records.get(symbol) or _record_for(symbol)
+        record.write(value, now, mono)
+        record.ring.append(mono, value)
+    if _listeners:
+        _notify(symbol, value, now)
 
-def get_oi(symbol):
-    # Проверка наличия данных в кэше
-    if symbol not in oi_data:
-        print(f"[-] Нет данных OI для {symbol}")
+def restore(symbol, timestamps, values):
+    """
+    Восстанавливает значение и историю символа (например, из журнала тиков).
+    
+    Args:
+        timestamps: время тиков по UNIX-часам в секундах (возрастающее)
+        values: значения OI
+    """
+    if not len(values):
+        return
+    # История ведётся по монотонным часам: переводим время через текущее смещение
+    offset = wall_time() - monotonic_time()
+    history_ts = timestamps - offset
+    value, updated_at = int(values[-1]), float(timestamps[-1])
+    if STORE_MODE != "local":
+        store = _shared_store()
+        if store is not None:
+            store.write(symbol, value, updated_at, updated_at - offset, append_history=False)
+            store.history(symbol).load(history_ts, values)
+    else:
+        record = _record_for(symbol)
+        record.write(value, updated_at, updated_at - offset)
+        record.ring.load(history_ts, values)
+    for callback in _restore_listeners:
+        try:
+            callback(symbol, timestamps, values)
+        except Exception as e:
+            logging.error(f"Ошибка в слушателе восстановления OI: {e}")
+
+def generation():
+    """
+    Поколение хранилища: меняется, когда счётчики обновлений начинаются
+    заново (перезапуск процесса или процесса фида). Версия данных для кэша
+    ответов и ETag - пара (поколение, число обновлений).
+    """
+    if STORE_MODE != "local":
+        store = _shared_store()
+        return store.generation if store is not None else None
+    return _generation
+
+def get_version(symbol):
+    """
+    Возвращает (номер обновления, время обновления) для символа или None.
+    Номер увеличивается на каждом тике и служит версией данных.
+    """
+    record = _read(symbol)
+    return (record[3], record[1]) if record else None
+
+def get_history(symbol):
+    """Возвращает кольцевой буфер истории OI символа или None"""
+    if STORE_MODE != "local":
+        store = _shared_store()
+        return store.history(symbol) if store is not None else None
+    record = _records.get(symbol)
+    return record.ring if record is not None else None
+
+def get_history_series(symbol):
+    """
+    История OI символа по UNIX-времени.
+
+    Монотонное время отсчётов переводится смещением из записи символа (время
+    последнего тика по UNIX- и по монотонным часам писателя), а не из часов
+    этого процесса, поэтому все читатели разделяемой памяти получают
+    одинаковые массивы.
+
+    Returns:
+        tuple: (время UNIX, OI) в хронологическом порядке или None
+    """
+    record = _read(symbol)
+    ring = get_history(symbol)
+    if record is None or ring is None or not len(ring):
         return None
+    ts, oi = ring.ordered()
+    return ts + (record[1] - record[2]), oi
+
+def get_oi_change(symbol, seconds, current_oi=None):
+    """
+    Изменение OI символа за последние seconds секунд.
     
-    # Проверка свежести данных
-    if symbol in last_update:
-        age = time.time() - last_update[symbol]
+    Returns:
+        tuple: (OI в начале окна, текущий OI, изменение в процентах) или None
+    """
+    return oi_change(get_history(symbol), seconds, monotonic_time(), current_oi)
+
+def get_state(symbol, count=True):
+    """
+    Согласованное состояние символа одним чтением записи.
+
+    Args:
+        count: учитывать чтение в метрике oi_cache_reads_total (проверки
+            версии для кэша ответов не учитываются)
+
+    Returns:
+        tuple: (OI, время обновления UNIX, возраст данных в секундах по
+            монотонным часам, число обновлений) или None, если данных нет.
+            Устаревшие данные тоже возвращаются - свежесть проверяет вызывающий.
+    """
+    record = _read(symbol)
+    if record is None:
+        if count:
+            CACHE_READS.inc("miss")
+            # Символ приходит из запроса - ключ общий, иначе клиенты плодят ключи
+            log_every(("oi_miss",), f"Нет данных OI для {symbol}")
+        return None
+    value, updated_at, updated_mono, updates = record
+    age = monotonic_time() - updated_mono
+    if count:
         if age > MAX_AGE_SECONDS:
-            print(f"[-] Данные OI для {symbol} устарели ({int(age)} сек)")
-            return None
-    
-    return oi_data.get(symbol, None)
+            CACHE_READS.inc("stale")
+            log_every(("oi_stale", symbol), f"Данные OI для {symbol} устарели ({int(age)} сек)")
+        else:
+            CACHE_READS.inc("hit")
+    return value, updated_at, age, updates
+
+def get_states(symbols=None):
+    """
+    Состояния набора символов на один момент времени: часы читаются один
+    раз на весь набор, каждая запись - согласованно.
+
+    Args:
+        symbols: символы (по умолчанию все символы с данными)
+
+    Returns:
+        dict: символ -> кортеж как в get_state; символов без данных в нём нет
+    """
+    if symbols is None:
+        if STORE_MODE != "local":
+            store = _shared_store()
+            symbols = store.symbols() if store is not None else []
+        else:
+            symbols = list(_records)
+    now = monotonic_time()
+    states = {}
+    stale = 0
+    for symbol in symbols:
+        record = _read(symbol)
+        if record is not None:
+            value, updated_at, updated_mono, updates = record
+            age = now - updated_mono
+            states[symbol] = (value, updated_at, age, updates)
+            if age > MAX_AGE_SECONDS:
+                stale += 1
+    missing = len(symbols) - len(states)
+    if missing:
+        CACHE_READS.inc("miss", amount=missing)
+    if stale:
+        CACHE_READS.inc("stale", amount=stale)
+    if len(states) > stale:
+        CACHE_READS.inc("hit", amount=len(states) - stale)
+    return states
+
+def is_fresh(state):
+    """Данные состояния (из get_state/get_states) не старше MAX_AGE_SECONDS"""
+    return state is not None and state[2] <= MAX_AGE_SECONDS
+
+def get_oi(symbol):
+    """Текущий OI символа или None, если данных нет или они устарели"""
+    state = get_state(symbol)
+    return state[0] if state is not None and state[2] <= MAX_AGE_SECONDS else None
 
 def get_oi_age(symbol):
     """Возвращает возраст данных в секундах или None, если данных нет"""
-    if symbol in last_update:
-        return time.time() - last_update[symbol]
-    return None
+    record = _read(symbol)
+    if record is None:
+        return None
+    return monotonic_time() - record[2]
+
+def get_oi_change_matrix(symbols, seconds, current_values):
+    """
+    Изменения OI в процентах для набора символов и интервалов за один проход.
+    
+    Returns:
+        numpy.ndarray: матрица len(symbols) x len(seconds)
+    """
+    rings = [get_history(symbol) for symbol in symbols]
+    return change_matrix(rings, seconds, monotonic_time(), current_values)
@@ -0,0 +1,324 @@
+"""
+Выгрузка истории OI для офлайн-анализа: поток колоночных данных вместо
+тысяч запросов /tv_data (/export и CLI).
+
+Источники:
+    - journal: журнал тиков (tick_journal) - каждый тик за день; файлы
+      читаются через mmap кусками по CHUNK_ROWS записей;
+    - cache: кольцевые буферы истории oi_cache - только изменения OI, тики
+      чаще OI_HISTORY_RESOLUTION секунд схлопнуты (работает и без журнала).
+
+Строки идут генератором кусков (код символа, время, OI), поэтому память
+ограничена размером куска независимо от числа инструментов и длины
+диапазона. Форматы:
+    - npz: один структурированный массив "ticks" (symbol, ts, oi), который
+      пишется в zip потоком; длина массива известна заранее из первого
+      (подсчитывающего) прохода по источнику. Если источник сократился между
+      проходами, хвост массива заполняется пустыми строками (NaT, пустой
+      символ), и их число записывается в член "padding" (0 - хвоста нет).
+        data = np.load("oi.npz")
+        pd.DataFrame(data["ticks"][:len(data["ticks"]) - int(data["padding"])])
+    - arrow: поток Arrow IPC, по пачке на кусок (нужен pyarrow).
+        pyarrow.ipc.open_stream(open("oi.arrow", "rb")).read_pandas()
+
+Запуск:
+    python oi_export.py --symbols NIFTY,BANKNIFTY --start 2026-10-16 --output oi.npz
+    python oi_export.py --source cache --format arrow --output oi.arrow
+"""
+import argparse
+import os
+import sys
+import time
+import zipfile
+from datetime import datetime, timedelta
+import logging
+
+import numpy as np
+
+import oi_cache
+import tick_journal
+from instrument_registry import get_registry
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+CHUNK_ROWS = int(os.environ.get("OI_EXPORT_CHUNK_ROWS", 65536))
+SOURCES = ("journal", "cache")
+FORMATS = ("npz", "arrow")
+
+CONTENT_TYPES = {
+    "npz": "application/zip",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+def parse_time(value, default=None):
+    """Время из параметра: UNIX-секунды или ISO 8601 (без зоны - местное время)"""
+    if value is None or value == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def _days(start, end):
+    """Дни журнала (YYYYMMDD) от start до end по местному времени"""
+    day = datetime.fromtimestamp(start).date()
+    last = datetime.fromtimestamp(end).date()
+    while day <= last:
+        yield day.strftime('%Y%m%d')
+        day += timedelta(days=1)
+
+
+def journal_chunks(symbols, start, end, directory=None):
+    """
+    Куски тиков из журнала за [start, end].
+
+    Yields:
+        tuple: (коды символов int32, время в нс int64, OI int64)
+    """
+    by_symbol = {symbol: code for code, symbol in enumerate(symbols)}
+    instruments = sorted(((segment << 32) | security_id, by_symbol[symbol])
+                         for (segment, security_id), symbol in get_registry().by_instrument.items()
+                         if symbol in by_symbol)
+    if not instruments:
+        return
+    keys = np.array([key for key, _ in instruments], dtype=np.uint64)
+    codes = np.array([code for _, code in instruments], dtype=np.int32)
+    start_ns, end_ns = np.int64(start * 1e9), np.int64(end * 1e9)
+    for day in _days(start, end):
+        for path in tick_journal.segment_files(day, directory):
+            try:
+                records = tick_journal.read_segment(path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Пропущен файл журнала {path}: {e}")
+                continue
+            for offset in range(0, len(records), CHUNK_ROWS):
+                part = records[offset:offset + CHUNK_ROWS]
+                ts = part['ts']
+                record_keys = (part['segment'].astype(np.uint64) << np.uint64(32)) | part['security_id']
+                pos = np.minimum(np.searchsorted(keys, record_keys), len(keys) - 1)
+                mask = (keys[pos] == record_keys) & (ts >= start_ns) & (ts <= end_ns)
+                if mask.any():
+                    yield codes[pos[mask]], ts[mask], part['oi'][mask]
+
+
+def cache_chunks(symbols, start, end):
+    """Куски отсчётов из истории oi_cache за [start, end] (по символу за кусок)"""
+    # История ведётся по монотонным часам: переводим в UNIX-время
+    offset = oi_cache.wall_time() - oi_cache.monotonic_time()
+    for code, symbol in enumerate(symbols):
+        ring = oi_cache.get_history(symbol)
+        if ring is None or not len(ring):
+            continue
+        ts, oi = ring.ordered()
+        ts = ts + offset
+        mask = (ts >= start) & (ts <= end)
+        if not mask.any():
+            continue
+        ts = (ts[mask] * 1e9).astype(np.int64)
+        oi = oi[mask]
+        for part in range(0, len(ts), CHUNK_ROWS):
+            n = len(ts[part:part + CHUNK_ROWS])
+            yield np.full(n, code, dtype=np.int32), ts[part:part + CHUNK_ROWS], oi[part:part + CHUNK_ROWS]
+
+
+class _Sink:
+    """Файлоподобный буфер: zipfile или Arrow пишут в него, генератор забирает байты"""
+
+    closed = False
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+class Export:
+    """Выгрузка: символы, диапазон, источник и формат; stream() отдаёт байты"""
+
+    def __init__(self, symbols, start, end, source="journal", fmt="npz", directory=None):
+        self.symbols = list(symbols)
+        self.start = start
+        self.end = end
+        self.source = source
+        self.format = fmt
+        self.directory = directory
+        self.rows = 0
+        self.padded = 0  # пустые строки в конце массива npz
+
+    @property
+    def content_type(self):
+        return CONTENT_TYPES[self.format]
+
+    @property
+    def filename(self):
+        day = datetime.fromtimestamp(self.start).strftime('%Y%m%d')
+        return f"oi-{day}.{self.format}"
+
+    def chunks(self):
+        if self.source == "journal":
+            return journal_chunks(self.symbols, self.start, self.end, self.directory)
+        return cache_chunks(self.symbols, self.start, self.end)
+
+    def stream(self):
+        started = time.perf_counter()
+        if self.format == "arrow":
+            yield from self._stream_arrow()
+        else:
+            yield from self._stream_npz()
+        logger.info(f"Выгрузка OI: {self.rows} строк по {len(self.symbols)} символам ({self.source}, "
+                    f"{self.format}) за {time.perf_counter() - started:.2f} сек")
+        if self.padded:
+            logger.warning(f"Выгрузка OI: источник сократился на {self.padded} строк, "
+                           f"они заполнены пустыми значениями")
+
+    def _stream_npz(self):
+        # Первый проход только считает строки: заголовок .npy содержит длину массива
+        total = sum(len(codes) for codes, _, _ in self.chunks())
+        width = max((len(symbol) for symbol in self.symbols), default=1)
+        dtype = np.dtype([('symbol', f'U{width}'), ('ts', 'M8[ns]'), ('oi', '<i8')])
+        names = np.array(self.symbols, dtype=f'U{width}')
+        sink = _Sink()
+        with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            with archive.open("ticks.npy", mode='w', force_zip64=True) as member:
+                np.lib.format.write_array_header_1_0(member, {
+                    'descr': np.lib.format.dtype_to_descr(dtype),
+                    'fortran_order': False,
+                    'shape': (total,),
+                })
+                written = 0
+                for codes, ts, oi in self.chunks():
+                    # Журнал текущего дня мог вырасти после подсчёта
+                    codes, ts, oi = codes[:total - written], ts[:total - written], oi[:total - written]
+                    rows = np.empty(len(codes), dtype=dtype)
+                    rows['symbol'] = names[codes]
+                    rows['ts'] = ts
+                    rows['oi'] = oi
+                    member.write(rows.tobytes())
+                    written += len(rows)
+                    yield sink.drain()
+                    if written >= total:
+                        break
+                self.rows = written
+                self.padded = total - written
+                if self.padded:
+                    # История кэша могла вытеснить старые отсчёты между проходами:
+                    # длина в заголовке уже отдана, хвост заполняется пустыми строками
+                    padding = np.zeros(self.padded, dtype=dtype)
+                    padding['ts'] = np.datetime64('NaT')
+                    member.write(padding.tobytes())
+            # Число пустых строк известно только в конце - отдельным членом после данных
+            with archive.open("padding.npy", mode='w') as member:
+                np.lib.format.write_array(member, np.array(self.padded, dtype=np.int64))
+        yield sink.drain()
+
+    def _stream_arrow(self):
+        schema = pyarrow.schema([
+            ('symbol', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+            ('ts', pyarrow.timestamp('ns', tz='UTC')),
+            ('oi', pyarrow.int64()),
+        ])
+        names = pyarrow.array(self.symbols, type=pyarrow.string())
+        sink = _Sink()
+        with pyarrow.ipc.new_stream(sink, schema) as writer:
+            for codes, ts, oi in self.chunks():
+                writer.write_batch(pyarrow.record_batch([
+                    pyarrow.DictionaryArray.from_arrays(pyarrow.array(codes, type=pyarrow.int32()), names),
+                    pyarrow.array(ts, type=pyarrow.timestamp('ns', tz='UTC')),
+                    pyarrow.array(oi, type=pyarrow.int64()),
+                ], schema=schema))
+                self.rows += len(codes)
+                yield sink.drain()
+        yield sink.drain()
+
+
+def build_export(symbols=None, start=None, end=None, source=None, fmt=None):
+    """
+    Формирует выгрузку для /export: (Export, 200) или (payload ошибки, status).
+
+    Args:
+        symbols: список символов; None - все настроенные тикеры
+        start, end: границы диапазона (UNIX-секунды или ISO 8601);
+            по умолчанию - с начала текущего дня до текущего момента
+        source: "journal" или "cache"; по умолчанию журнал, если он включён
+        fmt: "npz" (по умолчанию) или "arrow"
+    """
+    fmt = fmt or "npz"
+    if fmt not in FORMATS:
+        return {"error": f"format must be one of {', '.join(FORMATS)}", "status": "error"}, 400
+    if fmt == "arrow" and pyarrow is None:
+        return {"error": "Arrow export requires pyarrow", "status": "error"}, 501
+    source = source or ("journal" if tick_journal.JOURNAL_ENABLED else "cache")
+    if source not in SOURCES:
+        return {"error": f"source must be one of {', '.join(SOURCES)}", "status": "error"}, 400
+    now = oi_cache.wall_time()
+    midnight = datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    try:
+        start = parse_time(start, midnight)
+        end = parse_time(end, now)
+    except ValueError:
+        return {"error": "start and end must be UNIX seconds or ISO 8601", "status": "error"}, 400
+    if end < start:
+        return {"error": "end must not be earlier than start", "status": "error"}, 400
+    registry = get_registry()
+    registry.maybe_reload()
+    if symbols is None:
+        symbols = list(registry.by_symbol)
+    if not symbols:
+        return {"error": "No symbols to export", "status": "error"}, 400
+    if not any(symbol in registry.by_symbol for symbol in symbols):
+        return {"error": f"Unknown symbols: {', '.join(symbols)}", "status": "error"}, 400
+    return Export(symbols, start, end, source, fmt), 200
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка истории OI в колоночном формате")
+    parser.add_argument("--symbols", help="символы через запятую (по умолчанию все)")
+    parser.add_argument("--start", help="начало: UNIX-секунды или ISO 8601 (по умолчанию начало дня)")
+    parser.add_argument("--end", help="конец (по умолчанию сейчас)")
+    parser.add_argument("--source", choices=SOURCES, default="journal")
+    parser.add_argument("--format", choices=FORMATS, default="npz")
+    parser.add_argument("--journal-dir", help="каталог журнала тиков")
+    parser.add_argument("--output", help="файл (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s [%(levelname)s] %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    symbols = [s.strip() for s in args.symbols.split(",") if s.strip()] if args.symbols else None
+    export, status = build_export(symbols, args.start, args.end, args.source, args.format)
+    if status != 200:
+        logger.error(export["error"])
+        return 1
+    export.directory = args.journal_dir
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for data in export.stream():
+            out.write(data)
+    finally:
+        if args.output:
+            out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,203 @@
+"""
+Индекс свежести данных OI: какие символы свежие, какие устарели, по каким
+данных нет вовсе.
+
+Индекс обновляется по мере прихода тиков (слушатель oi_cache), а не при
+каждом запросе. Свежие символы лежат в куче сроков (время последнего тика +
+MAX_AGE_SECONDS); фоновый поток спит до ближайшего срока и переводит
+просроченные символы в устаревшие. Поэтому счётчики fresh/stale/missing
+всегда готовы и /health отвечает за O(1), а переходы символа в устаревшие и
+обратно вызывают слушателей и пишутся в лог.
+"""
+import heapq
+import threading
+import logging
+
+import oi_cache
+from metrics import Gauge
+from instrument_registry import get_registry
+
+logger = logging.getLogger(__name__)
+
+FRESH = "fresh"
+STALE = "stale"
+MISSING = "missing"
+
+# Сколько символов перечислять в сообщении о массовом устаревании
+LOG_SYMBOLS = 10
+
+
+class FreshnessIndex:
+    """Состояние свежести по символам и счётчики по состояниям"""
+
+    def __init__(self, max_age=oi_cache.MAX_AGE_SECONDS):
+        self.max_age = max_age
+        self.last_tick = {}  # символ -> монотонное время последнего тика
+        self.states = {}  # символ -> FRESH / STALE (символы с данными)
+        self.tracked = frozenset()
+        self.fresh = 0
+        self.stale = 0
+        self.listeners = []
+        self._heap = []  # (срок свежести, символ) для свежих символов
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._sweeper = None
+        self._registry_version = None
+
+    def add_listener(self, callback):
+        """Регистрирует функцию (символ, прежнее состояние, новое состояние)"""
+        self.listeners.append(callback)
+
+    def _notify(self, changes):
+        for symbol, old, new in changes:
+            for callback in self.listeners:
+                try:
+                    callback(symbol, old, new)
+                except Exception as e:
+                    logger.error(f"Ошибка в слушателе свежести OI: {e}")
+
+    def _set_fresh(self, symbol, now):
+        """Переводит символ в свежие (под блокировкой); возвращает прежнее состояние"""
+        old = self.states.get(symbol, MISSING)
+        if old is FRESH:
+            return old
+        self.states[symbol] = FRESH
+        self.fresh += 1
+        if old is STALE:
+            self.stale -= 1
+        elif symbol not in self.tracked:
+            self.tracked = self.tracked | {symbol}
+        heapq.heappush(self._heap, (now + self.max_age, symbol))
+        self._start_sweeper()
+        return old
+
+    def touch(self, symbol, tick_time):
+        """Учитывает тик символа (tick_time - по монотонным часам oi_cache)"""
+        self.last_tick[symbol] = tick_time
+        # Горячий путь: свежий символ остаётся свежим без блокировки, его
+        # срок продлевает поток сборки, когда достанет запись из кучи
+        if self.states.get(symbol) is FRESH:
+            return
+        with self._lock:
+            tick_time = self.last_tick[symbol]
+            if oi_cache.monotonic_time() - tick_time > self.max_age:
+                # Восстановленные старые данные: символ есть, но устарел
+                old = self.states.get(symbol, MISSING)
+                if old is not MISSING:
+                    return
+                self.states[symbol] = STALE
+                self.stale += 1
+                self.tracked = self.tracked | {symbol}
+                new = STALE
+            else:
+                old = self._set_fresh(symbol, tick_time)
+                new = FRESH
+        if old is STALE:
+            logger.info(f"Данные OI для {symbol} снова актуальны")
+        self._notify([(symbol, old, new)])
+
+    def on_update(self, symbol, value, updated_at):
+        """Слушатель oi_cache"""
+        self.touch(symbol, oi_cache.monotonic_time())
+
+    def on_restore(self, symbol, timestamps, values):
+        age = oi_cache.get_oi_age(symbol)
+        if age is not None:
+            self.touch(symbol, oi_cache.monotonic_time() - age)
+
+    def sweep(self, now=None):
+        """Переводит в устаревшие символы с истёкшим сроком; возвращает ближайший срок"""
+        now = oi_cache.monotonic_time() if now is None else now
+        expired = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                _, symbol = heapq.heappop(heap)
+                last = self.last_tick[symbol]
+                if now - last <= self.max_age:
+                    # Тики шли - срок просто продлевается
+                    heapq.heappush(heap, (last + self.max_age, symbol))
+                    continue
+                self.states[symbol] = STALE
+                # Тик мог прийти, пока символ переводился: тогда он снова свежий
+                if self.last_tick[symbol] != last:
+                    self.states[symbol] = FRESH
+                    heapq.heappush(heap, (self.last_tick[symbol] + self.max_age, symbol))
+                    continue
+                self.fresh -= 1
+                self.stale += 1
+                expired.append(symbol)
+            deadline = heap[0][0] if heap else None
+        if expired:
+            listed = ", ".join(expired[:LOG_SYMBOLS])
+            more = " ..." if len(expired) > LOG_SYMBOLS else ""
+            logger.warning(f"Данные OI устарели ({len(expired)}): {listed}{more}")
+            self._notify([(symbol, FRESH, STALE) for symbol in expired])
+        return deadline
+
+    def _start_sweeper(self):
+        if self._sweeper is not None and self._sweeper.is_alive():
+            return
+        self._sweeper = threading.Thread(target=self._run, name="oi-freshness")
+        self._sweeper.daemon = True
+        self._sweeper.start()
+
+    def _run(self):
+        while True:
+            deadline = self.sweep()
+            # Новые сроки всегда позже имеющихся, поэтому спим до ближайшего
+            timeout = self.max_age if deadline is None else deadline - oi_cache.monotonic_time()
+            if self._wakeup.wait(max(timeout, 0.01)):
+                break
+
+    def sync_tracked(self):
+        """
+        Подтягивает настроенные тикеры из реестра инструментов (только при
+        изменении реестра). Символы, по которым в кэше уже есть данные, а
+        тиков индекс ещё не видел (например, воркер подключился к
+        разделяемой памяти позже фида), учитываются по их возрасту.
+        """
+        registry = get_registry()
+        registry.maybe_reload()
+        if registry.version == self._registry_version:
+            return
+        self._registry_version = registry.version
+        symbols = list(registry.by_symbol)
+        with self._lock:
+            self.tracked = self.tracked | frozenset(symbols)
+        for symbol in symbols:
+            if symbol not in self.last_tick:
+                state = oi_cache.get_state(symbol, count=False)
+                if state is not None:
+                    self.touch(symbol, oi_cache.monotonic_time() - state[2])
+
+    def state(self, symbol):
+        return self.states.get(symbol, MISSING)
+
+    def age(self, symbol, now=None):
+        """Возраст последнего тика символа в секундах или None"""
+        last = self.last_tick.get(symbol)
+        if last is None:
+            return None
+        return (oi_cache.monotonic_time() if now is None else now) - last
+
+    def summary(self):
+        """Счётчики по состояниям за O(1)"""
+        self.sync_tracked()
+        # Между пробуждениями потока сборки сроки могли истечь
+        if self._heap and self._heap[0][0] <= oi_cache.monotonic_time():
+            self.sweep()
+        fresh, stale, total = self.fresh, self.stale, len(self.tracked)
+        return {FRESH: fresh, STALE: stale, MISSING: max(total - fresh - stale, 0), "total": total}
+
+    def stop(self):
+        self._wakeup.set()
+
+
+index = FreshnessIndex()
+oi_cache.add_listener(index.on_update)
+oi_cache.add_restore_listener(index.on_restore)
+
+SYMBOLS_BY_STATE = Gauge("oi_symbols", "Configured symbols by OI data freshness", ("state",),
+                         collect=lambda: {(state,): count for state, count in index.summary().items()
+                                          if state != "total"})
@@ -0,0 +1,186 @@
+"""
+История OI по символу: кольцевой буфер фиксированной ёмкости из пар
+(монотонное время, OI) в массивах NumPy.
+
+Буфер пополняется на каждом тике, поэтому изменение OI за любые последние
+N секунд считается бинарным поиском за O(log n) и не зависит от того,
+когда приходили запросы. Хранятся только изменения значения, а тики внутри
+одного окна HISTORY_RESOLUTION секунд (окна отсчитываются от нуля часов)
+схлопываются в последний из них - с его значением и временем. Правило одно
+для append и load, поэтому буфер, восстановленный из журнала, совпадает с
+накопленным по живым тикам.
+"""
+import os
+
+import numpy as np
+
+HISTORY_CAPACITY = int(os.environ.get("OI_HISTORY_CAPACITY", 4096))
+HISTORY_RESOLUTION = float(os.environ.get("OI_HISTORY_RESOLUTION", 5.0))
+
+TS_DTYPE = np.float64
+OI_DTYPE = np.int64
+# meta[0] - индекс следующей записи, meta[1] - число отсчётов
+META_DTYPE = np.int64
+
+
+class OIRing:
+    """
+    Кольцевой буфер отсчётов OI одного символа.
+
+    Массивы могут принадлежать самому буферу или быть представлениями
+    поверх разделяемой памяти (см. oi_shm).
+    """
+
+    __slots__ = ("ts", "oi", "meta", "capacity", "resolution")
+
+    def __init__(self, capacity=HISTORY_CAPACITY, resolution=HISTORY_RESOLUTION,
+                 ts=None, oi=None, meta=None):
+        self.capacity = capacity
+        self.resolution = resolution
+        self.ts = ts if ts is not None else np.zeros(capacity, dtype=TS_DTYPE)
+        self.oi = oi if oi is not None else np.zeros(capacity, dtype=OI_DTYPE)
+        self.meta = meta if meta is not None else np.zeros(2, dtype=META_DTYPE)
+
+    def __len__(self):
+        return int(self.meta[1])
+
+    def _window(self, timestamp):
+        return timestamp // self.resolution
+
+    def append(self, timestamp, value):
+        head, count = int(self.meta[0]), int(self.meta[1])
+        if count:
+            last = head - 1 if head else self.capacity - 1
+            if self.oi[last] == value:
+                return
+            if self.resolution > 0 and self._window(timestamp) == self._window(self.ts[last]):
+                # Частые тики схлопываются в последний отсчёт окна
+                self.ts[last] = timestamp
+                self.oi[last] = value
+                return
+        self.ts[head] = timestamp
+        self.oi[head] = value
+        self.meta[0] = (head + 1) % self.capacity
+        if count < self.capacity:
+            self.meta[1] = count + 1
+
+    def load(self, timestamps, values):
+        """
+        Заполняет буфер готовой историей (например, из журнала тиков).
+
+        Повторяющиеся значения отбрасываются, а отсчёты внутри одного окна
+        HISTORY_RESOLUTION схлопываются в последний (его время и значение),
+        как и при append.
+        """
+        timestamps = np.asarray(timestamps, dtype=TS_DTYPE)
+        values = np.asarray(values, dtype=OI_DTYPE)
+        if len(values):
+            changed = np.concatenate(([True], values[1:] != values[:-1]))
+            timestamps, values = timestamps[changed], values[changed]
+        if len(values) and self.resolution > 0:
+            windows = self._window(timestamps)
+            last = np.concatenate((windows[1:] != windows[:-1], [True]))
+            timestamps, values = timestamps[last], values[last]
+        timestamps, values = timestamps[-self.capacity:], values[-self.capacity:]
+        count = len(values)
+        self.ts[:count] = timestamps
+        self.oi[:count] = values
+        self.meta[0] = count % self.capacity
+        self.meta[1] = count
+
+    def latest(self):
+        """Возвращает последний отсчёт (время, OI) или None"""
+        head, count = int(self.meta[0]), int(self.meta[1])
+        if not count:
+            return None
+        last = head - 1 if head else self.capacity - 1
+        return float(self.ts[last]), int(self.oi[last])
+
+    def _index_at(self, timestamp, head, count):
+        """Физический индекс последнего отсчёта с временем <= timestamp (или старейшего)"""
+        if count < self.capacity:
+            idx = int(np.searchsorted(self.ts[:count], timestamp, side='right')) - 1
+            return max(idx, 0)
+        # Буфер заполнен: ts[head:] - старая часть, ts[:head] - новая
+        if head and timestamp >= self.ts[0]:
+            return int(np.searchsorted(self.ts[:head], timestamp, side='right')) - 1
+        idx = head + int(np.searchsorted(self.ts[head:], timestamp, side='right')) - 1
+        return max(idx, head)
+
+    def value_at(self, timestamp):
+        """
+        Возвращает OI на момент timestamp. Если история короче запрошенного
+        окна, возвращается самый старый отсчёт.
+        """
+        head, count = int(self.meta[0]), int(self.meta[1])
+        if not count:
+            return None
+        return int(self.oi[self._index_at(timestamp, head, count)])
+
+    def values_at(self, timestamps):
+        """Векторный вариант value_at для массива моментов времени"""
+        head, count = int(self.meta[0]), int(self.meta[1])
+        timestamps = np.asarray(timestamps, dtype=TS_DTYPE)
+        if not count:
+            return None
+        if count < self.capacity:
+            idx = np.searchsorted(self.ts[:count], timestamps, side='right') - 1
+            return self.oi[np.maximum(idx, 0)]
+        idx = head + np.searchsorted(self.ts[head:], timestamps, side='right') - 1
+        idx = np.maximum(idx, head)
+        if head:
+            newer = timestamps >= self.ts[0]
+            idx = np.where(newer, np.searchsorted(self.ts[:head], timestamps, side='right') - 1, idx)
+        return self.oi[idx]
+
+    def ordered(self):
+        """Возвращает копии массивов (время, OI) в хронологическом порядке"""
+        head, count = int(self.meta[0]), int(self.meta[1])
+        if count < self.capacity:
+            return self.ts[:count].copy(), self.oi[:count].copy()
+        return (np.concatenate((self.ts[head:], self.ts[:head])),
+                np.concatenate((self.oi[head:], self.oi[:head])))
+
+
+def change_pct(old_oi, current_oi):
+    """Изменение OI в процентах (0, если базового значения нет)"""
+    return ((current_oi - old_oi) / old_oi * 100) if old_oi else 0.0
+
+
+def oi_change(ring, seconds, now, current_oi=None):
+    """
+    Изменение OI за последние seconds секунд.
+
+    Returns:
+        tuple: (OI в начале окна, текущий OI, изменение в процентах) или None
+    """
+    if ring is None or not len(ring):
+        return None
+    if current_oi is None:
+        current_oi = ring.latest()[1]
+    old_oi = ring.value_at(now - seconds)
+    return old_oi, current_oi, change_pct(old_oi, current_oi)
+
+
+def change_matrix(rings, seconds, now, current_values):
+    """
+    Матрица изменений OI в процентах: строки - символы, столбцы - интервалы.
+
+    Args:
+        rings: список буферов истории (None для символов без истории)
+        seconds: длительности интервалов в секундах
+        now: текущее монотонное время
+        current_values: текущий OI по каждому символу
+
+    Returns:
+        numpy.ndarray: матрица размера len(rings) x len(seconds)
+    """
+    cutoffs = now - np.asarray(seconds, dtype=TS_DTYPE)
+    current = np.asarray(current_values, dtype=np.float64).reshape(-1, 1)
+    old = np.array(current, dtype=np.float64).repeat(len(cutoffs), axis=1)
+    for row, ring in enumerate(rings):
+        if ring is not None and len(ring):
+            old[row] = ring.values_at(cutoffs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct = np.where(old != 0, (current - old) / old * 100, 0.0)
+    return pct
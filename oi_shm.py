@@ -0,0 +1,303 @@
+"""
+Хранилище OI в разделяемой памяти (mmap-файл в /dev/shm).
+
+Один процесс фида пишет значения, воркеры gunicorn читают их без копирования
+и без собственных подключений к Dhan. Файл состоит из заголовка, каталога
+символов (по слоту на инструмент) и таблицы записей фиксированного размера.
+Имя символа в каталоге - до SYMBOL_SIZE байт UTF-8; более длинные символы
+не хранятся (ошибка в журнале), чтобы обрезанные имена не совпадали.
+
+Каждая запись защищена счётчиком seq (seqlock): писатель делает его нечётным
+на время записи, читатель повторяет чтение, пока не увидит одно и то же
+чётное значение до и после.
+
+За таблицей записей лежат кольцевые буферы истории OI (oi_history.OIRing)
+по одному на слот: воркеры считают изменения OI по той же истории, что
+накапливает процесс фида.
+
+В заголовке процесс фида раз в HEARTBEAT_INTERVAL секунд отмечает, что он
+жив (pid и монотонное время). Перезапущенный процесс фида создаёт новый файл
+и подменяет старый (os.replace), поэтому читатель сверяет inode пути со своим
+отображением и подключается заново, когда файл сменился.
+"""
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import logging
+
+import numpy as np
+
+from metrics import log_every
+from oi_history import OIRing, HISTORY_CAPACITY, TS_DTYPE, OI_DTYPE, META_DTYPE
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'DHANOI\x00\x00'
+LAYOUT_VERSION = 5
+
+DEFAULT_SLOTS = int(os.environ.get("OI_SHM_SLOTS", 4096))
+_SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+DEFAULT_PATH = os.environ.get("OI_SHM_PATH", os.path.join(_SHM_DIR, 'dhan_oi.bin'))
+
+# Как часто процесс фида отмечает в заголовке, что он жив
+HEARTBEAT_INTERVAL = 1.0
+# Сколько раз читатель записи повторяет чтение, пока писатель посреди записи
+READ_RETRIES = 10000
+
+# magic, версия, число слотов, занятые слоты, длина имени символа, ёмкость истории,
+# pid писателя, монотонное время последней отметки писателя, поколение файла
+HEADER = struct.Struct('<8sIIIIIIdQ')
+SYMBOL_SIZE = 32
+# seq, значение OI, время обновления (UNIX), время обновления (монотонное), число обновлений
+RECORD = struct.Struct('<I4xqddQ')
+# Смещение счётчика обновлений внутри записи
+_UPDATES_OFFSET = RECORD.size - 8
+# Смещения полей "занятые слоты" и "pid писателя, отметка" в заголовке
+_USED_OFFSET = 16
+_WRITER_OFFSET = 28
+_WRITER = struct.Struct('<Id')
+
+
+class SharedOIStore:
+    """Таблица OI с фиксированными слотами поверх mmap"""
+
+    def __init__(self, path, buf, slot_count, history_capacity, writable, inode=None):
+        self.path = path
+        self.inode = inode
+        # Случайное число нового файла: счётчики обновлений после перезапуска
+        # процесса фида начинаются заново, версии данных различаются поколением
+        self.generation = HEADER.unpack_from(buf, 0)[-1]
+        self.buf = buf
+        self.slot_count = slot_count
+        self.history_capacity = history_capacity
+        self.writable = writable
+        self.slots = {}  # символ -> номер слота
+        self._used = 0
+        self._directory_offset = HEADER.size
+        self._records_offset = HEADER.size + slot_count * SYMBOL_SIZE
+        self._lock = threading.Lock()
+
+        # Массивы истории - представления NumPy прямо поверх mmap
+        offset = self._records_offset + slot_count * RECORD.size
+        self._meta = np.frombuffer(buf, dtype=META_DTYPE, count=slot_count * 2,
+                                   offset=offset).reshape(slot_count, 2)
+        offset += self._meta.nbytes
+        self._ts = np.frombuffer(buf, dtype=TS_DTYPE, count=slot_count * history_capacity,
+                                 offset=offset).reshape(slot_count, history_capacity)
+        offset += self._ts.nbytes
+        self._oi = np.frombuffer(buf, dtype=OI_DTYPE, count=slot_count * history_capacity,
+                                 offset=offset).reshape(slot_count, history_capacity)
+        # Счётчики обновлений всех слотов одним представлением - для поиска изменений
+        self._updates = np.ndarray((slot_count,), dtype='<u8', buffer=buf,
+                                   offset=self._records_offset + _UPDATES_OFFSET, strides=(RECORD.size,))
+        self._rings = {}
+        self._by_slot = {}
+        self._refresh_directory()
+
+    @staticmethod
+    def file_size(slot_count, history_capacity):
+        return (HEADER.size + slot_count * (SYMBOL_SIZE + RECORD.size)
+                + slot_count * 2 * np.dtype(META_DTYPE).itemsize
+                + slot_count * history_capacity * (np.dtype(TS_DTYPE).itemsize + np.dtype(OI_DTYPE).itemsize))
+
+    @classmethod
+    def create(cls, path=DEFAULT_PATH, slot_count=DEFAULT_SLOTS, history_capacity=HISTORY_CAPACITY):
+        """Создаёт (или пересоздаёт) файл хранилища для процесса-писателя"""
+        size = cls.file_size(slot_count, history_capacity)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, LAYOUT_VERSION, slot_count, 0, SYMBOL_SIZE, history_capacity,
+                                os.getpid(), time.monotonic(), int.from_bytes(os.urandom(8), 'little')))
+            # Разреженный файл: страницы занимают память только после записи
+            f.truncate(size)
+        # Атомарная подмена: читатели старого файла не увидят полупустой заголовок
+        os.replace(tmp_path, path)
+        fd = os.open(path, os.O_RDWR)
+        try:
+            inode = os.fstat(fd).st_ino
+            buf = mmap.mmap(fd, size, access=mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+        logger.info(f"Создано хранилище OI в разделяемой памяти: {path} ({slot_count} слотов)")
+        return cls(path, buf, slot_count, history_capacity, writable=True, inode=inode)
+
+    @classmethod
+    def attach(cls, path=DEFAULT_PATH):
+        """Подключается к существующему хранилищу только для чтения"""
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            stat = os.fstat(fd)
+            size = stat.st_size
+            buf = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        if size < HEADER.size:
+            buf.close()
+            raise ValueError(f"Неподдерживаемый формат хранилища OI: {path}")
+        magic, version, slot_count, _, symbol_size, history_capacity, _, _, _ = HEADER.unpack_from(buf, 0)
+        if (magic != MAGIC or version != LAYOUT_VERSION or symbol_size != SYMBOL_SIZE
+                or size < cls.file_size(slot_count, history_capacity)):
+            buf.close()
+            raise ValueError(f"Неподдерживаемый формат хранилища OI: {path}")
+        return cls(path, buf, slot_count, history_capacity, writable=False, inode=stat.st_ino)
+
+    def is_current(self):
+        """Файл по пути - всё ещё тот, что отображён (писатель не пересоздал его)"""
+        try:
+            return os.stat(self.path).st_ino == self.inode
+        except OSError:
+            # Файла нет: писатель не запущен, новое хранилище ещё не создано
+            return True
+
+    def heartbeat(self):
+        """Отметка писателя: процесс фида жив"""
+        _WRITER.pack_into(self.buf, _WRITER_OFFSET, os.getpid(), time.monotonic())
+
+    def writer_state(self):
+        """
+        Returns:
+            tuple: (pid писателя, секунд с его последней отметки)
+        """
+        pid, heartbeat = _WRITER.unpack_from(self.buf, _WRITER_OFFSET)
+        return pid, time.monotonic() - heartbeat
+
+    def _refresh_directory(self):
+        """Дочитывает каталог символов, если писатель занял новые слоты"""
+        used = struct.unpack_from('<I', self.buf, _USED_OFFSET)[0]
+        if used == self._used:
+            return
+        slots = dict(self.slots)
+        for slot in range(self._used, used):
+            offset = self._directory_offset + slot * SYMBOL_SIZE
+            name = bytes(self.buf[offset:offset + SYMBOL_SIZE]).rstrip(b'\x00')
+            if name:
+                slots[name.decode('utf-8')] = slot
+        self.slots = slots
+        self._used = used
+
+    def slot_for(self, symbol, create=False):
+        """Возвращает номер слота символа; писатель может занять новый слот"""
+        slot = self.slots.get(symbol)
+        if slot is not None:
+            return slot
+        if not self.writable:
+            self._refresh_directory()
+            return self.slots.get(symbol)
+        if not create:
+            return None
+
+        with self._lock:
+            slot = self.slots.get(symbol)
+            if slot is not None:
+                return slot
+            if self._used >= self.slot_count:
+                logger.error(f"В хранилище OI нет свободных слотов для {symbol}")
+                return None
+            name = symbol.encode('utf-8')
+            if len(name) > SYMBOL_SIZE:
+                # Обрезанное имя совпало бы с другим символом того же префикса
+                log_every(("shm_symbol_size", symbol), f"Символ {symbol} длиннее {SYMBOL_SIZE} байт "
+                          f"и не хранится в разделяемой памяти", level=logging.ERROR, logger=logger)
+                return None
+            slot = self._used
+            offset = self._directory_offset + slot * SYMBOL_SIZE
+            self.buf[offset:offset + len(name)] = name
+            # Счётчик занятых слотов публикуется после имени символа
+            self._used += 1
+            struct.pack_into('<I', self.buf, _USED_OFFSET, self._used)
+            self.slots = {**self.slots, symbol: slot}
+            return slot
+
+    def ring(self, slot):
+        """Кольцевой буфер истории слота (представление поверх mmap)"""
+        ring = self._rings.get(slot)
+        if ring is None:
+            ring = OIRing(self.history_capacity, ts=self._ts[slot], oi=self._oi[slot],
+                          meta=self._meta[slot])
+            self._rings[slot] = ring
+        return ring
+
+    def history(self, symbol):
+        slot = self.slot_for(symbol)
+        return self.ring(slot) if slot is not None else None
+
+    def write(self, symbol, value, timestamp, monotonic, append_history=True):
+        """
+        Записывает значение символа.
+
+        Args:
+            timestamp: время обновления по UNIX-часам
+            monotonic: время обновления по монотонным часам (CLOCK_MONOTONIC
+                общие для всех процессов машины) - по нему считается возраст
+            append_history: добавить отсчёт в историю символа
+        """
+        slot = self.slot_for(symbol, create=True)
+        if slot is None:
+            return
+        offset = self._records_offset + slot * RECORD.size
+        seq, _, _, _, updates = RECORD.unpack_from(self.buf, offset)
+        # Нечётный seq - запись в процессе
+        struct.pack_into('<I', self.buf, offset, (seq + 1) & 0xFFFFFFFF)
+        RECORD.pack_into(self.buf, offset, (seq + 1) & 0xFFFFFFFF, value, timestamp, monotonic, updates + 1)
+        if append_history:
+            self.ring(slot).append(monotonic, value)
+        struct.pack_into('<I', self.buf, offset, (seq + 2) & 0xFFFFFFFF)
+
+    def read(self, symbol):
+        """
+        Согласованно читает запись символа.
+
+        Returns:
+            tuple: (значение, время обновления, монотонное время обновления,
+                число обновлений) или None
+        """
+        slot = self.slot_for(symbol)
+        if slot is None:
+            return None
+        offset = self._records_offset + slot * RECORD.size
+        unpack = RECORD.unpack_from
+        for _ in range(READ_RETRIES):
+            seq, value, timestamp, monotonic, updates = unpack(self.buf, offset)
+            if seq & 1:
+                continue
+            if struct.unpack_from('<I', self.buf, offset)[0] == seq:
+                break
+        else:
+            # Писатель умер посреди записи: seq останется нечётным до пересоздания файла
+            log_every(("seqlock", self.path, slot), f"Запись OI {symbol} не стабилизировалась "
+                      f"за {READ_RETRIES} попыток чтения", level=logging.ERROR, logger=logger)
+        if updates == 0:
+            return None
+        return value, timestamp, monotonic, updates
+
+    def changes(self, previous=None):
+        """
+        Находит символы, обновлённые после снимка previous.
+
+        Returns:
+            tuple: (новый снимок счётчиков обновлений, список символов)
+        """
+        if not self.writable:
+            self._refresh_directory()
+        used = self._used
+        counts = self._updates[:used].copy()
+        known = len(previous) if previous is not None else 0
+        changed = np.flatnonzero(counts[:known] != previous) if known else np.empty(0, dtype=np.intp)
+        changed = np.concatenate((changed, known + np.flatnonzero(counts[known:])))
+        if len(self._by_slot) != len(self.slots):
+            self._by_slot = {slot: symbol for symbol, slot in self.slots.items()}
+        return counts, [self._by_slot[slot] for slot in changed.tolist() if slot in self._by_slot]
+
+    def symbols(self):
+        if not self.writable:
+            self._refresh_directory()
+        return list(self.slots)
+
+    def close(self):
+        # Представления NumPy держат экспорт буфера - отпускаем их до закрытия mmap
+        self._rings = {}
+        self._meta = self._ts = self._oi = self._updates = None
+        self.buf.close()
@@ -0,0 +1,209 @@
+"""
+Push-поток обновлений OI (Server-Sent Events).
+
+Один издатель в памяти получает тики из oi_cache и раздаёт их подписчикам.
+У каждого подписчика хранится только последнее значение по символу, поэтому
+медленный клиент пропускает промежуточные значения, а не копит очередь.
+Обновления отправляются пачками не чаще одного раза за окно (window),
+то есть не более одного обновления по символу за окно.
+
+В синхронном сервере (Flask под gunicorn gthread) каждый открытый /stream
+занимает поток воркера, поэтому одновременных потоков в процессе не больше
+OI_MAX_STREAMS (stream_slots); остальные клиенты получают 503. ASGI-режим
+держит потоки на одном цикле событий и этим пределом не ограничен.
+"""
+import asyncio
+import json
+import math
+import os
+import threading
+import time
+import logging
+
+import oi_cache
+from metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 1.0
+MIN_WINDOW = 0.1
+MAX_WINDOW = 60.0
+# Интервал комментария-пинга, чтобы прокси не закрывали соединение
+HEARTBEAT_INTERVAL = 15.0
+# Одновременных /stream на процесс синхронного сервера: при threads=8 в
+# gunicorn.conf.py половина потоков воркера остаётся обычным запросам
+MAX_STREAMS = int(os.environ.get("OI_MAX_STREAMS", 4))
+
+stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+
+def parse_window(value):
+    """Окно объединения из параметра запроса, ограниченное [MIN_WINDOW, MAX_WINDOW]"""
+    try:
+        window = float(value) if value is not None else DEFAULT_WINDOW
+    except ValueError:
+        window = DEFAULT_WINDOW
+    if math.isnan(window):
+        window = DEFAULT_WINDOW
+    return min(max(window, MIN_WINDOW), MAX_WINDOW)
+
+
+def parse_symbols(value):
+    """Список символов из параметра запроса; None означает все символы"""
+    if not value or value == "all":
+        return None
+    return [symbol.strip() for symbol in value.split(",") if symbol.strip()]
+
+
+class Subscription:
+    """Подписка одного клиента: последние значения по символам и окно объединения"""
+
+    def __init__(self, symbols=None, window=DEFAULT_WINDOW):
+        self.symbols = set(symbols) if symbols else None
+        self.window = window
+        self.dropped = 0
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._last_flush = 0.0
+        self._loop = None
+        self._event = None
+
+    def offer(self, symbol, value, updated_at):
+        with self._condition:
+            if symbol in self._pending:
+                # Клиент не успел забрать предыдущее значение - перескакиваем
+                self.dropped += 1
+            was_empty = not self._pending
+            self._pending[symbol] = (value, updated_at)
+            if was_empty:
+                self._condition.notify()
+                if self._loop is not None:
+                    self._loop.call_soon_threadsafe(self._event.set)
+
+    def _take(self):
+        with self._condition:
+            batch, self._pending = self._pending, {}
+            if self._event is not None:
+                self._event.clear()
+        self._last_flush = time.monotonic()
+        return batch
+
+    def next_batch(self, timeout=HEARTBEAT_INTERVAL):
+        """
+        Блокирующее ожидание следующей пачки обновлений.
+
+        Returns:
+            dict: символ -> (значение, время обновления); пустой по таймауту
+        """
+        with self._condition:
+            if not self._pending and not self._condition.wait(timeout):
+                return {}
+        delay = self.window - (time.monotonic() - self._last_flush)
+        if delay > 0:
+            time.sleep(delay)
+        return self._take()
+
+    async def next_batch_async(self, timeout=HEARTBEAT_INTERVAL):
+        """Асинхронный вариант next_batch для ASGI-режима"""
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._event = asyncio.Event()
+            if self._pending:
+                self._event.set()
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return {}
+        delay = self.window - (time.monotonic() - self._last_flush)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return self._take()
+
+
+class OIPublisher:
+    """Раздаёт тики подписчикам с индексом символ -> подписки"""
+
+    def __init__(self):
+        self._by_symbol = {}
+        self._wildcard = set()
+        self._lock = threading.Lock()
+        self._attached = False
+
+    def subscribe(self, symbols=None, window=DEFAULT_WINDOW):
+        subscription = Subscription(symbols, window)
+        with self._lock:
+            if subscription.symbols is None:
+                self._wildcard = self._wildcard | {subscription}
+            else:
+                for symbol in subscription.symbols:
+                    self._by_symbol[symbol] = self._by_symbol.get(symbol, frozenset()) | {subscription}
+            if not self._attached:
+                oi_cache.add_listener(self.publish)
+                self._attached = True
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._wildcard = self._wildcard - {subscription}
+            for symbol in subscription.symbols or ():
+                remaining = self._by_symbol.get(symbol, frozenset()) - {subscription}
+                if remaining:
+                    self._by_symbol[symbol] = remaining
+                else:
+                    self._by_symbol.pop(symbol, None)
+
+    def publish(self, symbol, value, updated_at):
+        """Слушатель oi_cache: вызывается на каждом тике"""
+        # Множества подписок неизменяемы и подменяются целиком - читаем без блокировки
+        for subscription in self._by_symbol.get(symbol, ()):
+            subscription.offer(symbol, value, updated_at)
+        for subscription in self._wildcard:
+            subscription.offer(symbol, value, updated_at)
+
+    def subscriber_count(self):
+        return len(self._wildcard) + len({s for subs in self._by_symbol.values() for s in subs})
+
+
+publisher = OIPublisher()
+
+STREAM_SUBSCRIBERS = Gauge("oi_stream_subscribers", "Open /stream subscriptions",
+                           collect=publisher.subscriber_count)
+
+
+def format_event(batch):
+    """Пачка обновлений в формате SSE"""
+    updates = [
+        {"symbol": symbol, "open_interest": value, "last_update": updated_at}
+        for symbol, (value, updated_at) in batch.items()
+    ]
+    return f"event: oi\ndata: {json.dumps({'updates': updates}, separators=(',', ':'))}\n\n"
+
+
+def snapshot_event(symbols):
+    """
+    Начальное событие с текущими значениями, чтобы клиенту не ждать тика.
+    Подписке на все символы (symbols=None) отдаётся снимок всех символов.
+    """
+    batch = {
+        symbol: (state[0], state[1])
+        for symbol, state in oi_cache.get_states(symbols).items()
+        if oi_cache.is_fresh(state)
+    }
+    return format_event(batch) if batch else None
+
+
+HEARTBEAT_EVENT = ": keepalive\n\n"
+
+
+def stream_events(symbols=None, window=DEFAULT_WINDOW):
+    """Генератор SSE-событий для синхронного сервера (Flask)"""
+    subscription = publisher.subscribe(symbols, window)
+    try:
+        initial = snapshot_event(symbols)
+        if initial:
+            yield initial
+        while True:
+            batch = subscription.next_batch()
+            yield format_event(batch) if batch else HEARTBEAT_EVENT
+    finally:
+        publisher.unsubscribe(subscription)
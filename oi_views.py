@@ -0,0 +1,83 @@
+"""
+Формирование ответов API, не зависящее от веб-фреймворка.
+
+Функции используются как Flask-приложением (app.py), так и ASGI-приложением
+(asgi_app.py), поэтому ответы обоих серверов совпадают байт в байт.
+"""
+from config import get_config
+import oi_cache
+from oi_cache import get_state, is_fresh
+from oi_freshness import index as freshness, FRESH
+
+
+def get_oi_tag(ticker):
+    """Версия данных для кэша ответа /get_oi (None - не кэшировать)"""
+    # Свежие данные кэшируются до следующего тика по символу
+    state = get_state(ticker, count=False)
+    return (oi_cache.generation(), state[3]) if is_fresh(state) else None
+
+def build_get_oi(ticker):
+    """Формирует ответ /get_oi: (payload, status)"""
+    # Значение и возраст - из одной записи, без второго чтения кэша
+    state = get_state(ticker)
+    if not is_fresh(state):
+        if state is not None:
+            return {
+                "error": f"OI data is stale (last update {int(state[2])} seconds ago)", 
+                "symbol": ticker,
+                "status": "error"
+            }, 503
+        else:
+            return {
+                "error": f"OI data not available for {ticker}",
+                "symbol": ticker,
+                "status": "error"
+            }, 404
+            
+    return {"symbol": ticker, "open_interest": state[0], "status": "success"}, 200
+
+def build_health(websocket_status):
+    """
+    Формирует ответ /health за O(1): готовые счётчики индекса свежести.
+    Воркер-читатель отвечает 503, если процесс фида перестал отмечаться.
+    """
+    payload = {
+        "status": "ok",
+        "websocket": websocket_status.get("connected", False),
+        "symbols": freshness.summary()
+    }
+    feed_process = oi_cache.feed_process_state()
+    if feed_process is None:
+        return payload, 200
+    payload["websocket"] = feed_process["alive"]
+    payload["feed_process"] = feed_process
+    if not feed_process["alive"]:
+        payload["status"] = "degraded"
+        return payload, 503
+    return payload, 200
+
+def build_status(websocket_status, feed_stats):
+    """Формирует ответ /status: состояние сервера, фида и данных по тикерам"""
+    # Состояние тикеров берётся из индекса свежести, без чтения кэша OI
+    config = get_config()
+    
+    status_data = {
+        "server": "running",
+        "websocket": websocket_status,
+        "feed": feed_stats,
+        "summary": freshness.summary(),
+        "tickers": {}
+    }
+    
+    now = oi_cache.monotonic_time()
+    for ticker in config.get("tickers", []):
+        symbol = ticker.get("symbol")
+        age = freshness.age(symbol, now)
+        
+        status_data["tickers"][symbol] = {
+            "has_data": freshness.state(symbol) is FRESH,
+            "last_update_age": int(age) if age is not None else None,
+            "data_fresh": age is not None and age < 60 if age is not None else False
+        }
+    
+    return status_data
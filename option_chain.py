@@ -0,0 +1,506 @@
+"""
+OI опционных цепочек: подписка на все страйки базового актива и аналитика
+по цепочке (/chain_oi?symbol=).
+
+Контракты цепочки берутся из справочника инструментов (scrip_master) и
+подписываются через тот же фид dhan_ws. Тики опционов не идут в oi_cache:
+dhan_ws передаёт их движку (dhan_ws.add_tap), и каждый тик - это запись
+одного элемента массива OI цепочки [сторона, страйк]. Стоимость тика не
+зависит от числа страйков.
+
+Аналитика - put-call ratio, max pain, концентрация OI по страйкам и
+изменение OI по страйкам с первого тика - считается векторно по массивам
+цепочки и кэшируется до следующей пачки тиков.
+
+В режиме gunicorn с общим фидом (OI_SHARED_FEED=1) цепочки из
+OI_CHAIN_SYMBOLS ведёт процесс фида: массивы каждой цепочки лежат в файле в
+разделяемой памяти (каталог <OI_SHM_PATH>.chains), и воркеры считают
+аналитику по ним, не подписываясь сами. Подписаться на другую цепочку
+воркер не может - такие запросы получают 404.
+
+В процессе с фидом /chain_oi подписывается на цепочки по запросу, но не
+больше OI_CHAIN_MAX цепочек сверх OI_CHAIN_SYMBOLS (OI_CHAIN_ON_DEMAND=0
+отключает подписку по запросу). Истёкшие экспирации отписываются, а активы,
+отслеживаемые по ближайшим экспирациям, переходят на следующую.
+"""
+import glob
+import mmap
+import os
+import struct
+import threading
+import time
+import logging
+from urllib.parse import quote
+
+import numpy as np
+
+import dhan_ws
+import oi_cache
+from dhan_packets import EXCHANGE_SEGMENTS
+from scrip_master import get_scrip_master
+
+logger = logging.getLogger(__name__)
+
+# Базовые активы, цепочки которых подписываются при старте
+CHAIN_SYMBOLS = [s.strip() for s in os.environ.get("OI_CHAIN_SYMBOLS", "").split(",") if s.strip()]
+# Сколько ближайших экспираций отслеживать по каждому активу
+CHAIN_EXPIRIES = int(os.environ.get("OI_CHAIN_EXPIRIES", 1))
+# Сколько страйков с наибольшим OI показывать в концентрации
+CHAIN_TOP = int(os.environ.get("OI_CHAIN_TOP", 5))
+# Подписка на цепочки по запросу /chain_oi и предел таких цепочек
+CHAIN_ON_DEMAND = os.environ.get("OI_CHAIN_ON_DEMAND", "1") == "1"
+CHAIN_MAX = int(os.environ.get("OI_CHAIN_MAX", 8))
+# Как часто проверять, не истекли ли отслеживаемые экспирации, секунды
+ROLL_INTERVAL = 600.0
+
+CALL, PUT = 0, 1
+
+# magic, число страйков, код сегмента, версия, число пачек тиков, время обновления
+CHAIN_MAGIC = b'DHANCH01'
+CHAIN_HEADER = struct.Struct('<8sIB3xQQd')
+# Смещение полей версия/пачки/время в заголовке
+_STATE_OFFSET = 16
+_STATE = struct.Struct('<QQd')
+
+
+def chain_dir():
+    """Каталог файлов цепочек рядом с хранилищем OI в разделяемой памяти"""
+    from oi_shm import DEFAULT_PATH
+    return os.environ.get("OI_SHM_PATH", DEFAULT_PATH) + ".chains"
+
+
+def chain_file(underlying, expiry):
+    # Имя актива экранируется: в символах бывают "&" и "-", а "/" недопустим
+    return os.path.join(chain_dir(), f"{quote(underlying, safe='')}_{expiry}.bin")
+
+
+def chain_analytics(strikes, oi, base, top=CHAIN_TOP):
+    """
+    Аналитика по цепочке.
+
+    Args:
+        strikes: страйки по возрастанию
+        oi: массив 2 x len(strikes) - OI коллов и путов
+        base: OI на момент первого тика (-1 - тиков ещё не было)
+
+    Returns:
+        dict: PCR, max pain, концентрация и изменение OI по страйкам
+    """
+    calls, puts = oi[CALL].astype(np.float64), oi[PUT].astype(np.float64)
+    total_call, total_put = calls.sum(), puts.sum()
+
+    # Max pain: страйк, при экспирации на котором выплаты по всем опционам
+    # минимальны. Выплаты на страйке K_j считаются накопленными суммами за O(n):
+    # коллы  sum(c_i * (K_j - K_i)) по K_i < K_j = K_j * C(j) - CK(j)
+    # путы   sum(p_i * (K_i - K_j)) по K_i > K_j = PK'(j) - K_j * P'(j)
+    call_pain = strikes * np.cumsum(calls) - np.cumsum(calls * strikes)
+    put_pain = np.cumsum((puts * strikes)[::-1])[::-1] - strikes * np.cumsum(puts[::-1])[::-1]
+    pain = call_pain + put_pain
+    max_pain = float(strikes[np.argmin(pain)]) if len(strikes) and total_call + total_put else None
+
+    change = np.where(base >= 0, oi - base, 0)
+
+    def concentration(values, total):
+        if not total:
+            return {"hhi": None, "top": []}
+        shares = values / total
+        order = np.argsort(values)[::-1][:top]
+        return {
+            # Индекс Херфиндаля: 1/n при равномерном OI, 1 - весь OI на одном страйке
+            "hhi": round(float(np.square(shares).sum()), 4),
+            "top": [{"strike": float(strikes[i]), "oi": int(values[i]), "share": round(float(shares[i]), 4)}
+                    for i in order.tolist() if values[i] > 0],
+        }
+
+    return {
+        "total_call_oi": int(total_call),
+        "total_put_oi": int(total_put),
+        "pcr": round(float(total_put / total_call), 4) if total_call else None,
+        "max_pain": max_pain,
+        "call_oi_change": int(change[CALL].sum()),
+        "put_oi_change": int(change[PUT].sum()),
+        "concentration": {"calls": concentration(calls, total_call), "puts": concentration(puts, total_put)},
+        "strikes": [
+            {"strike": strike, "call_oi": c, "put_oi": p, "call_change": dc, "put_change": dp}
+            for strike, c, p, dc, dp in zip(strikes.tolist(), oi[CALL].tolist(), oi[PUT].tolist(),
+                                            change[CALL].tolist(), change[PUT].tolist())
+        ],
+    }
+
+
+class OptionChain:
+    """
+    OI одной цепочки (базовый актив + экспирация) в массивах по страйкам.
+
+    Массивы лежат в памяти процесса либо, у процесса фида с общим
+    хранилищем, в файле цепочки (create_shared): заголовок с версией и
+    временем обновления, затем страйки, security_id, OI и базовый OI.
+    Воркеры отображают этот файл только для чтения (attach).
+    """
+
+    def __init__(self, underlying, expiry, segment, strikes, security_ids, buf=None, path=None, inode=None):
+        self.underlying = underlying
+        self.expiry = expiry
+        self.segment = segment
+        self.buf = buf
+        self.path = path
+        self.inode = inode
+        self.version = 0
+        self.ticks = 0
+        self.updated_at = None
+        self._analytics = (None, None)
+        if buf is None:
+            self.strikes = np.asarray(strikes, dtype=np.float64)
+            # security_id контрактов [сторона, страйк]; -1 - контракта нет
+            self.security_ids = np.asarray(security_ids, dtype=np.int64)
+            self.oi = np.zeros((2, len(self.strikes)), dtype=np.int64)
+            self.base = np.full((2, len(self.strikes)), -1, dtype=np.int64)
+            return
+        # Представления NumPy прямо поверх mmap файла цепочки
+        n = CHAIN_HEADER.unpack_from(buf, 0)[1]
+        offset = CHAIN_HEADER.size
+        self.strikes = np.frombuffer(buf, dtype=np.float64, count=n, offset=offset)
+        offset += n * 8
+        self.security_ids, self.oi, self.base = (
+            np.frombuffer(buf, dtype=np.int64, count=2 * n, offset=offset + i * 16 * n).reshape(2, n)
+            for i in range(3))
+        self.refresh()
+
+    @staticmethod
+    def file_size(n):
+        return CHAIN_HEADER.size + n * 8 + 3 * 2 * n * 8
+
+    @classmethod
+    def create_shared(cls, path, underlying, expiry, segment, strikes, security_ids):
+        """Создаёт (или пересоздаёт) файл цепочки для процесса фида"""
+        strikes = np.asarray(strikes, dtype=np.float64)
+        security_ids = np.asarray(security_ids, dtype=np.int64)
+        n = len(strikes)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(CHAIN_HEADER.pack(CHAIN_MAGIC, n, EXCHANGE_SEGMENTS[segment], 0, 0, 0.0))
+            f.write(strikes.tobytes())
+            f.write(security_ids.tobytes())
+            f.write(np.zeros((2, n), dtype=np.int64).tobytes())
+            f.write(np.full((2, n), -1, dtype=np.int64).tobytes())
+        # Атомарная подмена, как у хранилища OI: читатель сверяет inode
+        os.replace(tmp_path, path)
+        return cls._map(path, underlying, expiry, segment, writable=True)
+
+    @classmethod
+    def attach(cls, path, underlying, expiry):
+        """Подключается к файлу цепочки процесса фида только для чтения"""
+        return cls._map(path, underlying, expiry, None, writable=False)
+
+    @classmethod
+    def _map(cls, path, underlying, expiry, segment, writable):
+        fd = os.open(path, os.O_RDWR if writable else os.O_RDONLY)
+        try:
+            stat = os.fstat(fd)
+            if stat.st_size < CHAIN_HEADER.size:
+                raise ValueError(f"Неподдерживаемый формат файла цепочки: {path}")
+            buf = mmap.mmap(fd, stat.st_size, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        magic, n, code = CHAIN_HEADER.unpack_from(buf, 0)[:3]
+        if magic != CHAIN_MAGIC or stat.st_size < cls.file_size(n):
+            buf.close()
+            raise ValueError(f"Неподдерживаемый формат файла цепочки: {path}")
+        if segment is None:
+            segment = next((name for name, value in EXCHANGE_SEGMENTS.items() if value == code), str(code))
+        return cls(underlying, expiry, segment, None, None, buf=buf, path=path, inode=stat.st_ino)
+
+    def is_current(self):
+        """Файл по пути - всё ещё тот, что отображён (процесс фида не пересоздал его)"""
+        try:
+            return os.stat(self.path).st_ino == self.inode
+        except OSError:
+            return False
+
+    def publish(self):
+        """Процесс фида: версия, число пачек и время обновления - в заголовок файла"""
+        if self.buf is not None:
+            _STATE.pack_into(self.buf, _STATE_OFFSET, self.version, self.ticks, self.updated_at or 0.0)
+
+    def refresh(self):
+        """Воркер: версия, число пачек и время обновления из заголовка файла"""
+        if self.buf is not None:
+            self.version, self.ticks, updated_at = _STATE.unpack_from(self.buf, _STATE_OFFSET)
+            self.updated_at = updated_at or None
+
+    def tickers(self):
+        segment = self.segment
+        return [{"symbol": f"{self.underlying}-{self.expiry}-{strike:g}-{'CE' if side == CALL else 'PE'}",
+                 "exchange_segment": segment, "security_id": str(security_id)}
+                for side in (CALL, PUT)
+                for strike, security_id in zip(self.strikes.tolist(), self.security_ids[side].tolist())
+                if security_id >= 0]
+
+    def analytics(self):
+        """Аналитика по текущим массивам; пересчитывается только после новых тиков"""
+        version, result = self._analytics
+        if version == self.version and result is not None:
+            return result
+        version = self.version
+        # Копии: поток фида может писать в массивы во время расчёта
+        result = chain_analytics(self.strikes, self.oi.copy(), self.base.copy())
+        self._analytics = (version, result)
+        return result
+
+
+class OptionChainEngine:
+    """Отслеживаемые цепочки и разбор их тиков (потребитель тиков dhan_ws)"""
+
+    def __init__(self, expiries=CHAIN_EXPIRIES, configured=CHAIN_SYMBOLS):
+        self.expiries = expiries
+        self.configured = set(configured)
+        self.chains = {}  # (базовый актив, экспирация) -> OptionChain
+        # (код сегмента, security_id) -> (цепочка, сторона, номер страйка)
+        self.instruments = {}
+        # Активы, отслеживаемые по ближайшим экспирациям: (актив, сегмент)
+        self.rolling = set()
+        # Файлы цепочек процесса фида, отображённые воркером: путь -> OptionChain
+        self.attached = {}
+        # Функции подписки и отписки; ASGI-приложение подменяет их своими
+        self.subscriber = dhan_ws.subscribe
+        self.unsubscriber = dhan_ws.unsubscribe
+        self._lock = threading.Lock()
+        self._roller = None
+
+    def lookup(self, key):
+        return self.instruments.get(key)
+
+    def on_ticks(self, ticks):
+        """Пачка тиков одного фрейма: O(1) на тик, версия цепочки - раз на пачку"""
+        touched = set()
+        for (chain, side, index), value in ticks:
+            chain.oi[side, index] = value
+            if chain.base[side, index] < 0:
+                chain.base[side, index] = value
+            touched.add(chain)
+        now = oi_cache.wall_time()
+        for chain in touched:
+            chain.ticks += 1
+            chain.updated_at = now
+            chain.version += 1
+            chain.publish()
+
+    def tickers(self):
+        return [ticker for chain in list(self.chains.values()) for ticker in chain.tickers()]
+
+    def on_demand(self):
+        """Число цепочек, подписанных по запросу (сверх OI_CHAIN_SYMBOLS)"""
+        return sum(1 for underlying, _ in self.chains if underlying not in self.configured)
+
+    def track(self, underlying, expiry=None, segment="NSE_FNO", cap=None, today=None):
+        """
+        Подписывается на цепочку (по умолчанию - ближайшие self.expiries экспираций).
+
+        Args:
+            cap: предел цепочек, подписанных по запросу (None - без предела)
+            today: дата, с которой экспирации считаются неистёкшими
+
+        Returns:
+            list: отслеживаемые цепочки актива; пустой, если опционов нет;
+                None, если новая цепочка превысила бы cap
+        """
+        master = get_scrip_master()
+        if master is None:
+            return []
+        if expiry is not None:
+            expiries, limit = [expiry], 1
+        else:
+            expiries, limit = [str(e) for e in master.expiries(underlying, segment, today)], self.expiries
+        chains, new = [], []
+        with self._lock:
+            if expiry is None:
+                self.rolling.add((underlying, segment))
+            for expiry in expiries:
+                if len(chains) >= limit:
+                    break
+                chain = self.chains.get((underlying, expiry))
+                if chain is None:
+                    if cap is not None and self.on_demand() >= cap:
+                        if not chains:
+                            return None
+                        break
+                    chain = self._create(master, underlying, expiry, segment)
+                    if chain is None:
+                        continue
+                    new.append(chain)
+                chains.append(chain)
+        tickers = [ticker for chain in new for ticker in chain.tickers()]
+        if tickers and self.subscriber is not None:
+            self.subscriber(tickers)
+        return chains
+
+    def _create(self, master, underlying, expiry, segment):
+        """Новая цепочка из справочника; вызывается под self._lock"""
+        data = master.option_chain(underlying, expiry, segment)
+        if data is None:
+            return None
+        strikes = [row["strike"] for row in data["strikes"]]
+        ids = [[row["CE"] if row["CE"] is not None else -1 for row in data["strikes"]],
+               [row["PE"] if row["PE"] is not None else -1 for row in data["strikes"]]]
+        if oi_cache.STORE_MODE == "writer":
+            os.makedirs(chain_dir(), exist_ok=True)
+            chain = OptionChain.create_shared(chain_file(underlying, data["expiry"]), underlying, data["expiry"],
+                                              segment, strikes, ids)
+        else:
+            chain = OptionChain(underlying, data["expiry"], segment, strikes, ids)
+        code = EXCHANGE_SEGMENTS[segment]
+        instruments = dict(self.instruments)
+        for side in (CALL, PUT):
+            for index, security_id in enumerate(chain.security_ids[side].tolist()):
+                if security_id >= 0:
+                    instruments[(code, security_id)] = (chain, side, index)
+        # Подмена словаря целиком - поток фида читает его без блокировки
+        self.instruments = instruments
+        self.chains = {**self.chains, (underlying, expiry): chain}
+        logger.info(f"Отслеживается цепочка {underlying} {chain.expiry}: {len(strikes)} страйков")
+        return chain
+
+    def roll(self, today=None):
+        """
+        Отписывается от истёкших цепочек; активы, отслеживаемые по ближайшим
+        экспирациям, подписываются на следующую.
+
+        Returns:
+            int: число снятых цепочек
+        """
+        today = str(np.datetime64(today or "today", "D"))
+        with self._lock:
+            expired = {chain for chain in self.chains.values() if chain.expiry < today}
+            if not expired:
+                return 0
+            self.instruments = {key: entry for key, entry in self.instruments.items() if entry[0] not in expired}
+            self.chains = {key: chain for key, chain in self.chains.items() if chain not in expired}
+            rolling = list(self.rolling)
+        tickers = [ticker for chain in expired for ticker in chain.tickers()]
+        if tickers and self.unsubscriber is not None:
+            self.unsubscriber(tickers)
+        for chain in expired:
+            # Отображение не закрывается: поток фида может дописывать пачку,
+            # разобранную до подмены словаря; файл исчезает для воркеров
+            if chain.path is not None:
+                try:
+                    os.unlink(chain.path)
+                except OSError:
+                    pass
+            logger.info(f"Снята истёкшая цепочка {chain.underlying} {chain.expiry}")
+        for underlying, segment in rolling:
+            if any(chain.underlying == underlying for chain in expired):
+                self.track(underlying, segment=segment, today=today)
+        return len(expired)
+
+    def _roll_forever(self):
+        while True:
+            time.sleep(ROLL_INTERVAL)
+            try:
+                self.roll()
+            except Exception as e:
+                logger.error(f"Ошибка при смене экспираций цепочек: {e}")
+
+    def _remove_stale(self):
+        """Процесс фида: удаляет файлы цепочек, оставшиеся от прошлого запуска"""
+        tracked = {chain.path for chain in self.chains.values()}
+        for path in glob.glob(os.path.join(glob.escape(chain_dir()), "*.bin")):
+            if path not in tracked:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def start(self, symbols=CHAIN_SYMBOLS):
+        for symbol in symbols:
+            try:
+                self.track(symbol)
+            except Exception as e:
+                logger.error(f"Не удалось подписаться на цепочку {symbol}: {e}")
+        if oi_cache.STORE_MODE == "writer":
+            self._remove_stale()
+        if self._roller is None:
+            self._roller = threading.Thread(target=self._roll_forever, name="option-chain-roll")
+            self._roller.daemon = True
+            self._roller.start()
+
+    def shared_chains(self, underlying, expiry=None):
+        """
+        Воркер: цепочки актива, которые ведёт процесс фида (файлы в chain_dir()).
+
+        Returns:
+            list: цепочки по возрастанию экспирации (без истёкших)
+        """
+        prefix = os.path.join(chain_dir(), quote(underlying, safe='') + "_")
+        today = str(np.datetime64("today", "D"))
+        chains = []
+        for path in sorted(glob.glob(glob.escape(prefix) + "????-??-??.bin")):
+            chain_expiry = path[len(prefix):-len(".bin")]
+            if chain_expiry < today or (expiry is not None and chain_expiry != expiry):
+                continue
+            chain = self.attached.get(path)
+            if chain is None or not chain.is_current():
+                try:
+                    chain = OptionChain.attach(path, underlying, chain_expiry)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Не удалось подключиться к файлу цепочки {path}: {e}")
+                    continue
+                with self._lock:
+                    # Отображения удалённых процессом фида файлов не копятся
+                    self.attached = {**{p: c for p, c in self.attached.items() if os.path.exists(p)},
+                                     path: chain}
+            chain.refresh()
+            chains.append(chain)
+        return chains if expiry is not None else chains[:self.expiries]
+
+
+def _chain_payload(symbol, chains):
+    result = []
+    for chain in chains:
+        if not chain.ticks:
+            result.append({"expiry": chain.expiry, "status": "pending", "strikes_count": len(chain.strikes)})
+            continue
+        result.append({"expiry": chain.expiry, "status": "success",
+                       "last_update": int(chain.updated_at), **chain.analytics()})
+    # 202 - подписка только что оформлена и тиков по цепочке ещё не было
+    if all(item["status"] == "pending" for item in result):
+        return {"symbol": symbol, "expiries": result, "status": "pending"}, 202
+    return {"symbol": symbol, "expiries": result, "status": "success"}, 200
+
+
+def build_chain_oi(symbol, expiry=None):
+    """Формирует ответ /chain_oi: (payload, status)"""
+    if expiry is not None:
+        try:
+            expiry = str(np.datetime64(expiry, "D"))
+        except ValueError:
+            return {"error": "expiry must be YYYY-MM-DD", "status": "error"}, 400
+        if expiry < str(np.datetime64("today", "D")):
+            return {"error": f"Expiry {expiry} has passed", "symbol": symbol, "status": "error"}, 404
+    started = time.perf_counter()
+    if oi_cache.STORE_MODE == "reader":
+        # Цепочки ведёт процесс фида; воркер только читает их файлы
+        chains = engine.shared_chains(symbol, expiry)
+        if not chains:
+            return {"error": f"Option chain for {symbol} is not tracked by the feed process "
+                             f"(add it to OI_CHAIN_SYMBOLS)", "symbol": symbol, "status": "error"}, 404
+    else:
+        if symbol not in engine.configured and not CHAIN_ON_DEMAND:
+            return {"error": f"Option chain for {symbol} is not in OI_CHAIN_SYMBOLS", "symbol": symbol,
+                    "status": "error"}, 403
+        if get_scrip_master() is None:
+            return {"error": "Scrip master is not available", "status": "error"}, 503
+        engine.roll()
+        chains = engine.track(symbol, expiry, cap=None if symbol in engine.configured else CHAIN_MAX)
+        if chains is None:
+            return {"error": f"Too many option chains tracked on demand (OI_CHAIN_MAX={CHAIN_MAX})",
+                    "symbol": symbol, "status": "error"}, 503
+        if not chains:
+            return {"error": f"No option chain for {symbol}", "symbol": symbol, "status": "error"}, 404
+    payload, status = _chain_payload(symbol, chains)
+    logger.debug(f"Аналитика цепочки {symbol} за {(time.perf_counter() - started) * 1000:.2f} мс")
+    return payload, status
+
+
+engine = OptionChainEngine()
+dhan_ws.add_tap(engine)
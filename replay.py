@@ -0,0 +1,235 @@
+"""
+Ускоренное воспроизведение тиков для проверки индикатора изменения OI.
+
+Тики из журнала (tick_journal) или синтетические собираются в бинарные
+фреймы Dhan и проходят тот же путь, что и в бою: process_frame -> oi_cache ->
+build_tv_data. Время задают виртуальные часы: они переводятся на момент
+каждого фрейма, без ожидания и без обращения к системному времени, поэтому
+торговый день воспроизводится за секунды.
+
+Каждые --step секунд виртуального времени снимается ответ /tv_data по
+символам - ряд oi_change_pct, который показал бы индикатор TradingView.
+
+Запуск:
+    python replay.py --day 20261016 --symbols NIFTY,BANKNIFTY --output nifty.csv
+    python replay.py --synthetic 50 --hours 6.25 --timeframes 15,45,240
+"""
+import argparse
+import calendar
+import csv
+import os
+import sys
+import time
+import logging
+
+# Воспроизведение не должно дописывать журнал, который оно читает
+os.environ["OI_JOURNAL"] = "0"
+os.environ["OI_STORE_MODE"] = "local"
+
+import numpy as np  # noqa: E402
+
+import dhan_ws  # noqa: E402
+import oi_cache  # noqa: E402
+import tick_journal  # noqa: E402
+from dhan_packets import EXCHANGE_SEGMENTS, encode_oi_packets  # noqa: E402
+from instrument_registry import get_registry  # noqa: E402
+from tv_endpoint import build_tv_data, get_intervals  # noqa: E402
+
+# Синтетические инструменты: NSE_FNO и security_id с этого номера
+SYNTHETIC_SEGMENT = "NSE_FNO"
+SYNTHETIC_FIRST_ID = 800000
+# Начало торговой сессии NSE (09:15 IST) для синтетического дня
+SESSION_START_UTC = (3, 45)
+# Период фреймов синтетического фида, сек
+FRAME_INTERVAL = 0.1
+
+
+class VirtualClock:
+    """Часы, которые двигает только воспроизведение"""
+
+    def __init__(self, now=0.0):
+        self.now = float(now)
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def advance_to(self, timestamp):
+        if timestamp > self.now:
+            self.now = float(timestamp)
+
+
+def journal_ticks(day=None, directory=None):
+    """
+    Тики из журнала за день в хронологическом порядке.
+
+    Returns:
+        tuple: (время в секундах, код сегмента, security_id, OI) - массивы NumPy
+    """
+    records = tick_journal.read_day(day, directory)
+    order = np.argsort(records['ts'], kind='stable')
+    records = records[order]
+    return (records['ts'] / 1e9, records['segment'].astype(np.int64),
+            records['security_id'].astype(np.int64), records['oi'].astype(np.int64))
+
+
+def synthetic_ticks(instruments, hours, rate, seed=0, start=None):
+    """
+    Синтетический торговый день: случайное блуждание OI по каждому инструменту.
+
+    Args:
+        instruments: число инструментов
+        hours: длительность сессии в часах
+        rate: тиков в секунду на все инструменты
+        start: начало сессии (UNIX-время); по умолчанию сегодня 09:15 IST
+    """
+    if start is None:
+        today = time.gmtime()
+        start = calendar.timegm((today.tm_year, today.tm_mon, today.tm_mday, *SESSION_START_UTC, 0))
+    rng = np.random.default_rng(seed)
+    count = int(hours * 3600 * rate)
+    # Фид присылает тики пачками - время округляется до FRAME_INTERVAL
+    ts = start + np.floor(np.sort(rng.uniform(0, hours * 3600, count)) / FRAME_INTERVAL) * FRAME_INTERVAL
+    which = rng.integers(0, instruments, count)
+    base = rng.integers(1_000_000, 20_000_000, instruments)
+    steps = rng.normal(0, 2000, count).astype(np.int64)
+    # Блуждание по каждому инструменту: накопленная сумма шагов внутри группы
+    order = np.argsort(which, kind='stable')
+    walk = np.empty(count, dtype=np.int64)
+    grouped = steps[order]
+    bounds = np.flatnonzero(np.diff(which[order])) + 1
+    for part, idx in zip(np.split(grouped, bounds), np.split(order, bounds)):
+        walk[idx] = np.cumsum(part)
+    oi = np.maximum(base[which] + walk, 0)
+    segment = np.full(count, EXCHANGE_SEGMENTS[SYNTHETIC_SEGMENT], dtype=np.int64)
+    return ts, segment, SYNTHETIC_FIRST_ID + which, oi
+
+
+def register_synthetic(instruments):
+    """Регистрирует синтетические инструменты в реестре (без записи config.json)"""
+    registry = get_registry()
+    registry.reload()
+    tickers = [{"symbol": f"SYN{i}", "exchange_segment": SYNTHETIC_SEGMENT,
+                "security_id": str(SYNTHETIC_FIRST_ID + i)} for i in range(instruments)]
+    registry.add_many(tickers)
+    return [ticker["symbol"] for ticker in tickers]
+
+
+def iter_frames(ts, segments, security_ids, values, max_packets=100):
+    """Группирует тики с одинаковым временем во фреймы (как их записал фид)"""
+    bounds = np.flatnonzero(np.diff(ts)) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(ts)]))
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        for chunk in range(start, end, max_packets):
+            stop = min(chunk + max_packets, end)
+            yield ts[chunk], encode_oi_packets(segments[chunk:stop], security_ids[chunk:stop],
+                                               values[chunk:stop])
+
+
+def replay(ticks, symbols, timeframes=None, step=60.0, on_sample=None):
+    """
+    Прогоняет тики через process_frame на виртуальных часах.
+
+    Args:
+        ticks: (время, сегмент, security_id, OI) - массивы в хронологическом порядке
+        symbols: символы, по которым снимается ответ /tv_data
+        step: период снятия ответа в секундах виртуального времени
+        on_sample: функция (время, символ, ответ /tv_data)
+
+    Returns:
+        dict: статистика воспроизведения
+    """
+    ts = ticks[0]
+    if not len(ts):
+        return {"ticks": 0, "frames": 0}
+    clock = VirtualClock(ts[0])
+    oi_cache.use_clock(clock.time, clock.monotonic)
+    started = time.perf_counter()
+    frames = samples = 0
+    # Отсчёты выравниваются по границам шага, как закрытия баров
+    next_sample = (ts[0] // step + 1) * step
+    try:
+        for frame_ts, frame in iter_frames(*ticks):
+            while next_sample <= frame_ts:
+                clock.advance_to(next_sample)
+                for symbol in symbols:
+                    payload, _ = build_tv_data(symbol, timeframes)
+                    if on_sample is not None:
+                        on_sample(next_sample, symbol, payload)
+                    samples += 1
+                next_sample += step
+            clock.advance_to(frame_ts)
+            dhan_ws.process_frame(frame)
+            frames += 1
+    finally:
+        oi_cache.use_clock()
+    elapsed = time.perf_counter() - started
+    virtual = float(ts[-1] - ts[0])
+    return {
+        "ticks": int(len(ts)),
+        "frames": frames,
+        "samples": samples,
+        "virtual_seconds": round(virtual, 1),
+        "real_seconds": round(elapsed, 3),
+        "speedup": round(virtual / elapsed, 1) if elapsed else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ускоренное воспроизведение тиков OI")
+    parser.add_argument("--day", help="день журнала YYYYMMDD (по умолчанию сегодня)")
+    parser.add_argument("--journal-dir", help="каталог журнала тиков")
+    parser.add_argument("--synthetic", type=int, metavar="N",
+                        help="вместо журнала сгенерировать день для N инструментов")
+    parser.add_argument("--hours", type=float, default=6.25, help="длительность синтетического дня")
+    parser.add_argument("--rate", type=float, default=50.0, help="синтетических тиков в секунду")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--symbols", help="символы через запятую (по умолчанию все)")
+    parser.add_argument("--timeframes", help="интервалы в минутах, как в /tv_data")
+    parser.add_argument("--step", type=float, default=60.0, help="период отсчётов, сек")
+    parser.add_argument("--output", help="CSV-файл (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING,
+                        format='%(asctime)s [%(levelname)s] %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    if args.synthetic:
+        symbols = register_synthetic(args.synthetic)
+        ticks = synthetic_ticks(args.synthetic, args.hours, args.rate, args.seed)
+    else:
+        ticks = journal_ticks(args.day, args.journal_dir)
+        lookup = get_registry().by_instrument
+        seen = {lookup.get((int(s), int(i))) for s, i in set(zip(ticks[1].tolist(), ticks[2].tolist()))}
+        symbols = sorted(symbol for symbol in seen if symbol)
+    if args.symbols:
+        symbols = [s.strip() for s in args.symbols.split(",") if s.strip()]
+
+    labels = list(get_intervals(args.timeframes))
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    writer = csv.writer(output)
+    writer.writerow(["timestamp", "symbol", "current_oi"] + [f"{label}_oi_change_pct" for label in labels])
+
+    def on_sample(timestamp, symbol, payload):
+        intervals = payload.get("intervals")
+        if not intervals:
+            # Нет данных или данные устарели на этот момент
+            writer.writerow([int(timestamp), symbol, ""] + [""] * len(labels))
+            return
+        writer.writerow([int(timestamp), symbol, payload["current_oi"]]
+                        + [intervals[label]["oi_change_pct"] for label in labels])
+
+    try:
+        stats = replay(ticks, symbols, args.timeframes, args.step, on_sample)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(f"Воспроизведено {stats['ticks']} тиков ({stats.get('virtual_seconds', 0)} сек) "
+          f"за {stats.get('real_seconds', 0)} сек, ускорение x{stats.get('speedup')}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
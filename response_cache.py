@@ -0,0 +1,96 @@
+"""
+Кэш готовых JSON-ответов с ETag.
+
+Ответ для символа сериализуется один раз на каждую версию данных (поколение
+хранилища и номер обновления OI в кэше) и дальше отдаётся готовыми байтами. Клиенту
+отправляется ETag, и повторный опрос без изменений получает 304 без тела.
+"""
+import hashlib
+import json
+import threading
+
+from flask import Response, request
+
+from metrics import RESPONSE_CACHE
+
+# Ограничение числа записей: при переполнении кэш очищается целиком
+MAX_ENTRIES = 8192
+
+_entries = {}
+_lock = threading.Lock()
+
+
+def make_etag(key, tag):
+    return hashlib.blake2b(repr((key, tag)).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def _build_response(body, status, etag):
+    response = Response(body, status=status, mimetype='application/json')
+    if etag:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def _not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def serialize(payload):
+    """JSON как у jsonify во Flask: компактно, с сортировкой ключей"""
+    return (json.dumps(payload, separators=(",", ":"), sort_keys=True) + "\n").encode('utf-8')
+
+
+def get_or_build(key, tag, build):
+    """
+    Возвращает готовый ответ из кэша, если версия данных не изменилась,
+    иначе строит и сериализует его заново.
+
+    Args:
+        key: ключ ответа (эндпоинт, символ, параметры)
+        tag: версия данных; None - не кэшировать
+        build: функция без аргументов, возвращающая (payload, status)
+
+    Returns:
+        tuple: (тело в байтах, HTTP-статус, ETag или None)
+    """
+    if tag is not None:
+        entry = _entries.get(key)
+        if entry is not None and entry[0] == tag:
+            RESPONSE_CACHE.inc("hit")
+            _, body, etag = entry
+            return body, 200, etag
+
+    RESPONSE_CACHE.inc("miss")
+    payload, status = build()
+    body = serialize(payload)
+    if tag is None or status != 200:
+        return body, status, None
+
+    etag = make_etag(key, tag)
+    with _lock:
+        if len(_entries) >= MAX_ENTRIES:
+            _entries.clear()
+        _entries[key] = (tag, body, etag)
+    return body, 200, etag
+
+
+def cached_json_response(key, tag, build):
+    """
+    Flask-ответ из кэша: 304 без тела, если клиент прислал актуальный ETag.
+
+    Returns:
+        flask.Response
+    """
+    body, status, etag = get_or_build(key, tag, build)
+    if etag and request.if_none_match.contains(etag):
+        return _not_modified(etag)
+    return _build_response(body, status, etag)
+
+
+def clear():
+    with _lock:
+        _entries.clear()
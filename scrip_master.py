@@ -0,0 +1,597 @@
+"""
+Полный справочник инструментов Dhan (scrip master) в колоночном бинарном
+индексе на диске.
+
+CSV справочника (сотни тысяч строк: акции, индексы, все фьючерсы и опционы)
+один раз читается потоком, пачками по CHUNK_ROWS строк, и сохраняется как
+набор .npy-колонок: базовый символ, сегмент, security_id, экспирация, страйк,
+тип опциона, тип инструмента, лот и торговый символ. Строки отсортированы по
+(базовый символ, сегмент, экспирация, страйк, тип опциона), поэтому все
+контракты одного базового актива - непрерывный диапазон, который находится
+бинарным поиском.
+
+При старте колонки открываются через mmap (np.load(mmap_mode='r')): CSV не
+разбирается, страницы читаются по мере обращения и делятся между воркерами
+через страничный кэш ОС. Индекс перестраивается, только если CSV изменился.
+
+Индекс строится только при запуске процесса (start, шаг lifecycle) или из
+CLI, и всегда под flock на файле <каталог индекса>.lock: из нескольких
+воркеров строит один, остальные ждут и открывают готовый. Запросы индекс не
+строят: get_scrip_master раз в DHAN_SCRIP_RECHECK секунд сверяет его с CSV
+и с каталогом на диске, переоткрывает индекс, перестроенный другим
+процессом, а устаревший перестраивает в фоновом потоке, продолжая отвечать
+по старому.
+
+Запуск:
+    python scrip_master.py build [--source api-scrip-master.csv | --source URL]
+    python scrip_master.py chain NIFTY [--expiry 2026-10-28]
+    python scrip_master.py lookup NIFTY --segment NSE_FNO
+"""
+import argparse
+import csv
+import fcntl
+import io
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import urllib.request
+import logging
+
+import numpy as np
+
+from config import CSV_FILE_PATH
+from dhan_packets import EXCHANGE_SEGMENTS, SEGMENT_NAMES
+from metrics import log_every
+
+logger = logging.getLogger(__name__)
+
+SCRIP_MASTER_URL = "https://images.dhan.co/api-data/api-scrip-master.csv"
+INDEX_DIR = os.environ.get("DHAN_SCRIP_INDEX",
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scrip_index'))
+INDEX_VERSION = 1
+# Строк в одной пачке при потоковом чтении CSV
+CHUNK_ROWS = 50000
+# Как часто сверять открытый индекс с CSV и с каталогом индекса, секунды
+RECHECK_INTERVAL = float(os.environ.get("DHAN_SCRIP_RECHECK", 60))
+
+# (биржа, сегмент справочника) -> сегмент фида Dhan
+SEGMENTS = {
+    ("NSE", "E"): "NSE_EQ",
+    ("NSE", "D"): "NSE_FNO",
+    ("NSE", "C"): "NSE_CURRENCY",
+    ("NSE", "I"): "IDX_I",
+    ("BSE", "E"): "BSE_EQ",
+    ("BSE", "D"): "BSE_FNO",
+    ("BSE", "C"): "BSE_CURRENCY",
+    ("BSE", "I"): "IDX_I",
+    ("MCX", "M"): "MCX_COMM",
+}
+_SEGMENT_CODES = {key: EXCHANGE_SEGMENTS[name] for key, name in SEGMENTS.items()}
+
+# Колонки CSV: компактный (SEM_*) и подробный форматы справочника
+_FIELDS = {
+    "exchange": ("SEM_EXM_EXCH_ID", "EXCH_ID"),
+    "segment": ("SEM_SEGMENT", "SEGMENT"),
+    "security_id": ("SEM_SMST_SECURITY_ID", "SECURITY_ID"),
+    "instrument": ("SEM_INSTRUMENT_NAME", "INSTRUMENT"),
+    "trading_symbol": ("SEM_TRADING_SYMBOL", "SYMBOL_NAME"),
+    "underlying": ("UNDERLYING_SYMBOL",),
+    "lot_size": ("SEM_LOT_UNITS", "LOT_SIZE"),
+    "expiry": ("SEM_EXPIRY_DATE", "SM_EXPIRY_DATE"),
+    "strike": ("SEM_STRIKE_PRICE", "STRIKE_PRICE"),
+    "option_type": ("SEM_OPTION_TYPE", "OPTION_TYPE"),
+}
+_REQUIRED = ("exchange", "segment", "security_id", "trading_symbol")
+
+# Колонки индекса и их типы (строковые колонки - байтовые фиксированной длины)
+COLUMNS = ("underlying", "segment", "security_id", "expiry", "strike",
+           "option_type", "instrument", "lot_size", "trading_symbol")
+# Колонки, которые при сборке держатся в памяти (ключи сортировки и поиска по
+# security_id); остальные сбрасываются на диск пачками
+SORT_COLUMNS = ("underlying", "segment", "security_id", "expiry", "strike", "option_type")
+SPILLED_COLUMNS = ("instrument", "lot_size", "trading_symbol")
+
+
+def _column_indexes(header):
+    positions = {name.strip(): i for i, name in enumerate(header)}
+    indexes = {}
+    for field, names in _FIELDS.items():
+        indexes[field] = next((positions[name] for name in names if name in positions), None)
+    missing = [field for field in _REQUIRED if indexes[field] is None]
+    if missing:
+        raise ValueError(f"В справочнике нет колонок: {', '.join(missing)}")
+    return indexes
+
+
+def _open_source(source):
+    """Текстовый поток CSV из файла или по URL (без загрузки целиком)"""
+    if source.startswith(("http://", "https://")):
+        response = urllib.request.urlopen(source, timeout=60)
+        return io.TextIOWrapper(response, encoding="utf-8", newline="")
+    return open(source, "r", encoding="utf-8", newline="")
+
+
+def _parse_rows(rows, idx):
+    """Разбирает пачку строк CSV в массивы колонок"""
+    underlying, segment, security_id, expiry, strike = [], [], [], [], []
+    option_type, instrument, lot_size, trading_symbol = [], [], [], []
+    i_exchange, i_segment, i_id = idx["exchange"], idx["segment"], idx["security_id"]
+    i_symbol, i_underlying, i_instrument = idx["trading_symbol"], idx["underlying"], idx["instrument"]
+    i_lot, i_expiry, i_strike, i_option = idx["lot_size"], idx["expiry"], idx["strike"], idx["option_type"]
+    for row in rows:
+        try:
+            code = _SEGMENT_CODES.get((row[i_exchange].strip(), row[i_segment].strip()))
+            if code is None:
+                continue
+            sid = int(row[i_id])
+        except (IndexError, ValueError):
+            continue
+        symbol = row[i_symbol].strip()
+        base = row[i_underlying].strip() if i_underlying is not None else ""
+        # В компактном формате базовый символ - начало торгового: NIFTY-Oct2026-24000-CE
+        underlying.append(base or symbol.split("-", 1)[0])
+        segment.append(code)
+        security_id.append(sid)
+        trading_symbol.append(symbol)
+        instrument.append(row[i_instrument].strip() if i_instrument is not None else "")
+        value = row[i_expiry].strip() if i_expiry is not None else ""
+        # Пустая дата или -1/0001-01-01 - инструмент без экспирации
+        expiry.append(value[:10] if value[:1].isdigit() and not value.startswith("0001") else "NaT")
+        try:
+            price = float(row[i_strike]) if i_strike is not None else 0.0
+        except ValueError:
+            price = 0.0
+        strike.append(price if price > 0 else np.nan)
+        option = row[i_option].strip() if i_option is not None else ""
+        option_type.append(option if option in ("CE", "PE") else "")
+        try:
+            lot_size.append(int(float(row[i_lot])) if i_lot is not None else 0)
+        except ValueError:
+            lot_size.append(0)
+    return {
+        "underlying": np.array([value.encode() for value in underlying], dtype=bytes),
+        "segment": np.array(segment, dtype=np.uint8),
+        "security_id": np.array(security_id, dtype=np.int64),
+        "expiry": np.array(expiry, dtype="datetime64[D]"),
+        "strike": np.array(strike, dtype=np.float64),
+        "option_type": np.array(option_type, dtype="S2"),
+        "instrument": np.array([value.encode() for value in instrument], dtype=bytes),
+        "lot_size": np.array(lot_size, dtype=np.int32),
+        "trading_symbol": np.array([value.encode() for value in trading_symbol], dtype=bytes),
+    }
+
+
+def _manifest_key(manifest):
+    """inode и mtime манифеста: build() подменяет каталог индекса целиком"""
+    st = os.stat(manifest)
+    return (st.st_ino, st.st_mtime_ns)
+
+
+def _source_key(source):
+    """Размер и mtime файла справочника (для URL - None)"""
+    try:
+        st = os.stat(source)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def build(source=CSV_FILE_PATH, index_dir=INDEX_DIR):
+    """
+    Потоково читает CSV справочника и записывает колоночный индекс.
+
+    В памяти держатся только колонки, по которым сортируется индекс
+    (SORT_COLUMNS, числа и короткий базовый символ). Широкие колонки
+    каждой пачки сразу сбрасываются на диск и после сортировки
+    раскладываются по своим местам в файлах колонок (open_memmap), поэтому
+    память не растёт с длиной торговых символов.
+
+    Индекс собирается во временном каталоге и подменяет старый целиком:
+    воркеры, уже открывшие старые колонки, дочитывают их без ошибок.
+
+    Returns:
+        int: число инструментов в индексе
+    """
+    started = time.perf_counter()
+    tmp_dir = f"{index_dir}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    keys = {name: [] for name in SORT_COLUMNS}
+    spilled = []  # (файл пачки, число строк)
+    dtypes = {}
+
+    def add_chunk(rows):
+        chunk = _parse_rows(rows, idx)
+        for name in SORT_COLUMNS:
+            keys[name].append(chunk[name])
+        path = os.path.join(tmp_dir, f"chunk{len(spilled)}.npz")
+        np.savez(path, **{name: chunk[name] for name in SPILLED_COLUMNS})
+        spilled.append((path, len(chunk["security_id"])))
+        for name in SPILLED_COLUMNS:
+            # Строковые колонки пачек могут иметь разную ширину - берётся наибольшая
+            dtype = chunk[name].dtype
+            dtypes[name] = max(dtypes.get(name, dtype), dtype, key=lambda d: d.itemsize)
+
+    try:
+        with _open_source(source) as f:
+            reader = csv.reader(f)
+            idx = _column_indexes(next(reader))
+            rows = []
+            for row in reader:
+                rows.append(row)
+                if len(rows) >= CHUNK_ROWS:
+                    add_chunk(rows)
+                    rows = []
+            if rows:
+                add_chunk(rows)
+        count = sum(n for _, n in spilled)
+        if not count:
+            raise ValueError(f"Справочник инструментов пуст: {source}")
+
+        columns = {name: np.concatenate(keys[name]) for name in SORT_COLUMNS}
+        del keys
+        underlyings, codes = np.unique(columns["underlying"], return_inverse=True)
+        columns["underlying"] = codes.astype(np.int32)
+        option_rank = np.searchsorted(np.array([b"", b"CE", b"PE"], dtype="S2"), columns["option_type"])
+        order = np.lexsort((option_rank, columns["strike"], columns["expiry"].view(np.int64),
+                            columns["segment"], columns["underlying"]))
+        for name, values in columns.items():
+            columns[name] = values[order]
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), columns[name])
+
+        # Место каждой исходной строки в отсортированном индексе
+        position = np.empty_like(order)
+        position[order] = np.arange(count)
+        outputs = {name: np.lib.format.open_memmap(os.path.join(tmp_dir, f"{name}.npy"), mode="w+",
+                                                   dtype=dtypes[name], shape=(count,))
+                   for name in SPILLED_COLUMNS}
+        offset = 0
+        for path, n in spilled:
+            with np.load(path) as chunk:
+                target = position[offset:offset + n]
+                for name, output in outputs.items():
+                    output[target] = chunk[name]
+            os.unlink(path)
+            offset += n
+        for output in outputs.values():
+            output.flush()
+        del outputs, position
+
+        # Поиск по (сегмент, security_id): отсортированные ключи и номера строк
+        id_keys = (columns["segment"].astype(np.int64) << 32) | columns["security_id"]
+        id_rows = np.argsort(id_keys, kind="stable")
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    np.save(os.path.join(tmp_dir, "underlyings.npy"), underlyings)
+    np.save(os.path.join(tmp_dir, "id_keys.npy"), id_keys[id_rows])
+    np.save(os.path.join(tmp_dir, "id_rows.npy"), id_rows.astype(np.int32))
+    manifest = {
+        "version": INDEX_VERSION,
+        "source": os.path.abspath(source) if _source_key(source) else source,
+        "source_key": _source_key(source),
+        "rows": int(count),
+        "built_at": int(time.time()),
+    }
+    with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+
+    old_dir = f"{index_dir}.{os.getpid()}.old"
+    if os.path.exists(index_dir):
+        os.rename(index_dir, old_dir)
+    os.rename(tmp_dir, index_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    logger.info(f"Индекс справочника инструментов построен: {count} инструментов, "
+                f"{len(underlyings)} базовых активов за {time.perf_counter() - started:.1f} сек")
+    return count
+
+
+class ScripMaster:
+    """Колоночный индекс справочника инструментов поверх mmap"""
+
+    def __init__(self, index_dir, columns, underlyings, id_keys, id_rows, manifest, manifest_key=None):
+        self.index_dir = index_dir
+        self.manifest_key = manifest_key
+        self.columns = columns
+        self.underlyings = underlyings
+        self.id_keys = id_keys
+        self.id_rows = id_rows
+        self.manifest = manifest
+        # Небольшая таблица базовых активов - в словарь, остальное остаётся в mmap
+        self._codes = {name.decode(): code for code, name in enumerate(underlyings.tolist())}
+
+    @classmethod
+    def open(cls, index_dir=INDEX_DIR):
+        with open(os.path.join(index_dir, "manifest.json")) as f:
+            manifest_key = _manifest_key(f.fileno())
+            manifest = json.load(f)
+        if manifest.get("version") != INDEX_VERSION:
+            raise ValueError(f"Неподдерживаемая версия индекса справочника: {index_dir}")
+
+        def load(name):
+            return np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r")
+
+        columns = {name: load(name) for name in COLUMNS}
+        return cls(index_dir, columns, np.load(os.path.join(index_dir, "underlyings.npy")),
+                   load("id_keys"), load("id_rows"), manifest, manifest_key)
+
+    def __len__(self):
+        return len(self.columns["security_id"])
+
+    def is_stale(self, source=CSV_FILE_PATH):
+        """CSV справочника изменился после построения индекса"""
+        key = _source_key(source)
+        return key is not None and key != self.manifest.get("source_key")
+
+    def is_replaced(self):
+        """Каталог индекса на диске перестроен (этим или другим процессом) после открытия"""
+        try:
+            return _manifest_key(os.path.join(self.index_dir, "manifest.json")) != self.manifest_key
+        except OSError:
+            return False
+
+    def _range(self, underlying, segment=None):
+        """Диапазон строк базового актива (и сегмента) - два бинарных поиска"""
+        code = self._codes.get(underlying)
+        if code is None:
+            return 0, 0
+        # Ключ того же типа, что и колонка: иначе searchsorted приводит всю колонку
+        codes = self.columns["underlying"]
+        code = codes.dtype.type(code)
+        start = int(np.searchsorted(codes, code, "left"))
+        end = int(np.searchsorted(codes, code, "right"))
+        if segment is not None:
+            segment_code = np.uint8(EXCHANGE_SEGMENTS[segment])
+            segments = self.columns["segment"][start:end]
+            start, end = (start + int(np.searchsorted(segments, segment_code, "left")),
+                          start + int(np.searchsorted(segments, segment_code, "right")))
+        return start, end
+
+    def row(self, i):
+        c = self.columns
+        expiry = c["expiry"][i]
+        strike = float(c["strike"][i])
+        return {
+            "symbol": c["trading_symbol"][i].decode(),
+            "underlying": self.underlyings[c["underlying"][i]].decode(),
+            "exchange_segment": SEGMENT_NAMES.get(int(c["segment"][i])),
+            "security_id": int(c["security_id"][i]),
+            "instrument": c["instrument"][i].decode(),
+            "expiry": None if np.isnat(expiry) else str(expiry),
+            "strike": None if np.isnan(strike) else strike,
+            "option_type": c["option_type"][i].decode() or None,
+            "lot_size": int(c["lot_size"][i]),
+        }
+
+    def by_security_id(self, security_id, segment="NSE_FNO"):
+        """Инструмент по сегменту и security_id или None"""
+        key = np.int64((EXCHANGE_SEGMENTS[segment] << 32) | int(security_id))
+        pos = int(np.searchsorted(self.id_keys, key))
+        if pos < len(self.id_keys) and self.id_keys[pos] == key:
+            return self.row(int(self.id_rows[pos]))
+        return None
+
+    def expiries(self, underlying, segment="NSE_FNO", today=None):
+        """Неистёкшие даты экспирации базового актива по возрастанию"""
+        start, end = self._range(underlying, segment)
+        values = np.unique(self.columns["expiry"][start:end])
+        today = np.datetime64(today or "today", "D")
+        return values[~np.isnat(values) & (values >= today)]
+
+    def contracts(self, underlying, segment="NSE_FNO", expiry=None, option_type=None):
+        """Номера строк контрактов базового актива (фильтры по экспирации и типу)"""
+        start, end = self._range(underlying, segment)
+        rows = np.arange(start, end)
+        if expiry is not None:
+            # Внутри актива и сегмента строки отсортированы по экспирации
+            # (как int64: инструменты без экспирации - NaT - идут первыми)
+            expiries = self.columns["expiry"][start:end].view(np.int64)
+            value = np.datetime64(expiry, "D").view(np.int64)
+            rows = rows[np.searchsorted(expiries, value, "left"):np.searchsorted(expiries, value, "right")]
+        if option_type is not None:
+            rows = rows[self.columns["option_type"][rows] == option_type.encode()]
+        return rows
+
+    def option_chain(self, underlying, expiry=None, segment="NSE_FNO", today=None):
+        """
+        Опционная цепочка на экспирацию (по умолчанию ближайшую).
+
+        Returns:
+            dict: {"underlying", "expiry", "strikes": [{"strike", "CE", "PE"}]} -
+                CE/PE - security_id контрактов; None, если опционов нет
+        """
+        if expiry is None:
+            expiries = [e for e in self.expiries(underlying, segment, today)
+                        if len(self.contracts(underlying, segment, e, "CE"))]
+            if not expiries:
+                return None
+            expiry = expiries[0]
+        rows = self.contracts(underlying, segment, expiry)
+        options = self.columns["option_type"][rows]
+        rows = rows[options != b""]
+        if not len(rows):
+            return None
+        strikes = {}
+        c = self.columns
+        for strike, option, security_id in zip(c["strike"][rows].tolist(), c["option_type"][rows].tolist(),
+                                               c["security_id"][rows].tolist()):
+            strikes.setdefault(strike, {"strike": strike, "CE": None, "PE": None})[option.decode()] = security_id
+        return {"underlying": underlying, "expiry": str(np.datetime64(expiry, "D")),
+                "strikes": list(strikes.values())}
+
+    def find_security_id(self, base_symbol, exchange_segment="NSE_FNO", today=None):
+        """
+        Security ID инструмента по символу.
+
+        Для сегментов F&O базовый символ (NIFTY, RELIANCE) разрешается в
+        ближайший неистёкший фьючерс - по нему Dhan отдаёт OI. Точный торговый
+        символ (NIFTY-Oct2026-FUT) разрешается в свой контракт.
+        """
+        segment = EXCHANGE_SEGMENTS.get(exchange_segment)
+        if segment is None:
+            return None
+        start, end = self._range(base_symbol, exchange_segment)
+        if end > start:
+            c = self.columns
+            # Фьючерсы - контракты с экспирацией, но без типа опциона;
+            # строки отсортированы по экспирации, первый неистёкший - ближайший
+            expiries = c["expiry"][start:end]
+            today = np.datetime64(today or "today", "D")
+            live = np.flatnonzero((c["option_type"][start:end] == b"") & ~np.isnat(expiries)
+                                  & (expiries >= today))
+            if len(live):
+                return int(c["security_id"][start + live[0]])
+            symbols = c["trading_symbol"][start:end]
+            exact = np.flatnonzero(symbols == base_symbol.encode())
+            if len(exact):
+                return int(c["security_id"][start + exact[0]])
+        # Торговый символ контракта: полный проход по колонке (медленный путь)
+        matches = np.flatnonzero((self.columns["trading_symbol"] == base_symbol.encode())
+                                 & (self.columns["segment"] == segment))
+        return int(self.columns["security_id"][matches[0]]) if len(matches) else None
+
+
+def _open_index(index_dir):
+    """Открывает готовый индекс или возвращает None"""
+    if not os.path.exists(os.path.join(index_dir, "manifest.json")):
+        return None
+    try:
+        return ScripMaster.open(index_dir)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Индекс справочника инструментов не открыт: {e}")
+        return None
+
+
+def ensure_index(source=CSV_FILE_PATH, index_dir=INDEX_DIR, force=False):
+    """
+    Открывает индекс, при необходимости (нет индекса, CSV изменился, force)
+    строит его под flock: параллельные процессы ждут блокировку и открывают
+    индекс, построенный первым.
+
+    Returns:
+        ScripMaster: индекс или None, если нет ни индекса, ни CSV
+    """
+    parent = os.path.dirname(os.path.abspath(index_dir))
+    os.makedirs(parent, exist_ok=True)
+    with open(f"{index_dir}.lock", "a") as lock:
+        # Блокировка снимается закрытием файла
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        master = _open_index(index_dir)
+        if force or ((master is None or master.is_stale(source)) and os.path.exists(source)):
+            build(source, index_dir)
+            master = ScripMaster.open(index_dir)
+    return master
+
+
+_master = None
+_master_lock = threading.Lock()
+_checked_at = float("-inf")
+_builder = None
+
+
+def _set_master(master):
+    global _master, _checked_at
+    with _master_lock:
+        _master = master
+        _checked_at = time.monotonic()
+
+
+def _rebuild(source, index_dir):
+    try:
+        master = ensure_index(source, index_dir)
+    except (OSError, ValueError) as e:
+        logger.error(f"Не удалось построить индекс справочника инструментов: {e}")
+        return
+    if master is not None:
+        _set_master(master)
+
+
+def _start_rebuild(source, index_dir):
+    """Перестройка индекса в фоновом потоке (одна на процесс)"""
+    global _builder
+    if _builder is not None and _builder.is_alive():
+        return
+    _builder = threading.Thread(target=_rebuild, args=(source, index_dir), name="scrip-master")
+    _builder.daemon = True
+    _builder.start()
+
+
+def start(source=CSV_FILE_PATH, index_dir=INDEX_DIR):
+    """Шаг запуска процесса: открывает индекс, а если его нет или CSV изменился - строит"""
+    try:
+        master = ensure_index(source, index_dir)
+    except (OSError, ValueError) as e:
+        logger.error(f"Не удалось построить индекс справочника инструментов: {e}")
+        master = _open_index(index_dir)
+    _set_master(master)
+    if master is None:
+        logger.warning(f"Справочник инструментов недоступен: нет {index_dir} и {source}")
+    return master
+
+
+def get_scrip_master(source=CSV_FILE_PATH, index_dir=INDEX_DIR):
+    """
+    Общий индекс справочника или None, если его ещё нет.
+
+    Не строит индекс в вызывающем потоке: раз в RECHECK_INTERVAL секунд
+    переоткрывает индекс, перестроенный другим процессом, а если индекса нет
+    или CSV изменился - запускает перестройку в фоне и отвечает по старому.
+    """
+    global _master, _checked_at
+    master = _master
+    if time.monotonic() - _checked_at < RECHECK_INTERVAL:
+        return master
+    with _master_lock:
+        if time.monotonic() - _checked_at < RECHECK_INTERVAL:
+            return _master
+        _checked_at = time.monotonic()
+        if _master is None or _master.is_replaced():
+            opened = _open_index(index_dir)
+            if opened is not None:
+                _master = opened
+        master = _master
+    if (master is None or master.is_stale(source)) and os.path.exists(source):
+        _start_rebuild(source, index_dir)
+    if master is None:
+        log_every(("scrip_master",), f"Справочник инструментов недоступен: нет {index_dir} и {source}",
+                  logger=logger)
+    return master
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Индекс справочника инструментов Dhan")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="построить индекс из CSV")
+    build_parser.add_argument("--source", default=CSV_FILE_PATH,
+                              help=f"файл или URL справочника (например, {SCRIP_MASTER_URL})")
+    chain_parser = commands.add_parser("chain", help="опционная цепочка")
+    chain_parser.add_argument("underlying")
+    chain_parser.add_argument("--expiry")
+    chain_parser.add_argument("--segment", default="NSE_FNO")
+    lookup_parser = commands.add_parser("lookup", help="Security ID по символу")
+    lookup_parser.add_argument("symbol")
+    lookup_parser.add_argument("--segment", default="NSE_FNO")
+    parser.add_argument("--index-dir", default=INDEX_DIR)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        ensure_index(args.source, args.index_dir, force=True)
+        return
+    started = time.perf_counter()
+    master = ScripMaster.open(args.index_dir)
+    print(f"Индекс открыт за {(time.perf_counter() - started) * 1000:.1f} мс: {len(master)} инструментов",
+          file=sys.stderr)
+    if args.command == "chain":
+        chain = master.option_chain(args.underlying, args.expiry, args.segment)
+        print(json.dumps(chain, indent=2))
+    else:
+        security_id = master.find_security_id(args.symbol, args.segment)
+        print(json.dumps(master.by_security_id(security_id, args.segment) if security_id else None, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Снимки изменений OI по всем символам на границах интервалов.
+
+Раз в SNAPSHOT_PERIOD секунд, ровно на границе по настенным часам
+(например, в 09:16:00, 09:17:00, ...), планировщик одним проходом читает
+текущий OI всех настроенных символов и считает матрицу изменений за
+интервалы индикатора прямо по кэшу - без HTTP-запросов и JSON.
+
+Последние снимки хранятся в памяти и отдаются через /snapshot.
+Заменяет прежний цикл cron_task.py, который опрашивал /tv_data по одному символу.
+"""
+import asyncio
+import os
+import threading
+import time
+import logging
+from collections import deque
+
+import numpy as np
+
+from metrics import Histogram
+from instrument_registry import get_registry
+from oi_cache import get_oi_change_matrix, get_states, is_fresh
+from tv_endpoint import get_intervals
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PERIOD = float(os.environ.get("OI_SNAPSHOT_PERIOD", 60))
+# Сколько снимков хранить (по умолчанию - торговый день минутных снимков)
+SNAPSHOT_HISTORY = int(os.environ.get("OI_SNAPSHOT_HISTORY", 400))
+SNAPSHOT_TIMEFRAMES = os.environ.get("OI_SNAPSHOT_TIMEFRAMES")
+
+SNAPSHOT_SECONDS = Histogram("oi_snapshot_seconds", "Time to take one snapshot of all symbols")
+
+
+class Snapshot:
+    """Снимок: текущий OI и изменения за интервалы по всем символам"""
+
+    __slots__ = ("timestamp", "symbols", "labels", "current", "changes", "missing")
+
+    def __init__(self, timestamp, symbols, labels, current, changes, missing):
+        self.timestamp = timestamp
+        self.symbols = symbols
+        self.labels = labels
+        self.current = current
+        self.changes = changes
+        self.missing = missing
+
+    def to_dict(self):
+        """Ответ /snapshot в формате, близком к /tv_data_batch"""
+        changes = self.changes.round(2).tolist()
+        current = self.current.tolist()
+        symbols = {
+            symbol: {
+                "current_oi": current[row],
+                "intervals": {label: changes[row][col] for col, label in enumerate(self.labels)},
+            }
+            for row, symbol in enumerate(self.symbols)
+        }
+        return {
+            "timestamp": int(self.timestamp),
+            "intervals": self.labels,
+            "symbols": symbols,
+            "missing": self.missing,
+            "status": "success",
+        }
+
+
+def take_snapshot(symbols=None, timeframes=SNAPSHOT_TIMEFRAMES, timestamp=None):
+    """
+    Снимает текущий OI и изменения за интервалы одним проходом по кэшу.
+
+    Returns:
+        Snapshot
+    """
+    if symbols is None:
+        symbols = [ticker["symbol"] for ticker in get_registry().instruments()]
+    intervals = get_intervals(timeframes)
+    available, values, missing = [], [], []
+    states = get_states(symbols)
+    for symbol in symbols:
+        state = states.get(symbol)
+        if is_fresh(state) and state[0]:
+            available.append(symbol)
+            values.append(state[0])
+        else:
+            missing.append(symbol)
+    current = np.asarray(values, dtype=np.int64)
+    if available:
+        changes = get_oi_change_matrix(available, list(intervals.values()), values)
+    else:
+        changes = np.zeros((0, len(intervals)))
+    return Snapshot(timestamp if timestamp is not None else time.time(),
+                    available, list(intervals), current, changes, missing)
+
+
+class SnapshotScheduler:
+    """Снимает снимки на границах периода по настенным часам"""
+
+    def __init__(self, period=SNAPSHOT_PERIOD, history=SNAPSHOT_HISTORY, timeframes=SNAPSHOT_TIMEFRAMES):
+        self.period = period
+        self.timeframes = timeframes
+        self.snapshots = deque(maxlen=history)
+        self.listeners = []
+        self._running = False
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._task = None
+
+    @property
+    def latest(self):
+        return self.snapshots[-1] if self.snapshots else None
+
+    def next_boundary(self, now=None):
+        now = time.time() if now is None else now
+        return (now // self.period + 1) * self.period
+
+    def run_once(self, boundary=None):
+        started = time.perf_counter()
+        snapshot = take_snapshot(timeframes=self.timeframes, timestamp=boundary)
+        elapsed = time.perf_counter() - started
+        SNAPSHOT_SECONDS.observe(elapsed)
+        self.snapshots.append(snapshot)
+        total = len(snapshot.symbols) + len(snapshot.missing)
+        logger.debug(f"Снимок OI: {len(snapshot.symbols)} символов за {elapsed * 1000:.2f} мс "
+                     f"({elapsed / total * 1e6 if total else 0:.1f} мкс на символ)")
+        for listener in self.listeners:
+            try:
+                listener(snapshot)
+            except Exception as e:
+                logger.error(f"Ошибка в обработчике снимка OI: {e}")
+        return snapshot
+
+    def _run(self):
+        while self._running:
+            boundary = self.next_boundary()
+            # Event.wait вместо sleep - остановка не ждёт конца периода
+            if self._wakeup.wait(max(boundary - time.time(), 0)):
+                break
+            try:
+                self.run_once(boundary)
+            except Exception as e:
+                logger.error(f"Ошибка при снятии снимка OI: {e}")
+
+    def start(self):
+        """Запускает планировщик в фоновом потоке"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._running = True
+        self._wakeup.clear()
+        self._thread = threading.Thread(target=self._run, name="oi-snapshots")
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info(f"Планировщик снимков OI запущен: каждые {self.period:g} сек")
+
+    async def run_async(self):
+        """Тот же цикл как задача asyncio (ASGI-режим: кэш читается из потока цикла)"""
+        while True:
+            boundary = self.next_boundary()
+            await asyncio.sleep(max(boundary - time.time(), 0))
+            try:
+                self.run_once(boundary)
+            except Exception as e:
+                logger.error(f"Ошибка при снятии снимка OI: {e}")
+
+    def start_async(self):
+        self._task = asyncio.get_running_loop().create_task(self.run_async(), name="oi-snapshots")
+        logger.info(f"Планировщик снимков OI запущен: каждые {self.period:g} сек")
+        return self._task
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+scheduler = SnapshotScheduler()
@@ -0,0 +1,178 @@
+"""
+Поиск символов по префиксу и с опечатками (/search?q=).
+
+Индекс строится один раз по реестру инструментов (config.json и список
+Security ID) и перестраивается только при изменении реестра. Символы
+нормализуются (верхний регистр, только буквы и цифры), поэтому "bank nifty"
+и "BANK-NIFTY" находят BANKNIFTY.
+
+    - префикс: отсортированный список нормализованных символов, диапазон
+      префикса находится двумя бинарными поисками (как обход префиксного
+      дерева, но без словаря на каждый узел);
+    - опечатки: индекс триграмм символ -> позиции, кандидаты ранжируются по
+      коэффициенту Дайса между множествами триграмм запроса и символа.
+
+Результаты ранжируются: точное совпадение, затем префиксы (короче - выше),
+затем нечёткие совпадения по убыванию сходства.
+"""
+import bisect
+import re
+import threading
+import logging
+
+from instrument_registry import get_registry, DEFAULT_SEGMENT
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100
+# Минимальное сходство триграмм для нечёткого совпадения
+MIN_SIMILARITY = 0.3
+
+_NON_ALNUM = re.compile(r'[^A-Z0-9]')
+
+
+def normalize(text):
+    return _NON_ALNUM.sub('', text.upper())
+
+
+def trigrams(key):
+    """Триграммы ключа с границами: "NIFTY" -> {"  N", " NI", "NIF", ...}"""
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SymbolIndex:
+    """Индекс символов для поиска по префиксу и с опечатками"""
+
+    def __init__(self, entries=()):
+        # entries: (символ, сегмент, security_id); первое вхождение символа выигрывает
+        self.entries = []
+        self.keys = []  # нормализованные ключи в порядке сортировки
+        self.order = []  # позиция ключа -> номер записи
+        self.exact = {}  # нормализованный ключ -> номера записей
+        self.grams = {}  # триграмма -> номера записей
+        self.gram_counts = []
+        seen = set()
+        for symbol, segment, security_id in entries:
+            key = normalize(symbol)
+            if not key or symbol in seen:
+                continue
+            seen.add(symbol)
+            entry = len(self.entries)
+            self.entries.append((symbol, segment, security_id))
+            self.exact.setdefault(key, []).append(entry)
+            grams = trigrams(key)
+            self.gram_counts.append(len(grams))
+            for gram in grams:
+                self.grams.setdefault(gram, []).append(entry)
+        ordered = sorted(range(len(self.entries)), key=lambda i: normalize(self.entries[i][0]))
+        self.keys = [normalize(self.entries[i][0]) for i in ordered]
+        self.order = ordered
+
+    def __len__(self):
+        return len(self.entries)
+
+    def prefix(self, key, limit):
+        """Номера записей, ключ которых начинается с key (короткие первыми)"""
+        start = bisect.bisect_left(self.keys, key)
+        # Все ключи с префиксом key лежат в [key, key + символ больше любого из алфавита)
+        end = bisect.bisect_left(self.keys, key + "\x7f", start)
+        found = [(len(self.keys[pos]), self.keys[pos], self.order[pos]) for pos in range(start, end)]
+        found.sort()
+        return [entry for _, _, entry in found[:limit]]
+
+    def fuzzy(self, key, limit, exclude=()):
+        """(сходство, номер записи) по убыванию сходства"""
+        query = trigrams(key)
+        shared = {}
+        for gram in query:
+            for entry in self.grams.get(gram, ()):
+                shared[entry] = shared.get(entry, 0) + 1
+        scored = []
+        for entry, count in shared.items():
+            if entry in exclude:
+                continue
+            score = 2.0 * count / (len(query) + self.gram_counts[entry])
+            if score >= MIN_SIMILARITY:
+                scored.append((-score, self.entries[entry][0], entry))
+        scored.sort()
+        return [(-score, entry) for score, _, entry in scored[:limit]]
+
+    def search(self, query, limit=DEFAULT_LIMIT):
+        """
+        Ранжированные кандидаты для запроса.
+
+        Returns:
+            list: словари {symbol, exchange_segment, security_id, match, score}
+        """
+        key = normalize(query)
+        if not key:
+            return []
+        results = []
+        taken = set()
+
+        def add(entry, match, score):
+            taken.add(entry)
+            symbol, segment, security_id = self.entries[entry]
+            results.append({"symbol": symbol, "exchange_segment": segment,
+                            "security_id": security_id, "match": match, "score": round(score, 3)})
+
+        for entry in self.exact.get(key, ()):
+            add(entry, "exact", 1.0)
+        for entry in self.prefix(key, limit + len(taken)):
+            if len(results) >= limit:
+                break
+            if entry not in taken:
+                add(entry, "prefix", len(key) / len(normalize(self.entries[entry][0])))
+        if len(results) < limit:
+            for score, entry in self.fuzzy(key, limit - len(results), taken):
+                add(entry, "fuzzy", score)
+        return results[:limit]
+
+
+def build_index(registry=None):
+    """Строит индекс по настроенным тикерам и списку Security ID"""
+    registry = registry or get_registry()
+    entries = []
+    for symbol, ticker in registry.by_symbol.items():
+        security_id = ticker.get("security_id")
+        entries.append((symbol, ticker.get("exchange_segment", DEFAULT_SEGMENT),
+                        str(security_id) if security_id is not None else None))
+    entries.extend((symbol, DEFAULT_SEGMENT, security_id) for symbol, security_id in registry.security_ids.items())
+    return SymbolIndex(entries)
+
+
+_index = None
+_index_version = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Общий индекс; перестраивается при изменении реестра инструментов"""
+    global _index, _index_version
+    registry = get_registry()
+    registry.maybe_reload()
+    if _index is None or _index_version != registry.version:
+        with _index_lock:
+            if _index is None or _index_version != registry.version:
+                version = registry.version
+                _index = build_index(registry)
+                _index_version = version
+                logger.info(f"Индекс поиска символов построен: {len(_index)} символов")
+    return _index
+
+
+def search(query, limit=DEFAULT_LIMIT):
+    return get_index().search(query, limit)
+
+
+def build_search(query, limit=None):
+    """Формирует ответ /search: (payload, status)"""
+    if not query or not normalize(query):
+        return {"error": "Query parameter q is required", "status": "error"}, 400
+    try:
+        limit = min(max(int(limit), 1), MAX_LIMIT) if limit else DEFAULT_LIMIT
+    except ValueError:
+        return {"error": "limit must be an integer", "status": "error"}, 400
+    return {"query": query, "results": search(query, limit), "status": "success"}, 200
@@ -0,0 +1,296 @@
+"""
+Журнал тиков: append-only бинарные файлы с записями фиксированного размера.
+
+dhan_ws складывает каждый разобранный тик в буфер, фоновый поток раз в
+COMMIT_INTERVAL секунд записывает накопленное одной операцией (group commit),
+поэтому горячий путь не ждёт диска. Файлы ротируются по размеру и по дням.
+
+При старте журнал за текущий день читается через mmap и NumPy и
+восстанавливает кэш OI и историю изменений без ожидания новых тиков.
+
+Пишет в каталог журнала только один процесс - тот, что держит flock на
+файле .lock в каталоге. Остальные процессы с фидом (несколько воркеров при
+OI_SHARED_FEED=0, отладочный python app.py рядом с сервером) не журналируют
+тики и раз в LOCK_RETRY секунд пробуют перехватить блокировку, например
+после остановки владельца. Файлы сегментов создаются эксклюзивно, поэтому
+два процесса никогда не дописывают один и тот же файл.
+"""
+import fcntl
+import glob
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_ENABLED = os.environ.get("OI_JOURNAL", "1") == "1"
+JOURNAL_DIR = os.environ.get("OI_JOURNAL_DIR",
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'journal'))
+SEGMENT_BYTES = int(os.environ.get("OI_JOURNAL_SEGMENT_BYTES", 64 * 1024 * 1024))
+COMMIT_INTERVAL = 0.2  # секунды между групповыми записями
+RETENTION_DAYS = int(os.environ.get("OI_JOURNAL_RETENTION_DAYS", 5))
+FSYNC = os.environ.get("OI_JOURNAL_FSYNC", "0") == "1"
+# Как часто процесс без блокировки журнала пробует её перехватить
+LOCK_RETRY = 5.0
+LOCK_NAME = '.lock'
+
+MAGIC = b'DHANTJ01'
+FILE_HEADER = struct.Struct('<8sII')  # magic, размер записи, резерв
+# Время (нс, UNIX), код сегмента, security_id, OI
+RECORD = struct.Struct('<qB3xIq')
+RECORD_DTYPE = np.dtype([
+    ('ts', '<i8'),
+    ('segment', 'u1'),
+    ('pad', 'V3'),
+    ('security_id', '<u4'),
+    ('oi', '<i8'),
+])
+
+SEGMENT_NAME = re.compile(r'ticks-(\d{8})-(\d{4})\.bin$')
+
+
+def segment_files(day=None, directory=None):
+    """Файлы журнала (за день в формате YYYYMMDD или все) в порядке записи"""
+    directory = directory or JOURNAL_DIR
+    pattern = f"ticks-{day}-*.bin" if day else "ticks-*.bin"
+    return sorted(glob.glob(os.path.join(directory, pattern)))
+
+
+class TickJournal:
+    """Журнал тиков с фоновым групповым коммитом"""
+
+    def __init__(self, directory=JOURNAL_DIR, segment_bytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
+        self._file = None
+        self._day = None
+        self._index = 0
+        self._written = 0
+        self._running = False
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._lock_file = None
+        self._lock_attempt = 0.0
+        # Журнал пишет только владелец блокировки каталога
+        self.owner = False
+        self.records = 0
+
+    def append(self, ts_ns, segment, security_id, oi):
+        """Добавляет тик в буфер (вызывается из потока фида, не блокирует)"""
+        if not self.owner:
+            return
+        record = RECORD.pack(ts_ns, segment, security_id, oi)
+        with self._buffer_lock:
+            self._buffer.append(record)
+
+    def acquire(self):
+        """Пробует стать владельцем журнала; True, если блокировка у этого процесса"""
+        if self.owner:
+            return True
+        self._lock_attempt = time.monotonic()
+        if self._lock_file is None:
+            self._lock_file = open(os.path.join(self.directory, LOCK_NAME), 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        self.owner = True
+        logger.info(f"Журнал тиков в {self.directory} ведёт процесс {os.getpid()}")
+        return True
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if not self.acquire():
+            logger.info(f"Журнал тиков в {self.directory} ведёт другой процесс - тики этого "
+                        f"процесса не журналируются")
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="tick-journal")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.commit()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._lock_file is not None:
+            # Закрытие файла снимает flock - журнал может перехватить другой процесс
+            self._lock_file.close()
+            self._lock_file = None
+            self.owner = False
+
+    def _run(self):
+        while self._running:
+            self._wakeup.wait(COMMIT_INTERVAL)
+            try:
+                if not self.owner:
+                    if time.monotonic() - self._lock_attempt >= LOCK_RETRY:
+                        self.acquire()
+                    continue
+                self.commit()
+            except Exception as e:
+                logger.error(f"Ошибка записи журнала тиков: {e}")
+
+    def _open_segment(self, day):
+        if self._file is not None:
+            self._file.close()
+        if day != self._day:
+            existing = segment_files(day, self.directory)
+            match = SEGMENT_NAME.search(existing[-1]) if existing else None
+            self._index = int(match.group(2)) + 1 if match else 0
+            self._day = day
+            self._cleanup()
+        else:
+            self._index += 1
+        while True:
+            path = os.path.join(self.directory, f"ticks-{day}-{self._index:04d}.bin")
+            try:
+                # Эксклюзивное создание: существующий сегмент не дописывается
+                self._file = open(path, 'xb')
+                break
+            except FileExistsError:
+                self._index += 1
+        self._file.write(FILE_HEADER.pack(MAGIC, RECORD.size, 0))
+        self._written = FILE_HEADER.size
+
+    def _cleanup(self):
+        """Удаляет файлы журнала старше RETENTION_DAYS дней"""
+        border = (datetime.now() - timedelta(days=RETENTION_DAYS)).strftime('%Y%m%d')
+        for path in segment_files(directory=self.directory):
+            match = SEGMENT_NAME.search(path)
+            if match and match.group(1) < border:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logger.warning(f"Не удалось удалить старый файл журнала {path}: {e}")
+
+    def commit(self):
+        """Записывает накопленные тики одной операцией"""
+        if not self._buffer:
+            return 0
+        # Новые тики сразу идут в новый буфер, запись на диск - вне блокировки
+        with self._buffer_lock:
+            batch, self._buffer = self._buffer, []
+        day = datetime.now().strftime('%Y%m%d')
+        if self._file is None or day != self._day or self._written >= self.segment_bytes:
+            self._open_segment(day)
+        data = b''.join(batch)
+        self._file.write(data)
+        self._file.flush()
+        if FSYNC:
+            os.fsync(self._file.fileno())
+        self._written += len(data)
+        self.records += len(batch)
+        return len(batch)
+
+
+def read_segment(path):
+    """
+    Читает файл журнала через mmap без копирования.
+
+    Returns:
+        numpy.ndarray: структурированный массив записей RECORD_DTYPE
+    """
+    size = os.path.getsize(path)
+    if size <= FILE_HEADER.size:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, record_size, _ = FILE_HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or record_size != RECORD.size:
+        raise ValueError(f"Неподдерживаемый формат журнала: {path}")
+    # Хвост, оборванный при аварийной остановке, отбрасывается
+    count = (size - FILE_HEADER.size) // RECORD.size
+    return np.frombuffer(buf, dtype=RECORD_DTYPE, count=count, offset=FILE_HEADER.size)
+
+
+def read_day(day=None, directory=None):
+    """Все записи журнала за день (по умолчанию - сегодня) одним массивом"""
+    day = day or datetime.now().strftime('%Y%m%d')
+    parts = []
+    for path in segment_files(day, directory):
+        try:
+            parts.append(read_segment(path))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Пропущен файл журнала {path}: {e}")
+    if not parts:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+def group_by_instrument(records):
+    """
+    Группирует записи по инструменту, сохраняя хронологический порядок.
+
+    Yields:
+        tuple: (код сегмента, security_id, массив времени в нс, массив OI)
+    """
+    if not len(records):
+        return
+    keys = (records['segment'].astype(np.uint64) << np.uint64(32)) | records['security_id'].astype(np.uint64)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    bounds = np.flatnonzero(np.diff(keys)) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(keys)]))
+    ts = records['ts'][order]
+    oi = records['oi'][order]
+    for start, end in zip(starts, ends):
+        key = int(keys[start])
+        yield key >> 32, key & 0xFFFFFFFF, ts[start:end], oi[start:end]
+
+
+def replay(lookup, restore, day=None, directory=None):
+    """
+    Восстанавливает состояние из журнала за день.
+
+    Args:
+        lookup: функция (код сегмента, security_id) -> символ или None
+        restore: функция (символ, время в нс, OI) с массивами по символу
+
+    Returns:
+        int: количество прочитанных записей
+    """
+    started = time.perf_counter()
+    records = read_day(day, directory)
+    symbols = 0
+    for segment, security_id, ts, oi in group_by_instrument(records):
+        symbol = lookup((segment, security_id))
+        if symbol is None:
+            continue
+        restore(symbol, ts, oi)
+        symbols += 1
+    logger.info(f"Журнал тиков воспроизведён: {len(records)} записей, {symbols} символов "
+                f"за {time.perf_counter() - started:.3f} сек")
+    return len(records)
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    """Возвращает общий журнал (запускается при первом обращении) или None, если отключён"""
+    global _journal
+    if not JOURNAL_ENABLED:
+        return None
+    if _journal is None:
+        with _journal_lock:
+            if _journal is None:
+                journal = TickJournal()
+                journal.start()
+                _journal = journal
+    return _journal
@@ -1,164 +1,186 @@
 from flask import Blueprint, jsonify, request
-from oi_cache import get_oi, get_oi_age
+import oi_cache
+from oi_cache import get_oi_change, get_oi_change_matrix, get_state, get_states, is_fresh
+from oi_history import HISTORY_RESOLUTION
+from response_cache import cached_json_response
 import time
 import logging
-import json
-import os
-from config import get_config, find_security_id
+from config import update_config_file, find_security_id
+from instrument_registry import get_registry
 
 # Настраиваем логирование (будет использовать конфигурацию из app.py)
 logger = logging.getLogger(__name__)
 
 tv_bp = Blueprint('tv', __name__)
 
-# Словарь для хранения исторических значений OI для расчета изменений
-historical_oi = {}
+# Интервалы индикатора TradingView по умолчанию (метка -> секунды)
+INTERVALS = {
+    "15min": 15 * 60,
+    "45min": 45 * 60,
+    "75min": 75 * 60,
+    "2hours": 2 * 60 * 60,
+    "4hours": 4 * 60 * 60
+}
 
-# Путь к конфигурационному файлу
-CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+def interval_label(minutes):
+    """Метка интервала в формате ответа: 15 -> "15min", 120 -> "2hours" """
+    if minutes >= 120 and minutes % 60 == 0:
+        return f"{minutes // 60}hours"
+    return f"{minutes}min"
+
+def get_intervals(timeframes=None):
+    """
+    Разбирает параметр timeframes (минуты через запятую, например "15,45,240").
+    Без параметра возвращает интервалы индикатора по умолчанию.
+    """
+    if not timeframes:
+        return INTERVALS
+    intervals = {}
+    for item in timeframes.split(","):
+        item = item.strip()
+        if item.isdigit() and int(item) > 0:
+            intervals[interval_label(int(item))] = int(item) * 60
+    return intervals or INTERVALS
 
 # Кэш для хранения найденных security_id (чтобы не искать повторно)
 security_id_cache = {}
 
+def build_tv_data(symbol, timeframes=None):
+    """Формирует ответ /tv_data: (payload, status)"""
+    # Получаем данные OI: значение, время и возраст - из одной записи кэша
+    state = get_state(symbol)
+    current_oi = state[0] if is_fresh(state) else None
+
+    # Улучшенная обработка ошибок
+    if not current_oi:
+        # Проверяем возраст данных для более информативного сообщения
+        if state is not None:
+            error_msg = f"OI data is stale (last update {int(state[2])} seconds ago)"
+            logger.debug(f"{error_msg} для {symbol}")
+            return {
+                "error": error_msg, 
+                "symbol": symbol,
+                "status": "error",
+                "error_code": "STALE_DATA"
+            }, 503  # Service Unavailable
+        else:
+            error_msg = f"No OI data available for {symbol}"
+            logger.debug(error_msg)
+            return {
+                "error": error_msg, 
+                "symbol": symbol,
+                "status": "error",
+                "error_code": "NO_DATA"
+            }, 200  # Изменено с 404 на 200
+
+    # Временная метка - время последнего обновления OI
+    current_time = int(state[1]) if state[1] else int(time.time())
+
+    results = {}
+    for interval, seconds in get_intervals(timeframes).items():
+        try:
+            change = get_oi_change(symbol, seconds, current_oi)
+            oi_change_pct = change[2] if change else 0.0
+            results[interval] = {
+                "oi": current_oi,
+                "oi_change_pct": round(oi_change_pct, 2)
+            }
+        except Exception as e:
+            logger.error(f"Ошибка при расчете изменения OI для {symbol} в интервале {interval}: {e}")
+            results[interval] = {
+                "oi": current_oi,
+                "oi_change_pct": 0.0  # По умолчанию, если произошла ошибка
+            }
+
+    response_data = {
+        "symbol": symbol,
+        "current_oi": current_oi,
+        "intervals": results,
+        "status": "success",
+        "last_update": current_time
+    }
+
+    logger.debug(f"Успешно отправлены данные для {symbol}")
+    return response_data, 200
+
+def discover_ticker(symbol):
+    """
+    Ищет Security ID тикера, которого нет в конфигурации, и добавляет его
+    в config.json и реестр инструментов.
+    
+    Returns:
+        dict: описание нового тикера или None
+    """
+    logger.info(f"Тикер {symbol} не найден в конфигурации. Выполняем автоматический поиск Security ID...")
+    
+    # Проверяем кэш сначала
+    if symbol in security_id_cache:
+        security_id = security_id_cache[symbol]
+        logger.info(f"Найден Security ID для {symbol} в кэше: {security_id}")
+        return None
+    
+    # Ищем Security ID в файле
+    security_id = find_security_id(symbol)
+    if not security_id:
+        from symbol_search import search
+        candidates = [item["symbol"] for item in search(symbol, 3)]
+        hint = f" Возможно, имелось в виду: {', '.join(candidates)}" if candidates else ""
+        logger.warning(f"Security ID для тикера {symbol} не найден.{hint}")
+        return None
+    
+    # Сохраняем в кэш для будущих запросов
+    security_id_cache[symbol] = security_id
+    
+    # Добавляем новый тикер в конфигурацию
+    new_ticker = {
+        "symbol": symbol,
+        "exchange_segment": "NSE_FNO",
+        "security_id": security_id
+    }
+    
+    def add_ticker(config):
+        tickers = config.setdefault('tickers', [])
+        if any(ticker.get('symbol') == symbol for ticker in tickers):
+            return False
+        tickers.append(new_ticker)
+    
+    # Добавляем новый тикер и атомарно сохраняем конфигурацию
+    try:
+        update_config_file(add_ticker)
+        get_registry().add(new_ticker)
+        logger.info(f"Конфигурация обновлена: добавлен новый тикер {symbol} с Security ID {security_id}")
+        return new_ticker
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении конфигурации: {e}")
+        return None
+
+def tv_data_tag(symbol):
+    """Версия данных для кэша ответа /tv_data (None - не кэшировать)"""
+    # Изменения за интервалы зависят и от времени, поэтому версия включает шаг истории
+    state = get_state(symbol, count=False)
+    if is_fresh(state):
+        return (oi_cache.generation(), state[3], int(time.monotonic() // HISTORY_RESOLUTION))
+    return None
+
 @tv_bp.route("/tv_data")
 def tv_data():
     try:
         symbol = request.args.get("symbol", "NIFTY")
-        logger.info(f"Запрос данных для TradingView: {symbol}")
-        
-        # Проверяем наличие тикера в настройках
-        config = get_config()
-        ticker_config = next((ticker for ticker in config.get('tickers', []) 
-                        if ticker.get('symbol') == symbol), None)
+        logger.debug(f"Запрос данных для TradingView: {symbol}")
         
         # Если тикера нет в конфигурации - автоматически находим его Security ID
-        if not ticker_config:
-            logger.info(f"Тикер {symbol} не найден в конфигурации. Выполняем автоматический поиск Security ID...")
-            
-            # Проверяем кэш сначала
-            if symbol in security_id_cache:
-                security_id = security_id_cache[symbol]
-                logger.info(f"Найден Security ID для {symbol} в кэше: {security_id}")
-            else:
-                # Ищем Security ID в файле
-                security_id = find_security_id(symbol)
-                
-                if security_id:
-                    # Сохраняем в кэш для будущих запросов
-                    security_id_cache[symbol] = security_id
-                    
-                    # Добавляем новый тикер в конфигурацию
-                    new_ticker = {
-                        "symbol": symbol,
-                        "exchange_segment": "NSE_FNO",
-                        "security_id": security_id
-                    }
-                    
-                    # Добавляем новый тикер в список
-                    config['tickers'].append(new_ticker)
-                    
-                    # Сохраняем обновленную конфигурацию
-                    try:
-                        with open(CONFIG_FILE, 'w') as f:
-                            json.dump(config, f, indent=2)
-                        logger.info(f"Конфигурация обновлена: добавлен новый тикер {symbol} с Security ID {security_id}")
-                        
-                        # Перезапускаем WebSocket для подписки на новый тикер
-                        from dhan_ws import restart_ws
-                        restart_ws()
-                        logger.info(f"WebSocket перезапущен для подписки на тикер {symbol}")
-                    except Exception as e:
-                        logger.error(f"Ошибка при сохранении конфигурации: {e}")
-                else:
-                    logger.warning(f"Security ID для тикера {symbol} не найден")
-        
-        # Получаем данные OI
-        current_oi = get_oi(symbol)
+        if not get_registry().get(symbol):
+            new_ticker = discover_ticker(symbol)
+            if new_ticker:
+                # Подписываемся на новый тикер по открытому соединению
+                from dhan_ws import subscribe
+                if subscribe([new_ticker]):
+                    logger.info(f"Отправлен запрос на подписку на тикер {symbol}")
         
-        # Улучшенная обработка ошибок
-        if not current_oi:
-            # Проверяем возраст данных для более информативного сообщения
-            age = get_oi_age(symbol)
-            if age is not None:
-                error_msg = f"OI data is stale (last update {int(age)} seconds ago)"
-                logger.warning(f"{error_msg} для {symbol}")
-                return jsonify({
-                    "error": error_msg, 
-                    "symbol": symbol,
-                    "status": "error",
-                    "error_code": "STALE_DATA"
-                }), 503  # Service Unavailable
-            else:
-                error_msg = f"No OI data available for {symbol}"
-                logger.warning(error_msg)
-                return jsonify({
-                    "error": error_msg, 
-                    "symbol": symbol,
-                    "status": "error",
-                    "error_code": "NO_DATA"
-                }), 200  # Изменено с 404 на 200
-        
-        # Получаем текущее время и используем его как временную метку
-        current_time = int(time.time())
-        
-        # Если это первый запрос для данного символа, инициализируем исторические данные
-        if symbol not in historical_oi:
-            logger.info(f"Инициализация исторических данных для {symbol}")
-            historical_oi[symbol] = {
-                "15min": {"time": current_time, "oi": current_oi},
-                "45min": {"time": current_time, "oi": current_oi},
-                "75min": {"time": current_time, "oi": current_oi},
-                "2hours": {"time": current_time, "oi": current_oi},
-                "4hours": {"time": current_time, "oi": current_oi}
-            }
-        
-        # Обновляем исторические данные на основе прошедшего времени
-        intervals = {
-            "15min": 15 * 60,
-            "45min": 45 * 60,
-            "75min": 75 * 60,
-            "2hours": 2 * 60 * 60,
-            "4hours": 4 * 60 * 60
-        }
-        
-        results = {}
-        
-        for interval, seconds in intervals.items():
-            try:
-                # Если прошло больше времени, чем интервал, обновляем историческое значение
-                if current_time - historical_oi[symbol][interval]["time"] >= seconds:
-                    old_oi = historical_oi[symbol][interval]["oi"]
-                    oi_change_pct = ((current_oi - old_oi) / old_oi * 100) if old_oi else 0
-                    logger.debug(f"Обновление интервала {interval} для {symbol}: изменение OI {oi_change_pct:.2f}%")
-                    
-                    # Обновляем историческое значение
-                    historical_oi[symbol][interval] = {"time": current_time, "oi": current_oi}
-                else:
-                    # Используем текущие исторические данные для расчета изменения
-                    old_oi = historical_oi[symbol][interval]["oi"]
-                    oi_change_pct = ((current_oi - old_oi) / old_oi * 100) if old_oi else 0
-                
-                results[interval] = {
-                    "oi": current_oi,
-                    "oi_change_pct": round(oi_change_pct, 2)
-                }
-            except Exception as e:
-                logger.error(f"Ошибка при расчете изменения OI для {symbol} в интервале {interval}: {e}")
-                results[interval] = {
-                    "oi": current_oi,
-                    "oi_change_pct": 0.0  # По умолчанию, если произошла ошибка
-                }
-        
-        response_data = {
-            "symbol": symbol,
-            "current_oi": current_oi,
-            "intervals": results,
-            "status": "success",
-            "last_update": current_time
-        }
-        
-        logger.info(f"Успешно отправлены данные для {symbol}")
-        return jsonify(response_data)
+        # Ответ кэшируется до следующего тика по символу
+        timeframes = request.args.get("timeframes")
+        return cached_json_response(("tv_data", symbol, timeframes), tv_data_tag(symbol),
+                                    lambda: build_tv_data(symbol, timeframes))
     
     except Exception as e:
         logger.error(f"Необработанная ошибка в tv_data для {request.args.get('symbol', 'Unknown')}: {e}", exc_info=True)
@@ -167,4 +189,80 @@ def tv_data():
             "symbol": request.args.get("symbol", "Unknown"),
             "status": "error",
             "error_code": "SERVER_ERROR"
-        }), 500 
\ No newline at end of file
+        }), 500 
+
+def build_tv_data_batch(symbols, timeframes=None):
+    """
+    Формирует ответ /tv_data_batch: (payload, status).
+
+    Args:
+        symbols: список символов, строка через запятую или "all"
+        timeframes: интервалы в минутах - строка через запятую или список
+    """
+    if isinstance(symbols, str):
+        symbols = [s.strip() for s in symbols.split(",") if s.strip()]
+    if isinstance(timeframes, list):
+        timeframes = ",".join(str(t) for t in timeframes)
+    if symbols == ["all"]:
+        symbols = [ticker["symbol"] for ticker in get_registry().instruments()]
+    
+    intervals = get_intervals(timeframes)
+    labels = list(intervals)
+    
+    # Символы без свежих данных отдаются с кодом ошибки, как в /tv_data
+    results = {}
+    available = []
+    current_values = []
+    states = get_states(symbols)
+    for symbol in symbols:
+        state = states.get(symbol)
+        if is_fresh(state) and state[0]:
+            available.append(symbol)
+            current_values.append(state[0])
+        elif state is not None:
+            results[symbol] = {"status": "error", "error_code": "STALE_DATA"}
+        else:
+            results[symbol] = {"status": "error", "error_code": "NO_DATA"}
+    
+    if available:
+        matrix = get_oi_change_matrix(available, list(intervals.values()), current_values).round(2)
+        for row, symbol in enumerate(available):
+            current_oi = current_values[row]
+            results[symbol] = {
+                "current_oi": current_oi,
+                "intervals": {
+                    label: {"oi": current_oi, "oi_change_pct": float(matrix[row, col])}
+                    for col, label in enumerate(labels)
+                },
+                "status": "success"
+            }
+    
+    return {
+        "symbols": results,
+        "intervals": labels,
+        "status": "success",
+        "last_update": int(time.time())
+    }, 200
+
+@tv_bp.route("/tv_data_batch", methods=["GET", "POST"])
+def tv_data_batch():
+    """
+    Данные для нескольких символов за один запрос.
+    
+    Параметры (query или JSON-тело POST):
+        symbols    - символы через запятую или "all" для всех настроенных тикеров
+        timeframes - интервалы в минутах через запятую (по умолчанию как в /tv_data)
+    """
+    try:
+        params = (request.get_json(silent=True) or {}) if request.method == "POST" else {}
+        symbols = params.get("symbols", request.args.get("symbols", "all"))
+        timeframes = params.get("timeframes", request.args.get("timeframes"))
+        payload, status = build_tv_data_batch(symbols, timeframes)
+        return jsonify(payload), status
+    except Exception as e:
+        logger.error(f"Необработанная ошибка в tv_data_batch: {e}", exc_info=True)
+        return jsonify({
+            "error": f"Internal server error: {str(e)}",
+            "status": "error",
+            "error_code": "SERVER_ERROR"
+        }), 500